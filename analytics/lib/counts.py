@@ -2,19 +2,25 @@ import time
 from collections import OrderedDict, defaultdict
 from datetime import datetime, timedelta
 import logging
-from typing import Callable, Dict, List, \
+import os
+from typing import Any, Callable, Dict, List, \
     Optional, Tuple, Type, Union
 
+import redis
+import ujson
 from django.conf import settings
-from django.db import connection
+from django.db import connection, transaction
 from django.db.models import F
+from django.utils.timezone import utc as timezone_utc
 
 from analytics.models import BaseCount, \
     FillState, InstallationCount, RealmCount, StreamCount, \
     UserCount, installation_epoch, last_successful_fill
 from zerver.lib.logging_util import log_to_file
-from zerver.lib.timestamp import ceiling_to_day, \
-    ceiling_to_hour, floor_to_hour, verify_UTC
+from zerver.lib.parallel import run_parallel
+from zerver.lib.redis_utils import get_redis_client
+from zerver.lib.timestamp import ceiling_to_day, ceiling_to_hour, \
+    datetime_to_timestamp, floor_to_hour, timestamp_to_datetime, verify_UTC
 from zerver.models import Message, Realm, \
     Stream, UserActivityInterval, UserProfile, models
 
@@ -52,8 +58,13 @@ class CountStat:
         return "<CountStat: %s>" % (self.property,)
 
 class LoggingCountStat(CountStat):
-    def __init__(self, property: str, output_table: Type[BaseCount], frequency: str) -> None:
+    def __init__(self, property: str, output_table: Type[BaseCount], frequency: str,
+                 buffered: bool=True) -> None:
         CountStat.__init__(self, property, DataCollector(output_table, None), frequency)
+        # Whether increments may be buffered with BUFFER_LOGGING_STATS;
+        # stats that are read live, rather than after being filled,
+        # need buffered=False.
+        self.buffered = buffered
 
 class DependentCountStat(CountStat):
     def __init__(self, property: str, data_collector: 'DataCollector', frequency: str,
@@ -69,7 +80,50 @@ class DataCollector:
 
 ## CountStat-level operations ##
 
-def process_count_stat(stat: CountStat, fill_to_time: datetime) -> None:
+def process_count_stats(stats: List[CountStat], fill_to_time: datetime,
+                        processes: int=1, batch_size: int=1) -> None:
+    '''
+    Processes the given stats like process_count_stat, with the stats
+    that don't depend on other stats in parallel, in up to `processes`
+    child processes; the DependentCountStats are processed afterwards,
+    in order.
+    '''
+    independent_stats = [stat for stat in stats if not isinstance(stat, DependentCountStat)]
+    dependent_stats = [stat for stat in stats if isinstance(stat, DependentCountStat)]
+
+    if processes > 1 and len(independent_stats) > 1:
+        def process_stat(stat: CountStat) -> int:
+            try:
+                process_count_stat(stat, fill_to_time, batch_size=batch_size)
+            except Exception:
+                logger.exception("FAILED %s" % (stat.property,))
+                return 1
+            return 0
+
+        # The child processes can't share our database connection.
+        connection.close()
+        failed = [stat.property for (status, stat) in
+                  run_parallel(process_stat, independent_stats, processes)
+                  if status != 0]
+        if failed:
+            raise RuntimeError("Failed to process %s" % (", ".join(failed),))
+    else:
+        for stat in independent_stats:
+            process_count_stat(stat, fill_to_time, batch_size=batch_size)
+
+    for stat in dependent_stats:
+        process_count_stat(stat, fill_to_time, batch_size=batch_size)
+
+def process_count_stat(stat: CountStat, fill_to_time: datetime, batch_size: int=1) -> None:
+    '''
+    Fills the stat through fill_to_time.  With batch_size > 1, the
+    hours (or days) to fill are filled batch_size at a time, each batch
+    in a single transaction, aggregated to the summary tables with one
+    query per table; this is much faster for long backfills.
+    '''
+    if isinstance(stat, LoggingCountStat) and settings.BUFFER_LOGGING_STATS:
+        flush_logging_stat_buffer()
+
     if stat.frequency == CountStat.HOUR:
         time_increment = timedelta(hours=1)
     elif stat.frequency == CountStat.DAY:
@@ -108,16 +162,37 @@ def process_count_stat(stat: CountStat, fill_to_time: datetime) -> None:
                 return
             fill_to_time = min(fill_to_time, dependency_fill_time)
 
+    fill_start = time.time()
+    filled = 0
     currently_filled = currently_filled + time_increment
     while currently_filled <= fill_to_time:
-        logger.info("START %s %s" % (stat.property, currently_filled))
+        end_times = []  # type: List[datetime]
+        while currently_filled <= fill_to_time and len(end_times) < batch_size:
+            end_times.append(currently_filled)
+            currently_filled = currently_filled + time_increment
+
+        logger.info("START %s %s" % (stat.property, end_times[0]))
         start = time.time()
-        do_update_fill_state(fill_state, currently_filled, FillState.STARTED)
-        do_fill_count_stat_at_hour(stat, currently_filled)
-        do_update_fill_state(fill_state, currently_filled, FillState.DONE)
+        if len(end_times) == 1:
+            do_update_fill_state(fill_state, end_times[0], FillState.STARTED)
+            do_fill_count_stat_at_hour(stat, end_times[0])
+            do_update_fill_state(fill_state, end_times[0], FillState.DONE)
+        else:
+            # Since the whole batch is one transaction, we don't need
+            # the STARTED state to recover from a crash partway through.
+            with transaction.atomic():
+                for end_time in end_times:
+                    do_pull_count_stat_at_hour(stat, end_time)
+                do_aggregate_to_summary_table(stat, end_times[-1], first_end_time=end_times[0])
+                do_update_fill_state(fill_state, end_times[-1], FillState.DONE)
         end = time.time()
-        currently_filled = currently_filled + time_increment
-        logger.info("DONE %s (%dms)" % (stat.property, (end-start)*1000))
+        filled += len(end_times)
+        logger.info("DONE %s %s (%dms)" % (stat.property, end_times[-1], (end-start)*1000))
+
+    if filled > 0:
+        elapsed = time.time() - fill_start
+        logger.info("FINISHED %s: %d %ss in %.1fs (%.1f/s)" % (
+            stat.property, filled, stat.frequency, elapsed, filled / max(elapsed, 0.001)))
 
 def do_update_fill_state(fill_state: FillState, end_time: datetime, state: int) -> None:
     fill_state.end_time = end_time
@@ -127,6 +202,10 @@ def do_update_fill_state(fill_state: FillState, end_time: datetime, state: int)
 # We assume end_time is valid (e.g. is on a day or hour boundary as appropriate)
 # and is timezone aware. It is the caller's responsibility to enforce this!
 def do_fill_count_stat_at_hour(stat: CountStat, end_time: datetime) -> None:
+    do_pull_count_stat_at_hour(stat, end_time)
+    do_aggregate_to_summary_table(stat, end_time)
+
+def do_pull_count_stat_at_hour(stat: CountStat, end_time: datetime) -> None:
     start_time = end_time - stat.interval
     if not isinstance(stat, LoggingCountStat):
         timer = time.time()
@@ -134,7 +213,6 @@ def do_fill_count_stat_at_hour(stat: CountStat, end_time: datetime) -> None:
         rows_added = stat.data_collector.pull_function(stat.property, start_time, end_time)
         logger.info("%s run pull_function (%dms/%sr)" %
                     (stat.property, (time.time()-timer)*1000, rows_added))
-    do_aggregate_to_summary_table(stat, end_time)
 
 def do_delete_counts_at_hour(stat: CountStat, end_time: datetime) -> None:
     if isinstance(stat, LoggingCountStat):
@@ -147,7 +225,12 @@ def do_delete_counts_at_hour(stat: CountStat, end_time: datetime) -> None:
         RealmCount.objects.filter(property=stat.property, end_time=end_time).delete()
         InstallationCount.objects.filter(property=stat.property, end_time=end_time).delete()
 
-def do_aggregate_to_summary_table(stat: CountStat, end_time: datetime) -> None:
+# Aggregates the counts with end times from first_end_time (by default,
+# end_time) through end_time.
+def do_aggregate_to_summary_table(stat: CountStat, end_time: datetime,
+                                  first_end_time: Optional[datetime]=None) -> None:
+    if first_end_time is None:
+        first_end_time = end_time
     cursor = connection.cursor()
 
     # Aggregate into RealmCount
@@ -158,19 +241,20 @@ def do_aggregate_to_summary_table(stat: CountStat, end_time: datetime) -> None:
                 (realm_id, value, property, subgroup, end_time)
             SELECT
                 zerver_realm.id, COALESCE(sum(%(output_table)s.value), 0), '%(property)s',
-                %(output_table)s.subgroup, %%(end_time)s
+                %(output_table)s.subgroup, %(output_table)s.end_time
             FROM zerver_realm
             JOIN %(output_table)s
             ON
                 zerver_realm.id = %(output_table)s.realm_id
             WHERE
                 %(output_table)s.property = '%(property)s' AND
-                %(output_table)s.end_time = %%(end_time)s
-            GROUP BY zerver_realm.id, %(output_table)s.subgroup
+                %(output_table)s.end_time >= %%(first_end_time)s AND
+                %(output_table)s.end_time <= %%(end_time)s
+            GROUP BY zerver_realm.id, %(output_table)s.subgroup, %(output_table)s.end_time
         """ % {'output_table': output_table._meta.db_table,
                'property': stat.property}
         start = time.time()
-        cursor.execute(realmcount_query, {'end_time': end_time})
+        cursor.execute(realmcount_query, {'first_end_time': first_end_time, 'end_time': end_time})
         end = time.time()
         logger.info("%s RealmCount aggregation (%dms/%sr)" % (
             stat.property, (end - start) * 1000, cursor.rowcount))
@@ -180,15 +264,16 @@ def do_aggregate_to_summary_table(stat: CountStat, end_time: datetime) -> None:
         INSERT INTO analytics_installationcount
             (value, property, subgroup, end_time)
         SELECT
-            sum(value), '%(property)s', analytics_realmcount.subgroup, %%(end_time)s
+            sum(value), '%(property)s', analytics_realmcount.subgroup, analytics_realmcount.end_time
         FROM analytics_realmcount
         WHERE
             property = '%(property)s' AND
-            end_time = %%(end_time)s
-        GROUP BY analytics_realmcount.subgroup
+            end_time >= %%(first_end_time)s AND
+            end_time <= %%(end_time)s
+        GROUP BY analytics_realmcount.subgroup, analytics_realmcount.end_time
     """ % {'property': stat.property}
     start = time.time()
-    cursor.execute(installationcount_query, {'end_time': end_time})
+    cursor.execute(installationcount_query, {'first_end_time': first_end_time, 'end_time': end_time})
     end = time.time()
     logger.info("%s InstallationCount aggregation (%dms/%sr)" % (
         stat.property, (end - start) * 1000, cursor.rowcount))
@@ -213,13 +298,123 @@ def do_increment_logging_stat(zerver_object: Union[Realm, UserProfile, Stream],
     else:  # CountStat.HOUR:
         end_time = ceiling_to_hour(event_time)
 
+    if settings.BUFFER_LOGGING_STATS and isinstance(stat, LoggingCountStat) and stat.buffered:
+        buffer_logging_stat_increment(table, stat.property, id_args, subgroup, end_time, increment)
+    else:
+        increment_count_row(table, stat.property, id_args, subgroup, end_time, increment)
+
+def increment_count_row(table: Type[BaseCount], property: str, id_args: Dict[str, Any],
+                        subgroup: Optional[Union[str, int, bool]], end_time: datetime,
+                        increment: int) -> None:
     row, created = table.objects.get_or_create(
-        property=stat.property, subgroup=subgroup, end_time=end_time,
+        property=property, subgroup=subgroup, end_time=end_time,
         defaults={'value': increment}, **id_args)
     if not created:
         row.value = F('value') + increment
         row.save(update_fields=['value'])
 
+## Buffered LoggingCountStat increments ##
+
+# Increments to LoggingCountStats happen in user-facing actions, and
+# many of them hit the same few rows (e.g. a realm's count of active
+# users for today), so with BUFFER_LOGGING_STATS they're summed in a
+# redis hash, keyed by the row they're for, and written to the count
+# tables in bulk before the LoggingCountStats are next filled.
+
+# Prefixed with KEY_PREFIX, so that each test gets its own buffer.
+KEY_PREFIX = ''
+LOGGING_STAT_BUFFER_KEY = 'analytics:logging_stat_buffer'
+# Holds the increments being written by flush_logging_stat_buffer, so
+# that a failed flush can be retried.
+LOGGING_STAT_FLUSHING_KEY = 'analytics:logging_stat_buffer:flushing'
+# Identifies the flush of the increments in LOGGING_STAT_FLUSHING_KEY;
+# the FillState for LOGGING_STAT_FLUSH_PROPERTY records the last flush
+# written to the count tables, in the same transaction, so that a
+# retry after a crash between that commit and deleting the increments
+# from redis doesn't apply them twice.
+LOGGING_STAT_FLUSH_TIME_KEY = 'analytics:logging_stat_buffer:flush_time'
+LOGGING_STAT_FLUSH_PROPERTY = 'logging_stat_buffer_flush'
+LOGGING_STAT_FLUSH_LOCK_KEY = 'analytics:logging_stat_buffer:lock'
+
+LOGGING_STAT_TABLES = {
+    'realm': RealmCount,
+    'user': UserCount,
+    'stream': StreamCount,
+}  # type: Dict[str, Type[BaseCount]]
+
+redis_client = get_redis_client()
+
+def bounce_redis_key_prefix_for_testing(test_name: str) -> None:
+    global KEY_PREFIX
+    KEY_PREFIX = test_name + ':' + str(os.getpid()) + ':'
+
+def buffer_logging_stat_increment(table: Type[BaseCount], property: str,
+                                  id_args: Dict[str, Any],
+                                  subgroup: Optional[Union[str, int, bool]],
+                                  end_time: datetime, increment: int) -> None:
+    if table == RealmCount:
+        (table_name, object_id) = ('realm', id_args['realm'].id)
+    elif table == UserCount:
+        (table_name, object_id) = ('user', id_args['user'].id)
+    else:  # StreamCount
+        (table_name, object_id) = ('stream', id_args['stream'].id)
+    # The subgroup column is a string; convert it here so that e.g.
+    # True and 'True' are buffered together.
+    if subgroup is not None:
+        subgroup = str(subgroup)
+    field = ujson.dumps([property, table_name, id_args['realm'].id, object_id,
+                         subgroup, datetime_to_timestamp(end_time)])
+    redis_client.hincrby(KEY_PREFIX + LOGGING_STAT_BUFFER_KEY, field, increment)
+
+def flush_logging_stat_buffer() -> int:
+    '''
+    Writes the buffered LoggingCountStat increments to the count
+    tables, returning the number of rows updated.
+    '''
+    flushing_key = KEY_PREFIX + LOGGING_STAT_FLUSHING_KEY
+    flush_time_key = KEY_PREFIX + LOGGING_STAT_FLUSH_TIME_KEY
+    with redis_client.lock(KEY_PREFIX + LOGGING_STAT_FLUSH_LOCK_KEY, timeout=600):
+        # If a previous flush failed, retry its increments before
+        # taking the ones buffered since.
+        if not redis_client.exists(flushing_key):
+            try:
+                redis_client.rename(KEY_PREFIX + LOGGING_STAT_BUFFER_KEY, flushing_key)
+            except redis.ResponseError:
+                # Nothing is buffered.
+                return 0
+        flush_timestamp = redis_client.get(flush_time_key)
+        if flush_timestamp is None:
+            flush_timestamp = str(time.time())
+            redis_client.set(flush_time_key, flush_timestamp)
+        flush_time = datetime.fromtimestamp(float(flush_timestamp), tz=timezone_utc)
+
+        start = time.time()
+        increments = redis_client.hgetall(flushing_key)
+        with transaction.atomic():
+            fill_state = FillState.objects.select_for_update().filter(
+                property=LOGGING_STAT_FLUSH_PROPERTY).first()
+            if fill_state is not None and fill_state.end_time == flush_time:
+                # This flush was written; we failed to delete it.
+                increments = {}
+            for (field, increment) in increments.items():
+                (property, table_name, realm_id, object_id,
+                 subgroup, end_timestamp) = ujson.loads(field)
+                id_args = {'realm_id': realm_id}
+                if table_name != 'realm':
+                    id_args[table_name + '_id'] = object_id
+                increment_count_row(LOGGING_STAT_TABLES[table_name], property, id_args,
+                                    subgroup, timestamp_to_datetime(end_timestamp),
+                                    int(increment))
+            FillState.objects.update_or_create(
+                property=LOGGING_STAT_FLUSH_PROPERTY,
+                defaults={'end_time': flush_time, 'state': FillState.DONE})
+        # Deleting both keys in one command means a flush time is never
+        # left behind to be mistaken for that of the next flush.
+        redis_client.delete(flushing_key, flush_time_key)
+    logger.info("flushed %d buffered logging stat rows (%dms)" %
+                (len(increments), (time.time()-start)*1000))
+    return len(increments)
+
 def do_drop_all_analytics_tables() -> None:
     UserCount.objects.all().delete()
     StreamCount.objects.all().delete()
@@ -523,7 +718,8 @@ count_stats_ = [
     # Rate limiting stats
 
     # Used to limit the number of invitation emails sent by a realm
-    LoggingCountStat('invites_sent::day', RealmCount, CountStat.DAY),
+    # check_invite_limit reads this live, so it can't be buffered.
+    LoggingCountStat('invites_sent::day', RealmCount, CountStat.DAY, buffered=False),
 
     # Dependent stats
     # Must come after their dependencies.
@@ -9,7 +9,9 @@ from django.utils.dateparse import parse_datetime
 from django.utils.timezone import now as timezone_now
 from django.utils.timezone import utc as timezone_utc
 
-from analytics.lib.counts import COUNT_STATS, logger, process_count_stat
+from analytics.lib.counts import COUNT_STATS, logger, process_count_stat, \
+    process_count_stats
+from analytics.views import precompute_chart_data
 from scripts.lib.zulip_tools import ENDC, WARNING
 from zerver.lib.remote_server import send_analytics_to_remote_server
 from zerver.lib.timestamp import floor_to_hour
@@ -37,6 +39,16 @@ class Command(BaseCommand):
                             action='store_true',
                             help="Print timing information to stdout.",
                             default=False)
+        parser.add_argument('--processes',
+                            type=int,
+                            help="Number of processes to fill independent stats in.",
+                            default=1)
+        parser.add_argument('--batch-size',
+                            dest='batch_size',
+                            type=int,
+                            help="Number of hours (or days) to fill per transaction; "
+                                 "larger values make long backfills faster.",
+                            default=1)
 
     def handle(self, *args: Any, **options: Any) -> None:
         try:
@@ -75,13 +87,24 @@ class Command(BaseCommand):
             start = time.time()
             last = start
 
-        for stat in stats:
-            process_count_stat(stat, fill_to_time)
-            if options['verbose']:
-                print("Updated %s in %.3fs" % (stat.property, time.time() - last))
-                last = time.time()
+        if options['processes'] > 1:
+            process_count_stats(stats, fill_to_time, processes=options['processes'],
+                                batch_size=options['batch_size'])
+        else:
+            for stat in stats:
+                process_count_stat(stat, fill_to_time, batch_size=options['batch_size'])
+                if options['verbose']:
+                    print("Updated %s in %.3fs" % (stat.property, time.time() - last))
+                    last = time.time()
 
+        try:
+            precompute_chart_data()
+        except Exception:
+            # This is just an optimization, so it mustn't stop us from
+            # sending analytics to the push notification bouncer.
+            logger.exception("Error precomputing chart data")
         if options['verbose']:
+            print("Precomputed chart data in %.3fs" % (time.time() - last,))
             print("Finished updating analytics counts through %s in %.3fs" %
                   (fill_to_time, time.time() - start))
         logger.info("Finished updating analytics counts through %s" % (fill_to_time,))
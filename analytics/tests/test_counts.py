@@ -2,19 +2,21 @@
 from datetime import datetime, timedelta
 from typing import Any, Dict, List, Optional, Tuple, Type
 
+import mock
 import ujson
 from django.apps import apps
 from django.db import models
 from django.db.models import Sum
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.utils.timezone import now as timezone_now
 from django.utils.timezone import utc as timezone_utc
 
+from analytics.lib import counts
 from analytics.lib.counts import COUNT_STATS, CountStat, \
     DependentCountStat, LoggingCountStat, do_aggregate_to_summary_table, \
     do_drop_all_analytics_tables, do_drop_single_stat, \
     do_fill_count_stat_at_hour, do_increment_logging_stat, \
-    process_count_stat, sql_data_collector
+    flush_logging_stat_buffer, process_count_stat, sql_data_collector
 from analytics.models import BaseCount, \
     FillState, InstallationCount, RealmCount, StreamCount, \
     UserCount, installation_epoch
@@ -192,6 +194,15 @@ class TestProcessCountStat(AnalyticsTestCase):
         self.assertFillStateEquals(stat, current_time)
         self.assertEqual(InstallationCount.objects.filter(property=stat.property).count(), 2)
 
+    def test_process_stat_in_batches(self) -> None:
+        stat = self.make_dummy_count_stat('test stat')
+        end_times = [installation_epoch() + i*self.HOUR for i in range(1, 5)]
+        process_count_stat(stat, end_times[-1], batch_size=3)
+        self.current_property = stat.property
+        self.assertFillStateEquals(stat, end_times[-1])
+        self.assertTableState(InstallationCount, ['value', 'end_time'],
+                              [[1, end_time] for end_time in end_times])
+
     def test_bad_fill_to_time(self) -> None:
         stat = self.make_dummy_count_stat('test stat')
         with self.assertRaises(ValueError):
@@ -778,6 +789,45 @@ class TestLoggingCountStats(AnalyticsTestCase):
         self.assertTableState(UserCount, ['property', 'value'], [['user test', 1]])
         self.assertTableState(StreamCount, ['property', 'value'], [['stream test', 1]])
 
+    def test_buffered_increments(self) -> None:
+        realm_stat = LoggingCountStat('realm test', RealmCount, CountStat.DAY)
+        user_stat = LoggingCountStat('user test', UserCount, CountStat.DAY)
+        user = self.create_user()
+        with override_settings(BUFFER_LOGGING_STATS=True):
+            do_increment_logging_stat(self.default_realm, realm_stat, True, self.TIME_ZERO)
+            do_increment_logging_stat(self.default_realm, realm_stat, 'True', self.TIME_ZERO,
+                                      increment=2)
+            do_increment_logging_stat(self.default_realm, realm_stat, None, self.TIME_ZERO)
+            do_increment_logging_stat(user, user_stat, None, self.TIME_ZERO)
+            self.assertFalse(RealmCount.objects.exists())
+            self.assertFalse(UserCount.objects.exists())
+
+            self.assertEqual(flush_logging_stat_buffer(), 3)
+            self.assertTableState(RealmCount, ['property', 'subgroup', 'value'],
+                                  [['realm test', 'True', 3], ['realm test', None, 1]])
+            self.assertTableState(UserCount, ['property', 'value'], [['user test', 1]])
+
+            # Filling the stat flushes the increments buffered since.
+            do_increment_logging_stat(self.default_realm, realm_stat, None, self.TIME_ZERO)
+            process_count_stat(realm_stat, self.TIME_ZERO)
+            self.assertEqual(flush_logging_stat_buffer(), 0)
+            self.assertTableState(InstallationCount, ['property', 'subgroup', 'value'],
+                                  [['realm test', 'True', 3], ['realm test', None, 2]])
+
+            # A flush that's retried after being written, but not
+            # deleted from redis, isn't written again.
+            do_increment_logging_stat(user, user_stat, None, self.TIME_ZERO)
+            with mock.patch.object(counts.redis_client, 'delete', side_effect=Exception):
+                with self.assertRaises(Exception):
+                    flush_logging_stat_buffer()
+            self.assertEqual(flush_logging_stat_buffer(), 0)
+            self.assertTableState(UserCount, ['property', 'value'], [['user test', 2]])
+
+            # Stats that are read live aren't buffered.
+            do_increment_logging_stat(self.default_realm, COUNT_STATS['invites_sent::day'],
+                                      None, self.TIME_ZERO)
+            self.assertEqual(RealmCount.objects.filter(property='invites_sent::day').count(), 1)
+
     def test_active_users_log_by_is_bot(self) -> None:
         property = 'active_users_log:is_bot:day'
         user = do_create_user('email', 'password', self.default_realm, 'full_name', 'short_name')
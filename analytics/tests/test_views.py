@@ -9,8 +9,8 @@ from analytics.lib.counts import COUNT_STATS, CountStat
 from analytics.lib.time_utils import time_range
 from analytics.models import FillState, \
     RealmCount, UserCount, last_successful_fill
-from analytics.views import rewrite_client_arrays, \
-    sort_by_totals, sort_client_labels
+from analytics.views import get_values_by_subgroup, precompute_chart_data, \
+    rewrite_client_arrays, sort_by_totals, sort_client_labels
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.timestamp import ceiling_to_day, \
     ceiling_to_hour, datetime_to_timestamp
@@ -136,6 +136,42 @@ class TestGetChartData(ZulipTestCase):
             'result': 'success',
         })
 
+    def test_cached_time_series(self) -> None:
+        stat = COUNT_STATS['messages_sent:is_bot:hour']
+        self.insert_data(stat, ['true', 'false'], ['false'])
+        result = self.client_get('/json/analytics/chart_data',
+                                 {'chart_name': 'messages_sent_over_time'})
+        self.assertEqual(result.json()['everyone'], {'bot': self.data(100), 'human': self.data(101)})
+
+        # The realm's time series is cached until the stat is next
+        # filled; the user's isn't.
+        RealmCount.objects.filter(property=stat.property).update(value=1)
+        UserCount.objects.filter(property=stat.property).update(value=2)
+        result = self.client_get('/json/analytics/chart_data',
+                                 {'chart_name': 'messages_sent_over_time'})
+        self.assertEqual(result.json()['everyone'], {'bot': self.data(100), 'human': self.data(101)})
+        self.assertEqual(result.json()['user'], {'bot': self.data(0), 'human': self.data(2)})
+
+        # Only realms whose charts were viewed recently are precomputed.
+        with mock.patch('analytics.views.get_values_by_subgroup',
+                        wraps=get_values_by_subgroup) as mock_get_values:
+            precompute_chart_data(min_length=None)
+        key_ids = {call[0][2] for call in mock_get_values.call_args_list}
+        self.assertIn(get_realm('zulip').id, key_ids)
+        self.assertNotIn(get_realm('lear').id, key_ids)
+        result = self.client_get('/json/analytics/chart_data',
+                                 {'chart_name': 'messages_sent_over_time'})
+        self.assertEqual(result.json()['everyone'], {'bot': self.data(1), 'human': self.data(1)})
+
+        # Data for end times the stat hasn't been filled through yet
+        # may still change, so it isn't cached.
+        params = {'chart_name': 'messages_sent_over_time',
+                  'end': datetime_to_timestamp(self.end_times_hour[-1] + timedelta(hours=1))}
+        self.client_get('/json/analytics/chart_data', params)
+        RealmCount.objects.filter(property=stat.property).update(value=3)
+        result = self.client_get('/json/analytics/chart_data', params)
+        self.assertEqual(result.json()['everyone']['bot'], [0, 0, 3, 0, 0])
+
     def test_messages_sent_by_message_type(self) -> None:
         stat = COUNT_STATS['messages_sent:message_type:day']
         self.insert_data(stat, ['public_stream', 'private_message'],
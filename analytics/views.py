@@ -31,11 +31,13 @@ from analytics.models import BaseCount, InstallationCount, \
     RealmCount, StreamCount, UserCount, last_successful_fill, installation_epoch
 from zerver.decorator import require_server_admin, require_server_admin_api, \
     to_non_negative_int, to_utc_datetime, zulip_login_required, require_non_guest_user
+from zerver.lib.cache import cache_get, cache_set
 from zerver.lib.exceptions import JsonableError
 from zerver.lib.json_encoder_for_html import JSONEncoderForHTML
 from zerver.lib.request import REQ, has_request_variables
 from zerver.lib.response import json_success
-from zerver.lib.timestamp import convert_to_UTC, timestamp_to_datetime
+from zerver.lib.timestamp import convert_to_UTC, datetime_to_timestamp, \
+    timestamp_to_datetime
 from zerver.lib.realm_icon import realm_icon_url
 from zerver.views.invite import get_invitee_emails_set
 from zerver.lib.subdomains import get_subdomain_from_hostname
@@ -145,6 +147,28 @@ def get_chart_data_for_remote_installation(
     return get_chart_data(request=request, user_profile=user_profile, for_installation=True,
                           remote=True, server=server, **kwargs)
 
+# The properties of the stats shown in each chart.
+CHART_STATS = {
+    'number_of_humans': ['1day_actives::day', 'realm_active_humans::day',
+                         'active_users_audit:is_bot:day'],
+    'messages_sent_over_time': ['messages_sent:is_bot:hour'],
+    'messages_sent_by_message_type': ['messages_sent:message_type:day'],
+    'messages_sent_by_client': ['messages_sent:client:day'],
+}  # type: Dict[str, List[str]]
+
+# The min_length that the /stats page requests charts with.
+STATS_PAGE_MIN_LENGTH = 10
+
+def last_successful_chart_fill(stats: List[CountStat]) -> datetime:
+    return max(last_successful_fill(stat.property) or
+               datetime.min.replace(tzinfo=timezone_utc) for stat in stats)
+
+def last_complete_chart_fill(stats: List[CountStat]) -> datetime:
+    """The time through which all of a chart's stats are filled, and so
+    its data won't change."""
+    return min(last_successful_fill(stat.property) or
+               datetime.min.replace(tzinfo=timezone_utc) for stat in stats)
+
 @require_non_guest_user
 @has_request_variables
 def get_chart_data(request: HttpRequest, user_profile: UserProfile, chart_name: str=REQ(),
@@ -168,11 +192,11 @@ def get_chart_data(request: HttpRequest, user_profile: UserProfile, chart_name:
         else:
             aggregate_table = RealmCount
 
+    if chart_name not in CHART_STATS:
+        raise JsonableError(_("Unknown chart name: %s") % (chart_name,))
+    stats = [COUNT_STATS[property] for property in CHART_STATS[chart_name]]
+
     if chart_name == 'number_of_humans':
-        stats = [
-            COUNT_STATS['1day_actives::day'],
-            COUNT_STATS['realm_active_humans::day'],
-            COUNT_STATS['active_users_audit:is_bot:day']]
         tables = [aggregate_table]
         subgroup_to_label = {
             stats[0]: {None: '_1day'},
@@ -181,13 +205,11 @@ def get_chart_data(request: HttpRequest, user_profile: UserProfile, chart_name:
         labels_sort_function = None
         include_empty_subgroups = True
     elif chart_name == 'messages_sent_over_time':
-        stats = [COUNT_STATS['messages_sent:is_bot:hour']]
         tables = [aggregate_table, UserCount]
         subgroup_to_label = {stats[0]: {'false': 'human', 'true': 'bot'}}
         labels_sort_function = None
         include_empty_subgroups = True
     elif chart_name == 'messages_sent_by_message_type':
-        stats = [COUNT_STATS['messages_sent:message_type:day']]
         tables = [aggregate_table, UserCount]
         subgroup_to_label = {stats[0]: {'public_stream': _('Public streams'),
                                         'private_stream': _('Private streams'),
@@ -195,16 +217,13 @@ def get_chart_data(request: HttpRequest, user_profile: UserProfile, chart_name:
                                         'huddle_message': _('Group private messages')}}
         labels_sort_function = lambda data: sort_by_totals(data['everyone'])
         include_empty_subgroups = True
-    elif chart_name == 'messages_sent_by_client':
-        stats = [COUNT_STATS['messages_sent:client:day']]
+    else:  # messages_sent_by_client
         tables = [aggregate_table, UserCount]
         # Note that the labels are further re-written by client_label_map
         subgroup_to_label = {stats[0]:
                              {str(id): name for id, name in Client.objects.values_list('id', 'name')}}
         labels_sort_function = sort_client_labels
         include_empty_subgroups = False
-    else:
-        raise JsonableError(_("Unknown chart name: %s") % (chart_name,))
 
     # Most likely someone using our API endpoint. The /stats page does not
     # pass a start or end in its requests.
@@ -241,8 +260,7 @@ def get_chart_data(request: HttpRequest, user_profile: UserProfile, chart_name:
             else:
                 start = realm.date_created
         if end is None:
-            end = max(last_successful_fill(stat.property) or
-                      datetime.min.replace(tzinfo=timezone_utc) for stat in stats)
+            end = last_successful_chart_fill(stats)
         if end is None or start > end:
             logging.warning("User from realm %s attempted to access /stats, but the computed "
                             "start time: %s (creation of realm or installation) is later than the computed "
@@ -252,6 +270,13 @@ def get_chart_data(request: HttpRequest, user_profile: UserProfile, chart_name:
 
     assert len(set([stat.frequency for stat in stats])) == 1
     end_times = time_range(start, end, stats[0].frequency, min_length)
+    if remote:
+        # Remote tables aren't cached; see get_cached_values_by_subgroup.
+        complete_until = None  # type: Optional[datetime]
+    else:
+        complete_until = last_complete_chart_fill(stats)
+        if aggregate_table is RealmCount:
+            record_chart_view(realm.id)
     data = {'end_times': end_times, 'frequency': stats[0].frequency}  # type: Dict[str, Any]
 
     aggregation_level = {
@@ -275,7 +300,8 @@ def get_chart_data(request: HttpRequest, user_profile: UserProfile, chart_name:
         data[aggregation_level[table]] = {}
         for stat in stats:
             data[aggregation_level[table]].update(get_time_series_by_subgroup(
-                stat, table, id_value[table], end_times, subgroup_to_label[stat], include_empty_subgroups))
+                stat, table, id_value[table], end_times, subgroup_to_label[stat],
+                include_empty_subgroups, complete_until))
 
     if labels_sort_function is not None:
         data['display_order'] = labels_sort_function(data)
@@ -351,21 +377,115 @@ def rewrite_client_arrays(value_arrays: Dict[str, List[int]]) -> Dict[str, List[
             mapped_arrays[mapped_label] = [value_arrays[label][i] for i in range(0, len(array))]
     return mapped_arrays
 
-def get_time_series_by_subgroup(stat: CountStat,
-                                table: Type[BaseCount],
-                                key_id: int,
-                                end_times: List[datetime],
-                                subgroup_to_label: Dict[Optional[str], str],
-                                include_empty_subgroups: bool) -> Dict[str, List[int]]:
+def get_values_by_subgroup(stat: CountStat, table: Type[BaseCount], key_id: int,
+                           end_times: List[datetime]) -> Dict[Optional[str], List[int]]:
     queryset = table_filtered_to_id(table, key_id).filter(property=stat.property) \
                                                   .values_list('subgroup', 'end_time', 'value')
     value_dicts = defaultdict(lambda: defaultdict(int))  # type: Dict[Optional[str], Dict[datetime, int]]
     for subgroup, end_time, value in queryset:
         value_dicts[subgroup][end_time] = value
+    return {subgroup: [values[end_time] for end_time in end_times]
+            for subgroup, values in value_dicts.items()}
+
+# The realm and installation-wide time series are the same for
+# everyone viewing a chart, and don't change for end times through
+# which all of the chart's stats are filled, so we cache those.  The
+# cached values are by subgroup, rather than by label, since the
+# labels are translated.
+CACHED_CHART_TABLES = [RealmCount, InstallationCount]
+CHART_DATA_CACHE_TIMEOUT = 3600 * 24
+
+# precompute_chart_data only fills the cache for realms whose charts
+# were viewed this recently; those of other realms are cached when
+# they're next viewed.
+CHART_RECENT_VIEW_WINDOW = 3600 * 24 * 7
+# How often we update a realm's entry in CHART_VIEWS_CACHE_KEY.
+CHART_VIEW_RECORD_INTERVAL = 3600
+# Maps realm IDs to the last time their charts were viewed.
+CHART_VIEWS_CACHE_KEY = 'chart_views'
+
+def get_recent_chart_views() -> Dict[int, float]:
+    cached = cache_get(CHART_VIEWS_CACHE_KEY)
+    if cached is None:
+        return {}
+    now = time.time()
+    return {realm_id: viewed for (realm_id, viewed) in cached[0].items()
+            if viewed > now - CHART_RECENT_VIEW_WINDOW}
+
+def record_chart_view(realm_id: int) -> None:
+    views = get_recent_chart_views()
+    now = time.time()
+    if views.get(realm_id, 0) > now - CHART_VIEW_RECORD_INTERVAL:
+        return
+    # Concurrent updates may lose a view, which just means that realm
+    # isn't precomputed until it's viewed again.
+    views[realm_id] = now
+    cache_set(CHART_VIEWS_CACHE_KEY, views, timeout=CHART_RECENT_VIEW_WINDOW)
+
+def chart_values_cache_key(stat: CountStat, table: Type[BaseCount], key_id: int,
+                           end_times: List[datetime]) -> str:
+    return 'chart_values:%s:%s:%s:%s:%s:%s' % (
+        stat.property, table._meta.db_table, key_id,
+        datetime_to_timestamp(end_times[0]), datetime_to_timestamp(end_times[-1]),
+        len(end_times))
+
+def get_cached_values_by_subgroup(stat: CountStat, table: Type[BaseCount], key_id: int,
+                                  end_times: List[datetime],
+                                  complete_until: Optional[datetime]) -> Dict[Optional[str], List[int]]:
+    if (table not in CACHED_CHART_TABLES or len(end_times) == 0 or
+            complete_until is None or end_times[-1] > complete_until):
+        return get_values_by_subgroup(stat, table, key_id, end_times)
+    key = chart_values_cache_key(stat, table, key_id, end_times)
+    cached = cache_get(key)
+    if cached is not None:
+        return cached[0]
+    values = get_values_by_subgroup(stat, table, key_id, end_times)
+    cache_set(key, values, timeout=CHART_DATA_CACHE_TIMEOUT)
+    return values
+
+def precompute_chart_data(min_length: Optional[int]=STATS_PAGE_MIN_LENGTH) -> None:
+    '''
+    Fills the cache with the installation-wide time series, and those
+    of realms whose charts were viewed recently, for every chart, as
+    the /stats pages will request them, so that the first views after
+    update_analytics_counts don't have to query the count tables.
+    '''
+    recent_views = get_recent_chart_views()
+    targets = [(InstallationCount, -1, installation_epoch())] + [
+        (RealmCount, realm.id, realm.date_created)
+        for realm in Realm.objects.filter(deactivated=False, id__in=recent_views.keys())
+    ]  # type: List[Tuple[Type[BaseCount], int, datetime]]
+    for properties in CHART_STATS.values():
+        stats = [COUNT_STATS[property] for property in properties]
+        end = last_successful_chart_fill(stats)
+        if end > last_complete_chart_fill(stats):
+            # Some of the chart's stats are behind, so its data for
+            # the end times the /stats page requests isn't final.
+            continue
+        for (table, key_id, start) in targets:
+            if start > end:
+                continue
+            end_times = time_range(start, end, stats[0].frequency, min_length)
+            for stat in stats:
+                cache_set(chart_values_cache_key(stat, table, key_id, end_times),
+                          get_values_by_subgroup(stat, table, key_id, end_times),
+                          timeout=CHART_DATA_CACHE_TIMEOUT)
+
+def get_time_series_by_subgroup(stat: CountStat,
+                                table: Type[BaseCount],
+                                key_id: int,
+                                end_times: List[datetime],
+                                subgroup_to_label: Dict[Optional[str], str],
+                                include_empty_subgroups: bool,
+                                complete_until: Optional[datetime]=None) -> Dict[str, List[int]]:
+    values_by_subgroup = get_cached_values_by_subgroup(stat, table, key_id, end_times,
+                                                       complete_until)
     value_arrays = {}
     for subgroup, label in subgroup_to_label.items():
-        if (subgroup in value_dicts) or include_empty_subgroups:
-            value_arrays[label] = [value_dicts[subgroup][end_time] for end_time in end_times]
+        if subgroup in values_by_subgroup:
+            value_arrays[label] = values_by_subgroup[subgroup]
+        elif include_empty_subgroups:
+            value_arrays[label] = [0] * len(end_times)
 
     if stat == COUNT_STATS['messages_sent:client:day']:
         # HACK: We rewrite these arrays to collapse the Client objects
@@ -59,11 +59,32 @@ class zulip::app_frontend_base {
   # support for Tornado sharding.
   $tornado_processes = zulipconf('application_server', 'tornado_processes', 1)
   if $tornado_processes > 1 {
-    $tornado_ports = range(9800, 9800 + $tornado_processes)
+    $tornado_ports = range(9800, 9800 + $tornado_processes - 1)
     $tornado_multiprocess = true
   } else {
     $tornado_multiprocess = false
   }
+  file { '/etc/nginx/zulip-include/tornado-upstreams':
+    require => Package[$zulip::common::nginx],
+    owner   => 'root',
+    group   => 'root',
+    mode    => '0644',
+    content => template('zulip/nginx/tornado-upstreams.template.erb'),
+    notify  => Service['nginx'],
+  }
+  if $tornado_multiprocess {
+    # Generated from /etc/zulip/sharding.json by scripts/lib/sharding.py;
+    # we only make sure it exists, so that nginx can include it.
+    file { '/etc/zulip/nginx_sharding.conf':
+      ensure  => file,
+      replace => false,
+      owner   => 'root',
+      group   => 'root',
+      mode    => '0644',
+      content => '',
+      notify  => Service['nginx'],
+    }
+  }
 
   # This determines whether we run queue processors multithreaded or
   # multiprocess.  Multiprocess scales much better, but requires more
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+#
+# Writes /etc/zulip/nginx_sharding.conf, which nginx includes to route
+# long-polling requests for the realms listed in
+# /etc/zulip/sharding.json to their assigned Tornado process.  Realms
+# not listed there are routed by hashing their hostname; see
+# zerver/tornado/sharding.py.
+#
+# /etc/zulip/sharding.json maps realm hostnames to Tornado ports, e.g.
+#   {"chat.example.com": 9801, "other.example.com": 9802}
+#
+# Run this (and reload nginx and restart Tornado) after editing
+# /etc/zulip/sharding.json.
+
+import json
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(BASE_DIR)
+from scripts.lib.zulip_tools import get_config, get_config_file
+
+# Must match TORNADO_SHARD_BASE_PORT in zerver/tornado/sharding.py.
+TORNADO_SHARD_BASE_PORT = 9800
+
+SHARDING_JSON_PATH = "/etc/zulip/sharding.json"
+NGINX_SHARDING_CONF_PATH = "/etc/zulip/nginx_sharding.conf"
+
+def write_nginx_sharding_conf() -> None:
+    config_file = get_config_file()
+    tornado_processes = int(get_config(config_file, 'application_server', 'tornado_processes', '1'))
+    valid_ports = range(TORNADO_SHARD_BASE_PORT, TORNADO_SHARD_BASE_PORT + tornado_processes)
+
+    shard_map = {}
+    if os.path.exists(SHARDING_JSON_PATH):
+        with open(SHARDING_JSON_PATH) as f:
+            shard_map = json.load(f)
+
+    lines = []
+    for host, port in sorted(shard_map.items()):
+        if int(port) not in valid_ports:
+            print("Port %s for %s is not one of the %d Tornado ports (%d-%d)." % (
+                port, host, tornado_processes, valid_ports[0], valid_ports[-1]))
+            sys.exit(1)
+        lines.append('"%s" tornado%d;\n' % (host.lower(), int(port)))
+
+    tmp_path = NGINX_SHARDING_CONF_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.writelines(lines)
+    os.rename(tmp_path, NGINX_SHARDING_CONF_PATH)
+
+if __name__ == "__main__":
+    write_nginx_sharding_conf()
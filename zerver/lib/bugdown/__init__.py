@@ -1,7 +1,7 @@
 # Zulip's main markdown implementation.  See docs/subsystems/markdown.md for
 # detailed documentation on our markdown syntax.
 from typing import (Any, Callable, Dict, Iterable, List, NamedTuple,
-                    Optional, Set, Tuple, TypeVar, Union, cast)
+                    Optional, Sequence, Set, Tuple, TypeVar, Union, cast)
 from mypy_extensions import TypedDict
 from typing.re import Match, Pattern
 
@@ -14,12 +14,13 @@ import os
 import html
 import time
 import functools
+import hashlib
 import ujson
 import xml.etree.cElementTree as etree
 from xml.etree.cElementTree import Element
 import ahocorasick
 
-from collections import deque, defaultdict
+from collections import OrderedDict, deque, defaultdict
 
 import requests
 
@@ -35,7 +36,7 @@ from zerver.lib.mention import possible_mentions, \
     possible_user_group_mentions, extract_user_group
 from zerver.lib.url_encoding import encode_stream
 from zerver.lib.thumbnail import user_uploads_or_external
-from zerver.lib.timeout import timeout, TimeoutExpired
+from zerver.lib.timeout import deadline_call, timeout, TimeoutExpired
 from zerver.lib.cache import cache_with_key, NotFoundInCache
 from zerver.lib.url_preview import preview as link_preview
 from zerver.models import (
@@ -180,6 +181,8 @@ def clear_state_for_testing() -> None:
     # a way to clear it.
     global LINK_REGEX
     LINK_REGEX = None
+    # Engines are built with the link regex, so we discard them too.
+    md_engines.clear()
 
 bugdown_logger = logging.getLogger()
 
@@ -1899,6 +1902,19 @@ class Bugdown(markdown.Markdown):
                                     'realm_filters/%s' % (pattern,), 45)
         return inlinePatterns
 
+    def set_realm_filters(self, realm_filters_key: int,
+                          realm_filters: List[Tuple[str, str, int]]) -> None:
+        # Replace just the realm filter patterns, which are the only
+        # part of the engine that depends on the realm; this is much
+        # cheaper than building a new engine.  The InlineProcessor
+        # shares our inlinePatterns registry, so it sees the change.
+        assert self.getConfig("realm") != ZEPHYR_MIRROR_BUGDOWN_KEY
+        for (pattern, format_string, id) in self.getConfig("realm_filters"):
+            self.inlinePatterns.deregister('realm_filters/%s' % (pattern,), strict=False)
+        self.config["realm_filters"][0] = realm_filters
+        self.config["realm"][0] = realm_filters_key
+        self.register_realm_filters(self.inlinePatterns)
+
     def build_treeprocessors(self) -> markdown.util.Registry:
         # Here we build all the processors from upstream, plus a few of our own.
         treeprocessors = markdown.util.Registry()
@@ -1940,24 +1956,88 @@ class Bugdown(markdown.Markdown):
             self.preprocessors = get_sub_registry(self.preprocessors, ['custom_text_notifications'])
             self.parser.blockprocessors = get_sub_registry(self.parser.blockprocessors, ['paragraph'])
 
-md_engines = {}  # type: Dict[Tuple[int, bool], markdown.Markdown]
-realm_filter_data = {}  # type: Dict[int, List[Tuple[str, str, int]]]
+class MarkdownEnginePool:
+    """A bounded pool of markdown engines, keyed by (realm_filters_key,
+    email_gateway), that evicts the least recently used engine when
+    it's full.
 
-def make_md_engine(realm_filters_key: int, email_gateway: bool) -> None:
-    md_engine_key = (realm_filters_key, email_gateway)
-    if md_engine_key in md_engines:
-        del md_engines[md_engine_key]
+    Building an engine is expensive, and apart from its realm filter
+    patterns, an engine doesn't depend on the realm.  So when a realm
+    that isn't in the pool needs an engine, we take over the engine
+    we're evicting (if it has the same email_gateway setting) and just
+    swap in the new realm's filters, rather than building a new one.
+    """
 
-    realm_filters = realm_filter_data[realm_filters_key]
-    md_engines[md_engine_key] = build_engine(
-        realm_filters=realm_filters,
-        realm_filters_key=realm_filters_key,
-        email_gateway=email_gateway,
-    )
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.engines = OrderedDict()  # type: OrderedDict[Tuple[int, bool], Bugdown]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.builds = 0
+
+    def __contains__(self, md_engine_key: Tuple[int, bool]) -> bool:
+        return md_engine_key in self.engines
+
+    def __len__(self) -> int:
+        return len(self.engines)
+
+    def clear(self) -> None:
+        self.engines.clear()
+
+    def get(self, realm_filters_key: int, email_gateway: bool) -> Bugdown:
+        md_engine_key = (realm_filters_key, email_gateway)
+        engine = self.engines.get(md_engine_key)
+        if engine is not None:
+            self.hits += 1
+            self.engines.move_to_end(md_engine_key)
+            return engine
+
+        self.misses += 1
+        realm_filters = realm_filter_data[realm_filters_key]
+        if len(self.engines) >= self.max_size:
+            ((evicted_realm_filters_key, evicted_email_gateway), engine) = \
+                self.engines.popitem(last=False)
+            self.evictions += 1
+            if evicted_email_gateway == email_gateway and \
+                    ZEPHYR_MIRROR_BUGDOWN_KEY not in (realm_filters_key, evicted_realm_filters_key):
+                engine.set_realm_filters(realm_filters_key, realm_filters)
+            else:
+                engine = None
+        if engine is None:
+            self.builds += 1
+            engine = build_engine(
+                realm_filters=realm_filters,
+                realm_filters_key=realm_filters_key,
+                email_gateway=email_gateway,
+            )
+        self.engines[md_engine_key] = engine
+        return engine
+
+    def update_realm_filters(self, realm_filters_key: int) -> None:
+        # Update any engines in the pool for this realm, without
+        # counting it as a use.
+        for email_gateway in [True, False]:
+            engine = self.engines.get((realm_filters_key, email_gateway))
+            if engine is not None:
+                engine.set_realm_filters(realm_filters_key, realm_filter_data[realm_filters_key])
+
+    def stats(self) -> Dict[str, int]:
+        return dict(
+            size=len(self.engines),
+            max_size=self.max_size,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            builds=self.builds,
+        )
+
+md_engines = MarkdownEnginePool(settings.BUGDOWN_ENGINE_POOL_SIZE)
+realm_filter_data = {}  # type: Dict[int, List[Tuple[str, str, int]]]
 
 def build_engine(realm_filters: List[Tuple[str, str, int]],
                  realm_filters_key: int,
-                 email_gateway: bool) -> markdown.Markdown:
+                 email_gateway: bool) -> Bugdown:
     engine = Bugdown(
         realm_filters=realm_filters,
         realm=realm_filters_key,
@@ -2002,14 +2082,19 @@ def maybe_update_markdown_engines(realm_filters_key: Optional[int], email_gatewa
     # If realm_filters_key is None, load all filters
     global realm_filter_data
     if realm_filters_key is None:
+        # Load the filters for all realms, and pre-warm the pool with
+        # the engines that aren't specific to a realm; engines for
+        # realms are added to the pool as they're used.
         all_filters = all_realm_filters()
         all_filters[DEFAULT_BUGDOWN_KEY] = []
         for realm_filters_key, filters in all_filters.items():
-            realm_filter_data[realm_filters_key] = filters
-            make_md_engine(realm_filters_key, email_gateway)
+            if realm_filter_data.get(realm_filters_key) != filters:
+                realm_filter_data[realm_filters_key] = filters
+                md_engines.update_realm_filters(realm_filters_key)
         # Hack to ensure that getConfig("realm") is right for mirrored Zephyrs
         realm_filter_data[ZEPHYR_MIRROR_BUGDOWN_KEY] = []
-        make_md_engine(ZEPHYR_MIRROR_BUGDOWN_KEY, False)
+        md_engines.get(DEFAULT_BUGDOWN_KEY, email_gateway)
+        md_engines.get(ZEPHYR_MIRROR_BUGDOWN_KEY, False)
     else:
         realm_filters = realm_filters_for_realm(realm_filters_key)
         if realm_filters_key not in realm_filter_data or    \
@@ -2017,14 +2102,7 @@ def maybe_update_markdown_engines(realm_filters_key: Optional[int], email_gatewa
             # Realm filters data has changed, update `realm_filter_data` and any
             # of the existing markdown engines using this set of realm filters.
             realm_filter_data[realm_filters_key] = realm_filters
-            for email_gateway_flag in [True, False]:
-                if (realm_filters_key, email_gateway_flag) in md_engines:
-                    # Update only existing engines(if any), don't create new one.
-                    make_md_engine(realm_filters_key, email_gateway_flag)
-
-        if (realm_filters_key, email_gateway) not in md_engines:
-            # Markdown engine corresponding to this key doesn't exists so create one.
-            make_md_engine(realm_filters_key, email_gateway)
+            md_engines.update_realm_filters(realm_filters_key)
 
 # We want to log Markdown parser failures, but shouldn't log the actual input
 # message for privacy reasons.  The compromise is to replace all alphanumeric
@@ -2067,10 +2145,7 @@ def get_email_info(realm_id: int, emails: Set[str]) -> Dict[str, FullNameInfo]:
     }
     return dct
 
-def get_possible_mentions_info(realm_id: int, mention_texts: Set[str]) -> List[FullNameInfo]:
-    if not mention_texts:
-        return list()
-
+def get_mention_full_names(mention_texts: Set[str]) -> Set[str]:
     # Remove the trailing part of the `name|id` mention syntax,
     # thus storing only full names in full_names.
     full_names = set()
@@ -2081,7 +2156,13 @@ def get_possible_mentions_info(realm_id: int, mention_texts: Set[str]) -> List[F
             full_names.add(name_syntax_match.group("full_name"))
         else:
             full_names.add(mention_text)
+    return full_names
 
+def get_possible_mentions_info(realm_id: int, mention_texts: Set[str]) -> List[FullNameInfo]:
+    if not mention_texts:
+        return list()
+
+    full_names = get_mention_full_names(mention_texts)
     q_list = {
         Q(full_name__iexact=full_name)
         for full_name in full_names
@@ -2100,9 +2181,47 @@ def get_possible_mentions_info(realm_id: int, mention_texts: Set[str]) -> List[F
     return list(rows)
 
 class MentionData:
-    def __init__(self, realm_id: int, content: str) -> None:
-        mention_texts = possible_mentions(content)
-        possible_mentions_info = get_possible_mentions_info(realm_id, mention_texts)
+    def __init__(self, realm_id: int, content: str,
+                 batch_mention_data: Optional['MentionData']=None) -> None:
+        """If batch_mention_data is passed, it must be the MentionData
+        for a batch of messages that includes this content (see
+        MentionData.for_batch); we then pick this content's rows out of
+        it, rather than querying the database."""
+        self.init_user_data(realm_id, possible_mentions(content), batch_mention_data)
+        self.init_user_group_data(realm_id, possible_user_group_mentions(content),
+                                  batch_mention_data)
+
+    @classmethod
+    def for_batch(cls, realm_id: int, contents: Iterable[str]) -> 'MentionData':
+        # We parse each message separately, since mention syntax
+        # could match across the boundary between two messages if we
+        # joined them together.
+        mention_texts = set()  # type: Set[str]
+        user_group_names = set()  # type: Set[str]
+        for content in contents:
+            mention_texts |= possible_mentions(content)
+            user_group_names |= possible_user_group_mentions(content)
+
+        mention_data = cls(realm_id, '')
+        mention_data.init_user_data(realm_id, mention_texts)
+        mention_data.init_user_group_data(realm_id, user_group_names)
+        return mention_data
+
+    def init_user_data(self,
+                       realm_id: int,
+                       mention_texts: Set[str],
+                       batch_mention_data: Optional['MentionData']=None) -> None:
+        if batch_mention_data is None:
+            possible_mentions_info = get_possible_mentions_info(realm_id, mention_texts)
+        else:
+            full_names = {
+                full_name.lower()
+                for full_name in get_mention_full_names(mention_texts)
+            }
+            possible_mentions_info = [
+                row for row in batch_mention_data.user_id_info.values()
+                if row['full_name'].lower() in full_names
+            ]
         self.full_name_info = {
             row['full_name'].lower(): row
             for row in possible_mentions_info
@@ -2111,14 +2230,23 @@ class MentionData:
             row['id']: row
             for row in possible_mentions_info
         }
-        self.init_user_group_data(realm_id=realm_id, content=content)
 
     def init_user_group_data(self,
                              realm_id: int,
-                             content: str) -> None:
-        user_group_names = possible_user_group_mentions(content)
-        self.user_group_name_info = get_user_group_name_info(realm_id, user_group_names)
+                             user_group_names: Set[str],
+                             batch_mention_data: Optional['MentionData']=None) -> None:
         self.user_group_members = defaultdict(list)  # type: Dict[int, List[int]]
+        if batch_mention_data is not None:
+            self.user_group_name_info = {
+                key: group
+                for (key, group) in batch_mention_data.user_group_name_info.items()
+                if group.name in user_group_names
+            }
+            for group in self.user_group_name_info.values():
+                self.user_group_members[group.id] = batch_mention_data.get_group_members(group.id)
+            return
+
+        self.user_group_name_info = get_user_group_name_info(realm_id, user_group_names)
         group_ids = [group.id for group in self.user_group_name_info.values()]
 
         if not group_ids:
@@ -2190,6 +2318,123 @@ def get_stream_name_info(realm: Realm, stream_names: Set[str]) -> Dict[str, Full
     return dct
 
 
+class RenderCache:
+    """A bounded, per-process cache of rendered messages, that evicts the
+    least recently used entry when it's full.  It's meant for the large
+    volumes of identical content that integrations (CI status lines,
+    monitoring alerts, etc.) send, and so is only used for content
+    whose rendering doesn't depend on which users or streams exist; see
+    get_render_cache_key.
+
+    Each entry is the rendered content, plus the links found for
+    previews, which rendering would otherwise have recorded on the
+    message.  Its size is settings.BUGDOWN_RENDER_CACHE_SIZE; 0
+    disables it.
+    """
+
+    def __init__(self) -> None:
+        self.entries = OrderedDict()  # type: OrderedDict[Tuple[Any, ...], Tuple[str, Set[str]]]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Tuple[Any, ...]) -> Optional[Tuple[str, Set[str]]]:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def set(self, key: Tuple[Any, ...], rendered_content: str, links_for_preview: Set[str]) -> None:
+        self.entries[key] = (rendered_content, set(links_for_preview))
+        while len(self.entries) > settings.BUGDOWN_RENDER_CACHE_SIZE:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return dict(
+            size=len(self.entries),
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+        )
+
+render_cache = RenderCache()
+
+def content_has_user_dependent_syntax(content: str,
+                                      realm_alert_words_automaton: Optional[ahocorasick.Automaton]) -> bool:
+    # Whether the content might mention users or user groups, link to
+    # streams, show avatars or contain alert words; the rendering (or
+    # its side effects on the message) then depends on data other
+    # than the content and the realm's settings.
+    if re.search(mention.find_mentions, content) is not None:
+        return True
+    if re.search(mention.user_group_mentions, content) is not None:
+        return True
+    if possible_avatar_emails(content) or possible_linked_stream_names(content):
+        return True
+    if realm_alert_words_automaton is not None:
+        for match in realm_alert_words_automaton.iter(content.lower()):
+            return True
+    return False
+
+def get_render_cache_key(content: str,
+                         md_engine: markdown.Markdown,
+                         realm_filters_key: int,
+                         email_gateway: Optional[bool]) -> Optional[Tuple[Any, ...]]:
+    db_data = md_engine.zulip_db_data
+    if content_has_user_dependent_syntax(content, db_data['realm_alert_words_automaton']):
+        return None
+
+    def digest(data: Any) -> str:
+        return hashlib.sha1(ujson.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+    return (
+        version,
+        realm_filters_key,
+        db_data['realm_uri'],
+        # The realm's current filters and custom emoji, standing in
+        # for version numbers for them.
+        digest(realm_filter_data[realm_filters_key]),
+        digest(db_data['active_realm_emoji']),
+        bool(email_gateway),
+        bool(db_data['sent_by_bot']),
+        bool(db_data['translate_emoticons']),
+        md_engine.image_preview_enabled,
+        md_engine.url_embed_preview_enabled,
+        hashlib.sha1(content.encode('utf-8')).hexdigest(),
+    )
+
+class BatchData:
+    """The data from the database that rendering messages from a realm
+    needs, fetched once for a whole batch of messages (see
+    convert_many), rather than once per message.  Like the per-message
+    fetches in do_convert, each fetch is skipped if none of the
+    messages has the relevant syntax."""
+
+    def __init__(self, realm: Realm, contents: Iterable[str]) -> None:
+        contents = list(contents)
+        self.realm_id = realm.id
+        self.mention_data = MentionData.for_batch(realm.id, contents)
+
+        emails = set()  # type: Set[str]
+        stream_names = set()  # type: Set[str]
+        for content in contents:
+            emails |= possible_avatar_emails(content)
+            stream_names |= possible_linked_stream_names(content)
+        self.email_info = get_email_info(realm.id, emails)
+        self.stream_name_info = get_stream_name_info(realm, stream_names)
+
+        if any(content_has_emoji_syntax(content) for content in contents):
+            self.active_realm_emoji = realm.get_active_emoji()
+        else:
+            self.active_realm_emoji = dict()
+
 def do_convert(content: str,
                realm_alert_words_automaton: Optional[ahocorasick.Automaton] = None,
                message: Optional[Message]=None,
@@ -2198,7 +2443,8 @@ def do_convert(content: str,
                translate_emoticons: Optional[bool]=False,
                mention_data: Optional[MentionData]=None,
                email_gateway: Optional[bool]=False,
-               no_previews: Optional[bool]=False) -> str:
+               no_previews: Optional[bool]=False,
+               batch_data: Optional[BatchData]=None) -> str:
     """Convert Markdown to HTML, with Zulip-specific settings and hacks."""
     # This logic is a bit convoluted, but the overall goal is to support a range of use cases:
     # * Nothing is passed in other than content -> just run default options (e.g. for docs)
@@ -2225,15 +2471,7 @@ def do_convert(content: str,
                 realm_filters_key = ZEPHYR_MIRROR_BUGDOWN_KEY
 
     maybe_update_markdown_engines(realm_filters_key, email_gateway)
-    md_engine_key = (realm_filters_key, email_gateway)
-
-    if md_engine_key in md_engines:
-        _md_engine = md_engines[md_engine_key]
-    else:
-        if DEFAULT_BUGDOWN_KEY not in md_engines:
-            maybe_update_markdown_engines(realm_filters_key=None, email_gateway=False)
-
-        _md_engine = md_engines[(DEFAULT_BUGDOWN_KEY, email_gateway)]
+    _md_engine = md_engines.get(realm_filters_key, email_gateway)
     # Reset the parser; otherwise it will get slower over time.
     _md_engine.reset()
 
@@ -2256,19 +2494,28 @@ def do_convert(content: str,
         # the fetches are somewhat expensive and these types of syntax
         # are uncommon enough that it's a useful optimization.
 
-        if mention_data is None:
-            mention_data = MentionData(message_realm.id, content)
+        if batch_data is not None:
+            assert batch_data.realm_id == message_realm.id
+            if mention_data is None:
+                mention_data = MentionData(message_realm.id, content,
+                                           batch_mention_data=batch_data.mention_data)
+            email_info = batch_data.email_info
+            stream_name_info = batch_data.stream_name_info
+            active_realm_emoji = batch_data.active_realm_emoji
+        else:
+            if mention_data is None:
+                mention_data = MentionData(message_realm.id, content)
 
-        emails = possible_avatar_emails(content)
-        email_info = get_email_info(message_realm.id, emails)
+            emails = possible_avatar_emails(content)
+            email_info = get_email_info(message_realm.id, emails)
 
-        stream_names = possible_linked_stream_names(content)
-        stream_name_info = get_stream_name_info(message_realm, stream_names)
+            stream_names = possible_linked_stream_names(content)
+            stream_name_info = get_stream_name_info(message_realm, stream_names)
 
-        if content_has_emoji_syntax(content):
-            active_realm_emoji = message_realm.get_active_emoji()
-        else:
-            active_realm_emoji = dict()
+            if content_has_emoji_syntax(content):
+                active_realm_emoji = message_realm.get_active_emoji()
+            else:
+                active_realm_emoji = dict()
 
         _md_engine.zulip_db_data = {
             'realm_alert_words_automaton': realm_alert_words_automaton,
@@ -2282,12 +2529,23 @@ def do_convert(content: str,
         }
 
     try:
+        render_cache_key = None
+        if message is not None and settings.BUGDOWN_RENDER_CACHE_SIZE > 0:
+            render_cache_key = get_render_cache_key(content, _md_engine,
+                                                    realm_filters_key, email_gateway)
+            if render_cache_key is not None:
+                cached = render_cache.get(render_cache_key)
+                if cached is not None:
+                    (rendered_content, links_for_preview) = cached
+                    message.links_for_preview |= links_for_preview
+                    return rendered_content
+
         # Spend at most 5 seconds rendering; this protects the backend
         # from being overloaded by bugs (e.g. markdown logic that is
         # extremely inefficient in corner cases) as well as user
         # errors (e.g. a realm filter that makes some syntax
         # infinite-loop).
-        rendered_content = timeout(5, _md_engine.convert, content)
+        rendered_content = deadline_call(5, _md_engine.convert, content)
 
         # Throw an exception if the content is huge; this protects the
         # rest of the codebase from any bugs where we end up rendering
@@ -2295,6 +2553,8 @@ def do_convert(content: str,
         if len(rendered_content) > MAX_MESSAGE_LENGTH * 10:
             raise BugdownRenderingException('Rendered content exceeds %s characters (message %s)' %
                                             (MAX_MESSAGE_LENGTH * 10, logging_message_id))
+        if render_cache_key is not None:
+            render_cache.set(render_cache_key, rendered_content, message.links_for_preview)
         return rendered_content
     except Exception:
         cleaned = privacy_clean_markdown(content)
@@ -2343,11 +2603,38 @@ def convert(content: str,
             translate_emoticons: Optional[bool]=False,
             mention_data: Optional[MentionData]=None,
             email_gateway: Optional[bool]=False,
-            no_previews: Optional[bool]=False) -> str:
+            no_previews: Optional[bool]=False,
+            batch_data: Optional[BatchData]=None) -> str:
     bugdown_stats_start()
     ret = do_convert(content, realm_alert_words_automaton,
                      message, message_realm, sent_by_bot,
                      translate_emoticons, mention_data, email_gateway,
-                     no_previews=no_previews)
+                     no_previews=no_previews, batch_data=batch_data)
     bugdown_stats_finish()
     return ret
+
+def convert_many(contents: Sequence[str],
+                 message_realm: Realm,
+                 messages: Sequence[Message],
+                 sent_by_bot: Sequence[bool],
+                 translate_emoticons: Sequence[bool],
+                 realm_alert_words_automaton: Optional[ahocorasick.Automaton]=None,
+                 email_gateway: Optional[bool]=False) -> List[str]:
+    """Convert a batch of messages from the same realm, fetching the data
+    needed to render mentions, avatars, stream links and custom emoji
+    once for the whole batch.  The other arguments are per message, as
+    in convert()."""
+    assert len(contents) == len(messages) == len(sent_by_bot) == len(translate_emoticons)
+    batch_data = BatchData(message_realm, contents)
+    return [
+        convert(content,
+                realm_alert_words_automaton=realm_alert_words_automaton,
+                message=message,
+                message_realm=message_realm,
+                sent_by_bot=message_sent_by_bot,
+                translate_emoticons=message_translate_emoticons,
+                email_gateway=email_gateway,
+                batch_data=batch_data)
+        for (content, message, message_sent_by_bot, message_translate_emoticons)
+        in zip(contents, messages, sent_by_bot, translate_emoticons)
+    ]
@@ -1,4 +1,5 @@
 # See https://zulip.readthedocs.io/en/latest/subsystems/caching.html for docs
+from collections import OrderedDict
 from functools import wraps
 
 from django.utils.lru_cache import lru_cache
@@ -14,10 +15,12 @@ from typing import Any, Callable, Dict, Iterable, List, Optional, TypeVar, Tuple
 from zerver.lib.utils import statsd, statsd_key, make_safe_digest
 import time
 import base64
+import pickle
 import random
 import sys
 import os
 import hashlib
+import threading
 
 if False:
     # These modules have to be imported for type annotations but
@@ -40,6 +43,9 @@ def get_remote_cache_time() -> float:
 def get_remote_cache_requests() -> int:
     return remote_cache_total_requests
 
+def get_local_cache_hits() -> int:
+    return local_cache.hits
+
 def remote_cache_stats_start() -> None:
     global remote_cache_time_start
     remote_cache_time_start = time.time()
@@ -107,6 +113,151 @@ def get_cache_backend(cache_name: Optional[str]) -> BaseCache:
         return djcache
     return caches[cache_name]
 
+# The keys (of the default cache) that we also keep in each process's
+# LocalCache: realm-wide values that are fetched from the remote cache
+# many times per request, and rarely change.  Each change to one of
+# these makes every process check which keys to drop, so per-user or
+# per-stream values, which change all the time (e.g. a UserProfile on
+# every pointer update), don't belong here.
+LOCAL_CACHE_KEY_PREFIXES = (
+    'realm_emoji:',
+    'active_realm_emoji:',
+    'get_client:',
+    'all_realm_filters:',
+)
+
+LOCAL_CACHE_GENERATION_KEY = 'local_cache_generation'
+# The keys flushed by the bump of LOCAL_CACHE_GENERATION_KEY to a given
+# generation are stored under this prefix plus that generation.
+LOCAL_CACHE_FLUSHED_KEYS_PREFIX = 'local_cache_flushed_keys:'
+# A process that is more generations behind than this drops its whole
+# local cache, rather than fetching the keys flushed in each.
+LOCAL_CACHE_MAX_GENERATIONS_BEHIND = 100
+
+def is_local_cache_key(key: str, cache_name: Optional[str]) -> bool:
+    return cache_name is None and key.startswith(LOCAL_CACHE_KEY_PREFIXES)
+
+class LocalCache:
+    '''
+    A bounded in-process LRU cache, in front of the remote cache for
+    the keys in LOCAL_CACHE_KEY_PREFIXES; its size and the lifetime
+    of its entries are set by settings.LOCAL_CACHE_SIZE and
+    settings.LOCAL_CACHE_TIMEOUT.
+
+    Writes to those keys in the remote cache (which is how we flush
+    them when the underlying objects change) update this process's
+    copy, and bump a generation number in the remote cache, recording
+    which keys were flushed by that generation.  Every process checks
+    the generation number at the start of each request, and queue
+    workers before each event (see check_generation), and drops the
+    keys flushed since its last check, so the values are as fresh as
+    the remote cache's.  If that record is incomplete, because the
+    process is far behind or some of it has been evicted, it drops
+    everything.
+
+    Values are stored pickled, as in the remote cache, so that callers
+    can't modify each other's copies.  The entries are shared by the
+    process's threads, so they're only accessed under a lock.
+    '''
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # type: OrderedDict[str, Tuple[float, bytes]]
+        self.key_prefix = KEY_PREFIX
+        self.generation = None  # type: Optional[int]
+        self.hits = 0
+        self.misses = 0
+
+    def enabled(self) -> bool:
+        if self.key_prefix != KEY_PREFIX:
+            # The tests bounce KEY_PREFIX to start with an empty cache.
+            with self.lock:
+                self.entries.clear()
+            self.key_prefix = KEY_PREFIX
+        return settings.LOCAL_CACHE_SIZE > 0
+
+    def get(self, key: str) -> Any:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.time():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return pickle.loads(entry[1])
+
+    def set(self, key: str, val: Any) -> None:
+        entry = (time.time() + settings.LOCAL_CACHE_TIMEOUT,
+                 pickle.dumps(val, pickle.HIGHEST_PROTOCOL))
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > settings.LOCAL_CACHE_SIZE:
+                self.entries.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def bump_generation(self, keys: List[str]) -> None:
+        key = KEY_PREFIX + LOCAL_CACHE_GENERATION_KEY
+        remote_cache_stats_start()
+        try:
+            generation = djcache.incr(key)
+        except ValueError:
+            djcache.add(key, 0, timeout=None)
+            generation = djcache.incr(key)
+        # Local entries don't outlive LOCAL_CACHE_TIMEOUT, and neither
+        # need the records of which to drop.
+        djcache.set(KEY_PREFIX + LOCAL_CACHE_FLUSHED_KEYS_PREFIX + str(generation),
+                    keys, timeout=settings.LOCAL_CACHE_TIMEOUT)
+        remote_cache_stats_finish()
+        if self.generation is not None and generation == self.generation + 1:
+            # Nobody else has bumped it since we last checked, and our
+            # own copies are already up to date.
+            self.generation = generation
+
+    def check_generation(self) -> None:
+        remote_cache_stats_start()
+        generation = djcache.get(KEY_PREFIX + LOCAL_CACHE_GENERATION_KEY)
+        if generation is None:
+            djcache.add(KEY_PREFIX + LOCAL_CACHE_GENERATION_KEY, 0, timeout=None)
+            generation = 0
+        remote_cache_stats_finish()
+        if generation == self.generation:
+            return
+
+        flushed = None  # type: Optional[Dict[str, List[str]]]
+        if (self.generation is not None and
+                0 < generation - self.generation <= LOCAL_CACHE_MAX_GENERATIONS_BEHIND):
+            record_keys = [KEY_PREFIX + LOCAL_CACHE_FLUSHED_KEYS_PREFIX + str(g)
+                           for g in range(self.generation + 1, generation + 1)]
+            remote_cache_stats_start()
+            flushed = djcache.get_many(record_keys)
+            remote_cache_stats_finish()
+            if len(flushed) < len(record_keys):
+                # Some records have expired or been evicted, or their
+                # bump_generation is still in progress.
+                flushed = None
+
+        with self.lock:
+            if flushed is None:
+                self.entries.clear()
+            else:
+                for keys in flushed.values():
+                    for key in keys:
+                        self.entries.pop(key, None)
+        self.generation = generation
+
+    def stats(self) -> Dict[str, int]:
+        return dict(size=len(self.entries), hits=self.hits, misses=self.misses)
+
+local_cache = LocalCache()
+
+def check_local_cache_generation() -> None:
+    if local_cache.enabled():
+        local_cache.check_generation()
+
 def get_cache_with_key(
         keyfunc: Callable[..., str],
         cache_name: Optional[str]=None
@@ -166,7 +317,7 @@ def cache_with_key(
 
             val = func(*args, **kwargs)
 
-            cache_set(key, val, cache_name=cache_name, timeout=timeout)
+            cache_set(key, val, cache_name=cache_name, timeout=timeout, flush_local=False)
 
             return val
 
@@ -174,47 +325,109 @@ def cache_with_key(
 
     return decorator
 
-def cache_set(key: str, val: Any, cache_name: Optional[str]=None, timeout: Optional[int]=None) -> None:
+# For the cache_set* functions, flush_local=False means the write just
+# fills the cache with the current value, rather than changing it, so
+# other processes' local caches needn't be flushed.
+def cache_set(key: str, val: Any, cache_name: Optional[str]=None, timeout: Optional[int]=None,
+              flush_local: bool=True) -> None:
     remote_cache_stats_start()
     cache_backend = get_cache_backend(cache_name)
     cache_backend.set(KEY_PREFIX + key, (val,), timeout=timeout)
     remote_cache_stats_finish()
 
+    if is_local_cache_key(key, cache_name) and local_cache.enabled():
+        local_cache.set(key, (val,))
+        if flush_local:
+            local_cache.bump_generation([key])
+
 def cache_get(key: str, cache_name: Optional[str]=None) -> Any:
+    use_local_cache = is_local_cache_key(key, cache_name) and local_cache.enabled()
+    if use_local_cache:
+        ret = local_cache.get(key)
+        if ret is not None:
+            return ret
+
     remote_cache_stats_start()
     cache_backend = get_cache_backend(cache_name)
     ret = cache_backend.get(KEY_PREFIX + key)
     remote_cache_stats_finish()
+
+    if use_local_cache and ret is not None:
+        local_cache.set(key, ret)
     return ret
 
 def cache_get_many(keys: List[str], cache_name: Optional[str]=None) -> Dict[str, Any]:
-    keys = [KEY_PREFIX + key for key in keys]
+    ret = {}  # type: Dict[str, Any]
+    if local_cache.enabled():
+        for key in keys:
+            if is_local_cache_key(key, cache_name):
+                val = local_cache.get(key)
+                if val is not None:
+                    ret[key] = val
+        if ret:
+            keys = [key for key in keys if key not in ret]
+            if not keys:
+                return ret
+
+    remote_keys = [KEY_PREFIX + key for key in keys]
     remote_cache_stats_start()
-    ret = get_cache_backend(cache_name).get_many(keys)
+    remote_ret = get_cache_backend(cache_name).get_many(remote_keys)
     remote_cache_stats_finish()
-    return dict([(key[len(KEY_PREFIX):], value) for key, value in ret.items()])
+    for (remote_key, val) in remote_ret.items():
+        key = remote_key[len(KEY_PREFIX):]
+        ret[key] = val
+        if is_local_cache_key(key, cache_name) and local_cache.enabled():
+            local_cache.set(key, val)
+    return ret
 
 def cache_set_many(items: Dict[str, Any], cache_name: Optional[str]=None,
-                   timeout: Optional[int]=None) -> None:
+                   timeout: Optional[int]=None, flush_local: bool=True) -> None:
     new_items = {}
     for key in items:
         new_items[KEY_PREFIX + key] = items[key]
-    items = new_items
     remote_cache_stats_start()
-    get_cache_backend(cache_name).set_many(items, timeout=timeout)
+    get_cache_backend(cache_name).set_many(new_items, timeout=timeout)
+    remote_cache_stats_finish()
+
+    local_keys = [key for key in items if is_local_cache_key(key, cache_name)]
+    if local_keys and local_cache.enabled():
+        for key in local_keys:
+            local_cache.set(key, items[key])
+        if flush_local:
+            local_cache.bump_generation(local_keys)
+
+def cache_add(key: str, val: Any, cache_name: Optional[str]=None,
+              timeout: Optional[int]=None) -> bool:
+    """Like cache_set, but only sets the key if it isn't already set,
+    returning whether it did.  Not supported for locally cached keys."""
+    assert not is_local_cache_key(key, cache_name)
+    remote_cache_stats_start()
+    ret = get_cache_backend(cache_name).add(KEY_PREFIX + key, (val,), timeout=timeout)
     remote_cache_stats_finish()
+    return ret
 
 def cache_delete(key: str, cache_name: Optional[str]=None) -> None:
     remote_cache_stats_start()
     get_cache_backend(cache_name).delete(KEY_PREFIX + key)
     remote_cache_stats_finish()
 
+    if is_local_cache_key(key, cache_name) and local_cache.enabled():
+        local_cache.delete(key)
+        local_cache.bump_generation([key])
+
 def cache_delete_many(items: Iterable[str], cache_name: Optional[str]=None) -> None:
+    items = list(items)
     remote_cache_stats_start()
     get_cache_backend(cache_name).delete_many(
         KEY_PREFIX + item for item in items)
     remote_cache_stats_finish()
 
+    local_keys = [key for key in items if is_local_cache_key(key, cache_name)]
+    if local_keys and local_cache.enabled():
+        for key in local_keys:
+            local_cache.delete(key)
+        local_cache.bump_generation(local_keys)
+
 # Generic_bulk_cached fetch and its helpers
 ObjKT = TypeVar('ObjKT')
 ItemT = TypeVar('ItemT')
@@ -274,7 +487,7 @@ def generic_bulk_cached_fetch(
         items_for_remote_cache[key] = (setter(item),)
         cached_objects[key] = item
     if len(items_for_remote_cache) > 0:
-        cache_set_many(items_for_remote_cache)
+        cache_set_many(items_for_remote_cache, flush_local=False)
     return dict((object_id, cached_objects[cache_keys[object_id]]) for object_id in object_ids
                 if cache_keys[object_id] in cached_objects)
 
@@ -300,6 +513,15 @@ def preview_url_cache_key(url: str) -> str:
 def display_recipient_cache_key(recipient_id: int) -> str:
     return "display_recipient_dict:%d" % (recipient_id,)
 
+def stream_recipient_info_cache_key(recipient_id: int) -> str:
+    return "stream_recipient_info:%d" % (recipient_id,)
+
+def unread_message_info_cache_key(user_profile_id: int) -> str:
+    return "unread_message_info:%d" % (user_profile_id,)
+
+def unread_message_info_version_cache_key(user_profile_id: int) -> str:
+    return "unread_message_info_version:%d" % (user_profile_id,)
+
 def user_profile_by_email_cache_key(email: str) -> str:
     # See the comment in zerver/lib/avatar_hash.py:gravatar_hash for why we
     # are proactively encoding email addresses even though they will
@@ -368,11 +590,22 @@ def delete_user_profile_caches(user_profiles: Iterable['UserProfile']) -> None:
 
     cache_delete_many(keys)
 
-def delete_display_recipient_cache(user_profile: 'UserProfile') -> None:
+def delete_display_recipient_cache(user_profile: 'UserProfile',
+                                   stream_recipient_info: bool=False) -> None:
     from zerver.models import Subscription  # We need to import here to avoid cyclic dependency.
     recipient_ids = Subscription.objects.filter(user_profile=user_profile)
     recipient_ids = recipient_ids.values_list('recipient_id', flat=True)
     keys = [display_recipient_cache_key(rid) for rid in recipient_ids]
+    if stream_recipient_info:
+        # Saves a query when we need to flush both.
+        keys += [stream_recipient_info_cache_key(rid) for rid in recipient_ids]
+    cache_delete_many(keys)
+
+def delete_stream_recipient_info_cache(user_profile: 'UserProfile') -> None:
+    from zerver.models import Subscription  # We need to import here to avoid cyclic dependency.
+    recipient_ids = Subscription.objects.filter(user_profile=user_profile, active=True)
+    recipient_ids = recipient_ids.values_list('recipient_id', flat=True)
+    keys = [stream_recipient_info_cache_key(rid) for rid in recipient_ids]
     cache_delete_many(keys)
 
 def changed(kwargs: Any, fields: List[str]) -> bool:
@@ -405,8 +638,14 @@ def flush_user_profile(sender: Any, **kwargs: Any) -> None:
     if changed(kwargs, ['is_guest']):
         cache_delete(active_non_guest_user_ids_cache_key(user_profile.realm_id))
 
+    # A new user doesn't have any subscriptions yet.
+    flush_stream_recipient_info = not kwargs.get('created') and changed(
+        kwargs, ['enable_stream_email_notifications', 'enable_stream_push_notifications'])
     if changed(kwargs, ['email', 'full_name', 'short_name', 'id', 'is_mirror_dummy']):
-        delete_display_recipient_cache(user_profile)
+        delete_display_recipient_cache(user_profile,
+                                       stream_recipient_info=flush_stream_recipient_info)
+    elif flush_stream_recipient_info:
+        delete_stream_recipient_info_cache(user_profile)
 
     # Invalidate our bots_in_realm info dict if any bot has
     # changed the fields in the dict or become (in)active
@@ -469,6 +708,14 @@ def flush_stream(sender: Any, **kwargs: Any) -> None:
            Q(default_events_register_stream=stream)).exists():
         cache_delete(bot_dicts_in_realm_cache_key(stream.realm))
 
+# Called by models.py to flush the stream recipient info (see
+# get_stream_recipient_info) whenever we save a subscription.  Bulk
+# updates to subscriptions need to flush it explicitly.
+def flush_subscription(sender: Any, **kwargs: Any) -> None:
+    subscription = kwargs['instance']
+    if changed(kwargs, ['active', 'is_muted', 'push_notifications', 'email_notifications']):
+        cache_delete(stream_recipient_info_cache_key(subscription.recipient_id))
+
 def flush_used_upload_space_cache(sender: Any, **kwargs: Any) -> None:
     attachment = kwargs['instance']
 
@@ -476,6 +723,9 @@ def flush_used_upload_space_cache(sender: Any, **kwargs: Any) -> None:
         cache_delete(get_realm_used_upload_space_cache_key(attachment.owner.realm))
 
 def to_dict_cache_key_id(message_id: int) -> str:
+    if settings.MESSAGE_CACHE_FORMAT == 'compact':
+        # Bump the version here after changing COMPACT_MESSAGE_DICT_KEYS.
+        return 'message_dict_compact1:%d' % (message_id,)
     return 'message_dict:%d' % (message_id,)
 
 def to_dict_cache_key(message: 'Message') -> str:
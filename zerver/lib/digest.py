@@ -1,19 +1,22 @@
-from typing import Any, Dict, List, Set, Tuple, Union
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union
 
 from collections import defaultdict
 import datetime
+import itertools
 import logging
 import pytz
 
 from django.conf import settings
+from django.db.models import Max, Q
 from django.utils.timezone import now as timezone_now
 
 from confirmation.models import one_click_unsubscribe_link
+from zerver.lib.cache import generic_bulk_cached_fetch, user_profile_by_id_cache_key
 from zerver.lib.email_notifications import build_message_list
 from zerver.lib.send_email import send_future_email, FromAddress
 from zerver.lib.url_encoding import encode_stream
-from zerver.models import UserProfile, Recipient, Subscription, UserActivity, \
-    get_active_streams, get_user_profile_by_id, Realm, Message, RealmAuditLog
+from zerver.models import UserProfile, Recipient, Subscription, Stream, \
+    get_active_streams, Realm, Message, RealmAuditLog
 from zerver.context_processors import common_context
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.logging_util import log_to_file
@@ -23,23 +26,26 @@ log_to_file(logger, settings.DIGEST_LOG_PATH)
 
 DIGEST_CUTOFF = 5
 
+# The number of users whose digests are handled together, by one event
+# on the digest_emails queue; the users' subscriptions, messages and
+# the realm's new streams are fetched once for the whole batch.
+DIGEST_BATCH_SIZE = 100
+
 # Digests accumulate 2 types of interesting traffic for a user:
 # 1. New streams
 # 2. Interesting stream traffic, as determined by the longest and most
 #    diversely comment upon topics.
 
-def inactive_since(user_profile: UserProfile, cutoff: datetime.datetime) -> bool:
-    # Hasn't used the app in the last DIGEST_CUTOFF (5) days.
-    most_recent_visit = [row.last_visit for row in
-                         UserActivity.objects.filter(
-                             user_profile=user_profile)]
-
-    if not most_recent_visit:
-        # This person has never used the app.
-        return True
-
-    last_visit = max(most_recent_visit)
-    return last_visit < cutoff
+def inactive_user_ids(realm: Realm, cutoff: datetime.datetime) -> List[int]:
+    # Users who want digests and haven't used the app in the last
+    # DIGEST_CUTOFF (5) days, or have never used it.
+    return list(UserProfile.objects.filter(
+        realm=realm, is_active=True, is_bot=False, enable_digest_emails=True,
+    ).annotate(
+        last_visit=Max('useractivity__last_visit'),
+    ).filter(
+        Q(last_visit__lt=cutoff) | Q(last_visit__isnull=True),
+    ).order_by('id').values_list('id', flat=True))
 
 def should_process_digest(realm_str: str) -> bool:
     if realm_str in settings.SYSTEM_ONLY_REALMS:
@@ -49,9 +55,9 @@ def should_process_digest(realm_str: str) -> bool:
 
 # Changes to this should also be reflected in
 # zerver/worker/queue_processors.py:DigestWorker.consume()
-def queue_digest_recipient(user_profile: UserProfile, cutoff: datetime.datetime) -> None:
+def queue_digest_recipients(user_profile_ids: List[int], cutoff: datetime.datetime) -> None:
     # Convert cutoff to epoch seconds for transit.
-    event = {"user_profile_id": user_profile.id,
+    event = {"user_profile_ids": user_profile_ids,
              "cutoff": cutoff.strftime('%s')}
     queue_json_publish("digest_emails", event)
 
@@ -64,14 +70,11 @@ def enqueue_emails(cutoff: datetime.datetime) -> None:
         if not should_process_digest(realm.string_id):
             continue
 
-        user_profiles = UserProfile.objects.filter(
-            realm=realm, is_active=True, is_bot=False, enable_digest_emails=True)
-
-        for user_profile in user_profiles:
-            if inactive_since(user_profile, cutoff):
-                queue_digest_recipient(user_profile, cutoff)
-                logger.info("%s is inactive, queuing for potential digest" % (
-                    user_profile.email,))
+        user_ids = inactive_user_ids(realm, cutoff)
+        for i in range(0, len(user_ids), DIGEST_BATCH_SIZE):
+            queue_digest_recipients(user_ids[i:i + DIGEST_BATCH_SIZE], cutoff)
+        logger.info("%d users in %s are inactive, queuing for potential digests" % (
+            len(user_ids), realm.string_id))
 
 def gather_hot_conversations(user_profile: UserProfile, messages: List[Message]) -> List[Dict[str, Any]]:
     # Gather stream conversations of 2 types:
@@ -137,11 +140,17 @@ def gather_hot_conversations(user_profile: UserProfile, messages: List[Message])
         hot_conversation_render_payloads.append(teaser_data)
     return hot_conversation_render_payloads
 
-def gather_new_streams(user_profile: UserProfile,
-                       threshold: datetime.datetime) -> Tuple[int, Dict[str, List[str]]]:
+def get_new_public_streams(realm: Realm, threshold: datetime.datetime) -> List[Stream]:
+    return list(get_active_streams(realm).filter(
+        invite_only=False, date_created__gt=threshold))
+
+def gather_new_streams(user_profile: UserProfile, threshold: datetime.datetime,
+                       realm_new_streams: Optional[List[Stream]]=None
+                       ) -> Tuple[int, Dict[str, List[str]]]:
     if user_profile.can_access_public_streams():
-        new_streams = list(get_active_streams(user_profile.realm).filter(
-            invite_only=False, date_created__gt=threshold))
+        if realm_new_streams is None:
+            realm_new_streams = get_new_public_streams(user_profile.realm, threshold)
+        new_streams = realm_new_streams
     else:
         new_streams = []
 
@@ -163,60 +172,119 @@ def enough_traffic(hot_conversations: str, new_streams: int) -> bool:
 
 def handle_digest_email(user_profile_id: int, cutoff: float,
                         render_to_web: bool = False) -> Union[None, Dict[str, Any]]:
-    user_profile = get_user_profile_by_id(user_profile_id)
+    if render_to_web:
+        # Convert from epoch seconds to a datetime object.
+        cutoff_date = datetime.datetime.fromtimestamp(int(cutoff), tz=pytz.utc)
+        [(user_profile, context)] = build_digest_contexts([user_profile_id], cutoff_date)
+        return context
 
+    handle_digest_emails([user_profile_id], cutoff)
+    return None
+
+def handle_digest_emails(user_profile_ids: List[int], cutoff: float) -> None:
     # Convert from epoch seconds to a datetime object.
     cutoff_date = datetime.datetime.fromtimestamp(int(cutoff), tz=pytz.utc)
 
-    context = common_context(user_profile)
-
-    # Start building email template data.
-    context.update({
-        'unsubscribe_link': one_click_unsubscribe_link(user_profile, "digest")
-    })
-
+    for user_profile, context in build_digest_contexts(user_profile_ids, cutoff_date):
+        # We don't want to send emails containing almost no information.
+        if not enough_traffic(context["hot_conversations"], context["new_streams_count"]):
+            continue
+        logger.info("Sending digest email for %s" % (user_profile.email,))
+        try:
+            # Send now, as a ScheduledEmail
+            send_future_email('zerver/emails/digest', user_profile.realm, to_user_ids=[user_profile.id],
+                              from_name="Zulip Digest", from_address=FromAddress.NOREPLY,
+                              context=context)
+        except Exception:
+            # Don't let one user's failure fail the batch: the queue
+            # would retry it, re-sending the digests that went out
+            # before the failure.
+            logger.exception("Failed to send digest email for %s" % (user_profile.email,))
+
+def build_digest_contexts(user_profile_ids: List[int], cutoff_date: datetime.datetime
+                          ) -> List[Tuple[UserProfile, Dict[str, Any]]]:
+    def fetch_users_by_id(user_ids: List[int]) -> List[UserProfile]:
+        return list(UserProfile.objects.filter(id__in=user_ids).select_related())
+
+    user_profiles = sorted(generic_bulk_cached_fetch(
+        cache_key_function=user_profile_by_id_cache_key,
+        query_function=fetch_users_by_id,
+        object_ids=user_profile_ids,
+    ).values(), key=lambda user_profile: user_profile.id)  # type: List[UserProfile]
+
+    # The streams each user will see traffic from: their unmuted
+    # subscriptions, except (for long-term idle users, whose
+    # UserMessage rows may be incomplete) those modified since the
+    # cutoff.
+    stream_ids_by_user = defaultdict(set)  # type: Dict[int, Set[int]]
     home_view_streams = Subscription.objects.filter(
-        user_profile=user_profile,
+        user_profile_id__in=user_profile_ids,
         recipient__type=Recipient.STREAM,
         active=True,
-        is_muted=False).values_list('recipient__type_id', flat=True)
-
-    if not user_profile.long_term_idle:
-        stream_ids = home_view_streams
-    else:
-        stream_ids = exclude_subscription_modified_streams(user_profile, home_view_streams, cutoff_date)
-
-    # Fetch list of all messages sent after cutoff_date where the user is subscribed
-    messages = Message.objects.filter(
-        recipient__type=Recipient.STREAM,
-        recipient__type_id__in=stream_ids,
-        pub_date__gt=cutoff_date).select_related('recipient', 'sender', 'sending_client')
-
-    # Gather hot conversations.
-    context["hot_conversations"] = gather_hot_conversations(
-        user_profile, messages)
-
-    # Gather new streams.
-    new_streams_count, new_streams = gather_new_streams(
-        user_profile, cutoff_date)
-    context["new_streams"] = new_streams
-    context["new_streams_count"] = new_streams_count
-
-    if render_to_web:
-        return context
-
-    # We don't want to send emails containing almost no information.
-    if enough_traffic(context["hot_conversations"], new_streams_count):
-        logger.info("Sending digest email for %s" % (user_profile.email,))
-        # Send now, as a ScheduledEmail
-        send_future_email('zerver/emails/digest', user_profile.realm, to_user_ids=[user_profile.id],
-                          from_name="Zulip Digest", from_address=FromAddress.NOREPLY, context=context)
-    return None
+        is_muted=False).values_list('user_profile_id', 'recipient__type_id')
+    for user_profile_id, stream_id in home_view_streams:
+        stream_ids_by_user[user_profile_id].add(stream_id)
+
+    long_term_idle_users = [user_profile for user_profile in user_profiles
+                            if user_profile.long_term_idle]
+    if long_term_idle_users:
+        modified_streams = get_subscription_modified_streams(long_term_idle_users, cutoff_date)
+        for user_profile_id, stream_ids in modified_streams.items():
+            stream_ids_by_user[user_profile_id] -= stream_ids
+
+    # Fetch all messages sent after cutoff_date to any of those
+    # streams, once for the whole batch.
+    all_stream_ids = set(itertools.chain.from_iterable(stream_ids_by_user.values()))
+    messages_by_stream = defaultdict(list)  # type: Dict[int, List[Message]]
+    if all_stream_ids:
+        messages = Message.objects.filter(
+            recipient__type=Recipient.STREAM,
+            recipient__type_id__in=all_stream_ids,
+            pub_date__gt=cutoff_date).select_related(
+                'recipient', 'sender', 'sending_client').order_by('id')
+        for message in messages:
+            messages_by_stream[message.recipient.type_id].append(message)
+
+    new_streams_by_realm = {}  # type: Dict[int, List[Stream]]
+    digest_contexts = []  # type: List[Tuple[UserProfile, Dict[str, Any]]]
+    for user_profile in user_profiles:
+        context = common_context(user_profile)
+
+        # Start building email template data.
+        context.update({
+            'unsubscribe_link': one_click_unsubscribe_link(user_profile, "digest")
+        })
+
+        # Gather hot conversations.
+        user_messages = sorted(itertools.chain.from_iterable(
+            messages_by_stream[stream_id] for stream_id in stream_ids_by_user[user_profile.id]),
+            key=lambda message: message.id)
+        context["hot_conversations"] = gather_hot_conversations(
+            user_profile, user_messages)
+
+        # Gather new streams.
+        if user_profile.can_access_public_streams() and \
+                user_profile.realm_id not in new_streams_by_realm:
+            new_streams_by_realm[user_profile.realm_id] = get_new_public_streams(
+                user_profile.realm, cutoff_date)
+        new_streams_count, new_streams = gather_new_streams(
+            user_profile, cutoff_date, new_streams_by_realm.get(user_profile.realm_id))
+        context["new_streams"] = new_streams
+        context["new_streams_count"] = new_streams_count
+
+        digest_contexts.append((user_profile, context))
+    return digest_contexts
 
 def exclude_subscription_modified_streams(user_profile: UserProfile,
                                           stream_ids: List[int],
                                           cutoff_date: datetime.datetime) -> List[int]:
     """Exclude streams from given list where users' subscription was modified."""
+    modified_streams = get_subscription_modified_streams([user_profile], cutoff_date)
+    return list(set(stream_ids) - modified_streams[user_profile.id])
+
+def get_subscription_modified_streams(user_profiles: Iterable[UserProfile],
+                                      cutoff_date: datetime.datetime) -> Dict[int, Set[int]]:
+    """The streams where each user's subscription was modified since cutoff_date."""
 
     events = [
         RealmAuditLog.SUBSCRIPTION_CREATED,
@@ -225,10 +293,11 @@ def exclude_subscription_modified_streams(user_profile: UserProfile,
     ]
 
     # Streams where the user's subscription was changed
-    modified_streams = RealmAuditLog.objects.filter(
-        realm=user_profile.realm,
-        modified_user=user_profile,
+    modified_streams = defaultdict(set)  # type: Dict[int, Set[int]]
+    rows = RealmAuditLog.objects.filter(
+        modified_user__in=user_profiles,
         event_time__gt=cutoff_date,
-        event_type__in=events).values_list('modified_stream_id', flat=True)
-
-    return list(set(stream_ids) - set(modified_streams))
+        event_type__in=events).values_list('modified_user_id', 'modified_stream_id')
+    for user_profile_id, stream_id in rows:
+        modified_streams[user_profile_id].add(stream_id)
+    return modified_streams
@@ -4,11 +4,13 @@
 import copy
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from django.db import close_old_connections
 from django.utils.translation import ugettext as _
 from django.conf import settings
 from importlib import import_module
 from typing import (
-    Any, Callable, Dict, Iterable, Optional, Sequence, Set
+    Any, Callable, Dict, Iterable, List, Optional, Sequence, Set
 )
 
 session_engine = import_module(settings.SESSION_ENGINE)
@@ -27,7 +29,9 @@ from zerver.lib.message import (
     get_starred_message_ids,
 )
 from zerver.lib.narrow import check_supported_events_narrow_filter, read_stop_words
+from zerver.lib.profile import SectionTimer
 from zerver.lib.push_notifications import push_notifications_enabled
+from zerver.lib.queue import queue_json_publish
 from zerver.lib.soft_deactivation import reactivate_user_if_soft_deactivated
 from zerver.lib.realm_icon import realm_icon_url
 from zerver.lib.realm_logo import realm_logo_url
@@ -45,7 +49,7 @@ from zerver.lib.actions import (
 )
 from zerver.lib.user_groups import user_groups_in_realm_serialized
 from zerver.lib.user_status import get_user_info_dict
-from zerver.tornado.event_queue import request_event_queue, get_user_events
+from zerver.tornado.event_queue import request_event_queue, get_user_events, send_event
 from zerver.models import Client, Message, Realm, UserPresence, UserProfile, CustomProfileFieldValue, \
     get_user_profile_by_id, \
     get_realm_user_dicts, realm_filters_for_realm, get_user,\
@@ -136,6 +140,49 @@ def always_want(msg_type: str) -> bool:
         return False
     return True
 
+# Used for fetching independent sections of the initial state
+# concurrently; see start_section_fetches.  It's replaced if
+# settings.INITIAL_STATE_FETCH_THREADS changes.
+initial_state_executor = None  # type: Optional[ThreadPoolExecutor]
+initial_state_executor_threads = 0
+
+def run_with_own_connection(fetch: Callable[[], Any]) -> Any:
+    # Django gives each thread its own database connection; as it
+    # would around a request, we discard it if it's broken or older
+    # than CONN_MAX_AGE.
+    close_old_connections()
+    try:
+        return fetch()
+    finally:
+        close_old_connections()
+
+def start_section_fetches(fetches: Dict[str, Callable[[], Any]]) -> Dict[str, Callable[[], Any]]:
+    """Given functions that fetch independent sections of the initial
+    state, returns functions that return their results.
+
+    If settings.INITIAL_STATE_FETCH_THREADS is set, all the fetches
+    are started immediately on a thread pool of that size, each
+    using a separate database connection; otherwise, each runs when
+    its result is requested.  Since those connections don't share a
+    transaction with the caller, this shouldn't be used where the
+    caller has uncommitted changes (e.g. in tests)."""
+    global initial_state_executor, initial_state_executor_threads
+    if not settings.INITIAL_STATE_FETCH_THREADS:
+        return fetches
+
+    if (initial_state_executor is None or
+            initial_state_executor_threads != settings.INITIAL_STATE_FETCH_THREADS):
+        if initial_state_executor is not None:
+            initial_state_executor.shutdown(wait=False)
+        initial_state_executor = ThreadPoolExecutor(
+            max_workers=settings.INITIAL_STATE_FETCH_THREADS)
+        initial_state_executor_threads = settings.INITIAL_STATE_FETCH_THREADS
+    futures = {
+        section: initial_state_executor.submit(run_with_own_connection, fetch)
+        for (section, fetch) in fetches.items()
+    }
+    return {section: future.result for (section, future) in futures.items()}
+
 # Fetch initial data.  When event_types is not specified, clients want
 # all event types.  Whenever you add new code to this function, you
 # should also add corresponding events for changes in the data
@@ -143,8 +190,12 @@ def always_want(msg_type: str) -> bool:
 def fetch_initial_state_data(user_profile: UserProfile,
                              event_types: Optional[Iterable[str]],
                              queue_id: str, client_gravatar: bool,
-                             include_subscribers: bool = True) -> Dict[str, Any]:
+                             include_subscribers: bool = True,
+                             section_timer: Optional[SectionTimer] = None,
+                             deferred_event_types: Iterable[str] = ()) -> Dict[str, Any]:
     state = {'queue_id': queue_id}  # type: Dict[str, Any]
+    if section_timer is None:
+        section_timer = SectionTimer()
     realm = user_profile.realm
 
     if event_types is None:
@@ -153,18 +204,50 @@ def fetch_initial_state_data(user_profile: UserProfile,
     else:
         want = set(event_types).__contains__
 
+    # Sections the client asked to receive later; see
+    # send_deferred_initial_state.
+    deferred = set(deferred_event_types)
+    if deferred:
+        wanted = want
+        want = lambda msg_type: msg_type not in deferred and wanted(msg_type)
+
+    # The most expensive sections, which don't depend on each other,
+    # and so can be fetched concurrently.
+    fetches = {}  # type: Dict[str, Callable[[], Any]]
+    if want('presence'):
+        fetches['presence'] = lambda: get_status_dict(user_profile)
+    if want('realm_bot'):
+        fetches['realm_bot'] = lambda: get_owned_bot_dicts(user_profile)
+    if want('realm_emoji'):
+        fetches['realm_emoji'] = lambda: realm.get_emoji()
+    if want('realm_user'):
+        fetches['realm_user'] = lambda: get_raw_user_data(
+            realm=realm,
+            client_gravatar=client_gravatar,
+        )
+    if want('subscription'):
+        fetches['subscription'] = lambda: gather_subscriptions_helper(
+            user_profile, include_subscribers=include_subscribers)
+    if want('update_message_flags') and want('message'):
+        fetches['unread_msgs'] = lambda: get_raw_unread_data(user_profile)
+    fetched = start_section_fetches(fetches)
+
     if want('alert_words'):
+        section_timer.start('alert_words')
         state['alert_words'] = user_alert_words(user_profile)
 
     if want('custom_profile_fields'):
+        section_timer.start('custom_profile_fields')
         fields = custom_profile_fields_for_realm(realm.id)
         state['custom_profile_fields'] = [f.as_dict() for f in fields]
         state['custom_profile_field_types'] = CustomProfileField.FIELD_TYPE_CHOICES_DICT
 
     if want('hotspots'):
+        section_timer.start('hotspots')
         state['hotspots'] = get_next_hotspots(user_profile)
 
     if want('message'):
+        section_timer.start('message')
         # The client should use get_messages() to fetch messages
         # starting with the max_message_id.  They will get messages
         # newer than that ID via get_events()
@@ -175,15 +258,19 @@ def fetch_initial_state_data(user_profile: UserProfile,
             state['max_message_id'] = -1
 
     if want('muted_topics'):
+        section_timer.start('muted_topics')
         state['muted_topics'] = get_topic_mutes(user_profile)
 
     if want('pointer'):
+        section_timer.start('pointer')
         state['pointer'] = user_profile.pointer
 
     if want('presence'):
-        state['presences'] = get_status_dict(user_profile)
+        section_timer.start('presence')
+        state['presences'] = fetched['presence']()
 
     if want('realm'):
+        section_timer.start('realm')
         for property_name in Realm.property_types:
             state['realm_' + property_name] = getattr(realm, property_name)
 
@@ -233,22 +320,24 @@ def fetch_initial_state_data(user_profile: UserProfile,
             state['realm_signup_notifications_stream_id'] = -1
 
     if want('realm_domains'):
+        section_timer.start('realm_domains')
         state['realm_domains'] = get_realm_domains(realm)
 
     if want('realm_emoji'):
-        state['realm_emoji'] = realm.get_emoji()
+        section_timer.start('realm_emoji')
+        state['realm_emoji'] = fetched['realm_emoji']()
 
     if want('realm_filters'):
+        section_timer.start('realm_filters')
         state['realm_filters'] = realm_filters_for_realm(realm.id)
 
     if want('realm_user_groups'):
+        section_timer.start('realm_user_groups')
         state['realm_user_groups'] = user_groups_in_realm_serialized(realm)
 
     if want('realm_user'):
-        state['raw_users'] = get_raw_user_data(
-            realm=realm,
-            client_gravatar=client_gravatar,
-        )
+        section_timer.start('realm_user')
+        state['raw_users'] = fetched['realm_user']()
 
         # For the user's own avatar URL, we force
         # client_gravatar=False, since that saves some unnecessary
@@ -278,11 +367,13 @@ def fetch_initial_state_data(user_profile: UserProfile,
         state['full_name'] = user_profile.full_name
 
     if want('realm_bot'):
-        state['realm_bots'] = get_owned_bot_dicts(user_profile)
+        section_timer.start('realm_bot')
+        state['realm_bots'] = fetched['realm_bot']()
 
     # This does not yet have an apply_event counterpart, since currently,
     # new entries for EMBEDDED_BOTS can only be added directly in the codebase.
     if want('realm_embedded_bots'):
+        section_timer.start('realm_embedded_bots')
         realm_embedded_bots = []
         for bot in EMBEDDED_BOTS:
             realm_embedded_bots.append({'name': bot.name,
@@ -290,6 +381,7 @@ def fetch_initial_state_data(user_profile: UserProfile,
         state['realm_embedded_bots'] = realm_embedded_bots
 
     if want('recent_private_conversations'):
+        section_timer.start('recent_private_conversations')
         # A data structure containing records of this form:
         #
         #   [{'max_message_id': 700175, 'user_ids': [801]}]
@@ -305,33 +397,38 @@ def fetch_initial_state_data(user_profile: UserProfile,
         state['raw_recent_private_conversations'] = get_recent_private_conversations(user_profile)
 
     if want('subscription'):
-        subscriptions, unsubscribed, never_subscribed = gather_subscriptions_helper(
-            user_profile, include_subscribers=include_subscribers)
+        section_timer.start('subscription')
+        subscriptions, unsubscribed, never_subscribed = fetched['subscription']()
         state['subscriptions'] = subscriptions
         state['unsubscribed'] = unsubscribed
         state['never_subscribed'] = never_subscribed
 
     if want('update_message_flags') and want('message'):
+        section_timer.start('unread_msgs')
         # Keeping unread_msgs updated requires both message flag updates and
         # message updates. This is due to the fact that new messages will not
         # generate a flag update so we need to use the flags field in the
         # message event.
-        state['raw_unread_msgs'] = get_raw_unread_data(user_profile)
+        state['raw_unread_msgs'] = fetched['unread_msgs']()
 
     if want('starred_messages'):
+        section_timer.start('starred_messages')
         state['starred_messages'] = get_starred_message_ids(user_profile)
 
     if want('stream'):
+        section_timer.start('stream')
         state['streams'] = do_get_streams(user_profile)
         state['stream_name_max_length'] = Stream.MAX_NAME_LENGTH
         state['stream_description_max_length'] = Stream.MAX_DESCRIPTION_LENGTH
     if want('default_streams'):
+        section_timer.start('default_streams')
         if user_profile.is_guest:
             state['realm_default_streams'] = []
         else:
             state['realm_default_streams'] = streams_to_dicts_sorted(
                 get_default_streams_for_realm(realm.id))
     if want('default_stream_groups'):
+        section_timer.start('default_stream_groups')
         if user_profile.is_guest:
             state['realm_default_stream_groups'] = []
         else:
@@ -339,24 +436,30 @@ def fetch_initial_state_data(user_profile: UserProfile,
                 get_default_stream_groups(realm))
 
     if want('stop_words'):
+        section_timer.start('stop_words')
         state['stop_words'] = read_stop_words()
 
     if want('update_display_settings'):
+        section_timer.start('update_display_settings')
         for prop in UserProfile.property_types:
             state[prop] = getattr(user_profile, prop)
         state['emojiset_choices'] = user_profile.emojiset_choices()
 
     if want('update_global_notifications'):
+        section_timer.start('update_global_notifications')
         for notification in UserProfile.notification_setting_types:
             state[notification] = getattr(user_profile, notification)
         state['available_notification_sounds'] = get_available_notification_sounds()
 
     if want('user_status'):
+        section_timer.start('user_status')
         state['user_status'] = get_user_info_dict(realm_id=realm.id)
 
     if want('zulip_version'):
+        section_timer.start('zulip_version')
         state['zulip_version'] = ZULIP_VERSION
 
+    section_timer.stop()
     return state
 
 
@@ -826,7 +929,9 @@ def do_events_register(user_profile: UserProfile, user_client: Client,
                        include_subscribers: bool = True,
                        notification_settings_null: bool = False,
                        narrow: Iterable[Sequence[str]] = [],
-                       fetch_event_types: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+                       fetch_event_types: Optional[Iterable[str]] = None,
+                       section_timer: Optional[SectionTimer] = None,
+                       deferred_event_types: Iterable[str] = ()) -> Dict[str, Any]:
     # Technically we don't need to check this here because
     # build_narrow_filter will check it, but it's nicer from an error
     # handling perspective to do it before contacting Tornado
@@ -853,27 +958,100 @@ def do_events_register(user_profile: UserProfile, user_client: Client,
     else:
         event_types_set = None
 
+    deferred = sorted(set(
+        event_type for event_type in expand_deferred_event_types(deferred_event_types)
+        if event_types_set is None or event_type in event_types_set
+    ))
+
     # Fill up the UserMessage rows if a soft-deactivated user has returned
     reactivate_user_if_soft_deactivated(user_profile)
 
+    if section_timer is None:
+        section_timer = SectionTimer()
     ret = fetch_initial_state_data(user_profile, event_types_set, queue_id,
                                    client_gravatar=client_gravatar,
-                                   include_subscribers=include_subscribers)
+                                   include_subscribers=include_subscribers,
+                                   section_timer=section_timer,
+                                   deferred_event_types=deferred)
 
     # Apply events that came in while we were fetching initial data
+    section_timer.start('apply_events')
     events = get_user_events(user_profile, queue_id, -1)
-    apply_events(ret, events, user_profile, include_subscribers=include_subscribers,
+    apply_events(ret, [event for event in events if event['type'] not in deferred],
+                 user_profile, include_subscribers=include_subscribers,
                  client_gravatar=client_gravatar,
                  fetch_event_types=fetch_event_types)
 
+    section_timer.start('post_process')
     post_process_state(user_profile, ret, notification_settings_null)
+    section_timer.stop()
 
     if len(events) > 0:
         ret['last_event_id'] = events[-1]['id']
     else:
         ret['last_event_id'] = -1
+
+    if deferred:
+        ret['deferred_event_types'] = deferred
+        queue_json_publish('deferred_work', dict(
+            type='send_deferred_initial_state',
+            user_profile_id=user_profile.id,
+            queue_id=queue_id,
+            event_types=deferred,
+            client_gravatar=client_gravatar,
+            include_subscribers=include_subscribers,
+            notification_settings_null=notification_settings_null,
+        ))
     return ret
 
+# Event types whose sections of the initial state are computed from,
+# or updated by events of, each other's types, so that they can only be
+# deferred together: e.g. `stream` events update the `subscriptions`
+# section, and `unread_msgs` needs both `message` and
+# `update_message_flags`.
+DEFERRED_EVENT_TYPE_GROUPS = [
+    {'stream', 'subscription'},
+    {'message', 'update_message', 'delete_message', 'update_message_flags',
+     'starred_messages'},
+]
+
+def expand_deferred_event_types(deferred_event_types: Iterable[str]) -> Set[str]:
+    deferred = set(deferred_event_types)
+    for group in DEFERRED_EVENT_TYPE_GROUPS:
+        if deferred & group:
+            deferred |= group
+    return deferred
+
+def send_deferred_initial_state(user_profile: UserProfile, queue_id: str,
+                                event_types: List[str], client_gravatar: bool,
+                                include_subscribers: bool,
+                                notification_settings_null: bool) -> None:
+    """Fetches the sections of the initial state that a client deferred
+    when registering the given queue, and sends them to that queue
+    (only) as an `initial_state` event.
+
+    As in do_events_register, we apply the events already in the queue
+    to the state before sending it; its `last_event_id` is the last
+    event so applied.  Clients should apply events of these types that
+    have higher IDs on top of the state, and can ignore the others."""
+    state = fetch_initial_state_data(user_profile, event_types, queue_id,
+                                     client_gravatar=client_gravatar,
+                                     include_subscribers=include_subscribers)
+    del state['queue_id']
+
+    events = get_user_events(user_profile, queue_id, -1)
+    apply_events(state, events, user_profile, include_subscribers=include_subscribers,
+                 client_gravatar=client_gravatar, fetch_event_types=event_types)
+    post_process_state(user_profile, state, notification_settings_null)
+
+    event = dict(
+        type='initial_state',
+        queue_id=queue_id,
+        state=state,
+        last_event_id=events[-1]['id'] if events else -1,
+    )
+    send_event(user_profile.realm, event, [user_profile.id])
+
 def post_process_state(user_profile: UserProfile, ret: Dict[str, Any],
                        notification_settings_null: bool) -> None:
     '''
@@ -23,7 +23,7 @@ from zerver.lib.timestamp import datetime_to_timestamp
 from zerver.lib.export import DATE_FIELDS, \
     Record, TableData, TableName, Field, Path
 from zerver.lib.message import do_render_markdown
-from zerver.lib.bugdown import version as bugdown_version
+from zerver.lib.bugdown import BatchData, version as bugdown_version
 from zerver.lib.actions import render_stream_description
 from zerver.lib.upload import random_name, sanitize_name, \
     guess_type, BadImageError
@@ -233,6 +233,13 @@ def fix_message_rendered_content(realm: Realm,
     This function sets the rendered_content of all the messages
     after the messages have been imported from a non-Zulip platform.
     """
+    # The messages are all from the same realm, so we can fetch the
+    # data from the database needed to render them in one batch.
+    batch_data = BatchData(realm, [
+        message['content'] for message in messages
+        if message['rendered_content'] is None
+    ])
+
     for message in messages:
         if message['rendered_content'] is not None:
             # For Zulip->Zulip imports, we use the original rendered
@@ -305,6 +312,7 @@ def fix_message_rendered_content(realm: Realm,
                 message_user_ids=message_user_ids,
                 sent_by_bot=sent_by_bot,
                 translate_emoticons=translate_emoticons,
+                batch_data=batch_data,
             )
             assert(rendered_content is not None)
 
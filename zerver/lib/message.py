@@ -1,24 +1,36 @@
 
 import datetime
+import logging
+import random
 import ujson
 import zlib
 import ahocorasick
 
+from django.conf import settings
+from django.utils.lru_cache import lru_cache
 from django.utils.translation import ugettext as _
 from django.utils.timezone import now as timezone_now
 from django.db import connection
-from django.db.models import Sum
+from django.db.models import Q, Sum
+from django.db.models.expressions import RawSQL
 
 from analytics.lib.counts import COUNT_STATS, RealmCount
 
 from zerver.lib.avatar import get_avatar_field
 import zerver.lib.bugdown as bugdown
 from zerver.lib.cache import (
+    cache_add,
+    cache_get_many,
+    cache_set,
+    cache_set_many,
     cache_with_key,
     generic_bulk_cached_fetch,
     to_dict_cache_key,
     to_dict_cache_key_id,
+    unread_message_info_cache_key,
+    unread_message_info_version_cache_key,
 )
+from zerver.lib.exceptions import BugdownRenderingException
 from zerver.lib.request import JsonableError
 from zerver.lib.stream_subscription import (
     get_stream_subscriptions_for_user,
@@ -79,6 +91,33 @@ UnreadMessagesResult = TypedDict('UnreadMessagesResult', {
 # user has more older unread messages that were cut off.
 MAX_UNREAD_MESSAGES = 50000
 
+SUBMESSAGES_JSON_SQL = '''
+    SELECT COALESCE(json_agg(json_build_object(
+        'id', zerver_submessage.id,
+        'message_id', zerver_submessage.message_id,
+        'sender_id', zerver_submessage.sender_id,
+        'msg_type', zerver_submessage.msg_type,
+        'content', zerver_submessage.content
+    ) ORDER BY zerver_submessage.id), '[]')
+    FROM zerver_submessage
+    WHERE zerver_submessage.message_id = zerver_message.id
+'''
+
+REACTIONS_JSON_SQL = '''
+    SELECT COALESCE(json_agg(json_build_object(
+        'message_id', zerver_reaction.message_id,
+        'emoji_name', zerver_reaction.emoji_name,
+        'emoji_code', zerver_reaction.emoji_code,
+        'reaction_type', zerver_reaction.reaction_type,
+        'user_profile__email', zerver_userprofile.email,
+        'user_profile__id', zerver_userprofile.id,
+        'user_profile__full_name', zerver_userprofile.full_name
+    ) ORDER BY zerver_reaction.id), '[]')
+    FROM zerver_reaction
+    JOIN zerver_userprofile ON zerver_userprofile.id = zerver_reaction.user_profile_id
+    WHERE zerver_reaction.message_id = zerver_message.id
+'''
+
 def messages_for_ids(message_ids: List[int],
                      user_message_flags: Dict[int, List[str]],
                      search_fields: Dict[int, Dict[str, str]],
@@ -148,11 +187,88 @@ def sew_messages_and_submessages(messages: List[Dict[str, Any]],
             message['submessages'].append(submessage)
 
 def extract_message_dict(message_bytes: bytes) -> Dict[str, Any]:
-    return ujson.loads(zlib.decompress(message_bytes).decode("utf-8"))
+    if settings.MESSAGE_CACHE_FORMAT == 'compact':
+        return extract_message_dict_compact(message_bytes)
+    return extract_message_dict_json(message_bytes)
 
 def stringify_message_dict(message_dict: Dict[str, Any]) -> bytes:
+    if settings.MESSAGE_CACHE_FORMAT == 'compact':
+        return stringify_message_dict_compact(message_dict)
+    return stringify_message_dict_json(message_dict)
+
+def extract_message_dict_json(message_bytes: bytes) -> Dict[str, Any]:
+    return ujson.loads(zlib.decompress(message_bytes).decode("utf-8"))
+
+def stringify_message_dict_json(message_dict: Dict[str, Any]) -> bytes:
     return zlib.compress(ujson.dumps(message_dict).encode())
 
+# The top-level keys of the dicts built by MessageDict.build_message_dict,
+# in the order that the compact format stores their values.  After
+# changing this, bump the version in to_dict_cache_key_id.
+COMPACT_MESSAGE_DICT_KEYS = (
+    'id',
+    'sender_id',
+    'content',
+    'recipient_type_id',
+    'recipient_type',
+    'recipient_id',
+    'timestamp',
+    'client',
+    TOPIC_NAME,
+    'sender_realm_id',
+    'raw_display_recipient',
+    TOPIC_LINKS,
+    'last_edit_timestamp',
+    'edit_history',
+    'rendered_content',
+    'is_me_message',
+    'reactions',
+    'submessages',
+)
+
+# Encodings shorter than this aren't worth compressing; zlib saves
+# little on them, and decompressing is a good part of the decoding time.
+COMPACT_MESSAGE_DICT_MIN_COMPRESS_LENGTH = 1024
+
+@lru_cache(maxsize=None)
+def compact_message_dict_keys(present: int) -> Tuple[str, ...]:
+    return tuple(key for (i, key) in enumerate(COMPACT_MESSAGE_DICT_KEYS)
+                 if present & (1 << i))
+
+def stringify_message_dict_compact(message_dict: Dict[str, Any]) -> bytes:
+    '''
+    Encodes a message dict as a JSON array, rather than an object, so
+    that we don't store its keys for every message: the first element
+    is a bitmap of which of COMPACT_MESSAGE_DICT_KEYS the dict has (not
+    every message has edit history, for example), the second is an
+    object with any other keys, and the rest are the values of the keys
+    in the bitmap, in order.  The encoding is prefixed with b'z' if
+    it's compressed, and b'j' if not.
+    '''
+    present = 0
+    values = []  # type: List[Any]
+    for (i, key) in enumerate(COMPACT_MESSAGE_DICT_KEYS):
+        if key in message_dict:
+            present |= 1 << i
+            values.append(message_dict[key])
+    others = {key: value for (key, value) in message_dict.items()
+              if key not in COMPACT_MESSAGE_DICT_KEYS}
+    data = ujson.dumps([present, others] + values).encode()
+    if len(data) >= COMPACT_MESSAGE_DICT_MIN_COMPRESS_LENGTH:
+        return b'z' + zlib.compress(data)
+    return b'j' + data
+
+def extract_message_dict_compact(message_bytes: bytes) -> Dict[str, Any]:
+    if message_bytes[:1] == b'z':
+        data = zlib.decompress(message_bytes[1:])
+    else:
+        data = message_bytes[1:]
+    values = ujson.loads(data.decode("utf-8"))
+    message_dict = dict(zip(compact_message_dict_keys(values[0]), values[2:]))
+    if values[1]:
+        message_dict.update(values[1])
+    return message_dict
+
 @cache_with_key(to_dict_cache_key, timeout=3600*24)
 def message_to_dict_json(message: Message) -> bytes:
     return MessageDict.to_dict_uncached(message)
@@ -164,6 +280,85 @@ def save_message_rendered_content(message: Message, content: str) -> str:
     message.save_rendered_content()
     return rendered_content
 
+def bulk_save_rendered_content(messages: List[Message]) -> None:
+    '''
+    Saves the rendered_content (and rendered_content_version) of the
+    messages with a single UPDATE query, and refreshes their entries
+    in the to_dict cache.  Messages whose stored rendering is already
+    at least as new, e.g. because they were edited after we read
+    them, are left alone.
+    '''
+    if not messages:
+        return
+
+    values = ','.join(['(%s, %s, %s)'] * len(messages))
+    params = []  # type: List[Any]
+    for message in messages:
+        params += [message.id, message.rendered_content, message.rendered_content_version]
+    query = '''
+        UPDATE
+            zerver_message
+        SET
+            rendered_content = data.rendered_content,
+            rendered_content_version = data.rendered_content_version
+        FROM
+            (VALUES %s) AS data (id, rendered_content, rendered_content_version)
+        WHERE
+            zerver_message.id = data.id AND
+            (zerver_message.rendered_content_version IS NULL OR
+             zerver_message.rendered_content_version < data.rendered_content_version)
+    ''' % (values,)
+
+    with connection.cursor() as cursor:
+        cursor.execute(query, params)
+
+    rows = MessageDict.get_raw_db_rows([message.id for message in messages])
+    cache_set_many({
+        to_dict_cache_key_id(row['id']): (
+            stringify_message_dict(MessageDict.build_dict_from_raw_db_row(row)),
+        )
+        for row in rows
+    })
+
+def rerender_stale_messages(start_id: int, end_id: int) -> int:
+    '''
+    Re-renders the messages with IDs in [start_id, end_id) that haven't
+    been rendered with the current version of bugdown, which
+    MessageDict would otherwise do lazily, one message at a time, when
+    they're next fetched.  Returns the number of messages re-rendered.
+    '''
+    messages = Message.objects.select_related('sender', 'sending_client').filter(
+        id__gte=start_id,
+        id__lt=end_id,
+    ).filter(
+        Q(rendered_content=None) |
+        Q(rendered_content_version=None) |
+        Q(rendered_content_version__lt=bugdown.version)
+    ).order_by('id')
+
+    messages_by_realm = {}  # type: Dict[int, List[Message]]
+    for message in messages:
+        messages_by_realm.setdefault(message.sender.realm_id, []).append(message)
+
+    rendered_messages = []  # type: List[Message]
+    for realm_messages in messages_by_realm.values():
+        realm = realm_messages[0].get_realm()
+        batch_data = bugdown.BatchData(realm, [message.content for message in realm_messages])
+        for message in realm_messages:
+            try:
+                message.rendered_content = render_markdown(message, message.content,
+                                                           realm=realm, batch_data=batch_data)
+            except BugdownRenderingException:
+                # bugdown has logged the details already; we leave the
+                # message to be rendered lazily, as before.
+                logging.warning("Failed to re-render message %s" % (message.id,))
+                continue
+            message.rendered_content_version = bugdown.version
+            rendered_messages.append(message)
+
+    bulk_save_rendered_content(rendered_messages)
+    return len(rendered_messages)
+
 class MessageDict:
     @staticmethod
     def wide_dict(message: Message) -> Dict[str, Any]:
@@ -262,13 +457,15 @@ class MessageDict:
             'sending_client__name',
             'sender__realm_id',
         ]
-        messages = Message.objects.filter(id__in=needed_ids).values(*fields)
-
-        submessages = SubMessage.get_raw_db_rows(needed_ids)
-        sew_messages_and_submessages(messages, submessages)
-
-        reactions = Reaction.get_raw_db_rows(needed_ids)
-        return sew_messages_and_reactions(messages, reactions)
+        # We fold each message's submessages and reactions into its
+        # row as JSON arrays (in the same format as
+        # SubMessage.get_raw_db_rows and Reaction.get_raw_db_rows),
+        # so that this is a single query.
+        messages = Message.objects.filter(id__in=needed_ids).annotate(
+            submessages=RawSQL(SUBMESSAGES_JSON_SQL, ()),
+            reactions=RawSQL(REACTIONS_JSON_SQL, ()),
+        ).values(*fields, 'submessages', 'reactions')
+        return list(messages)
 
     @staticmethod
     def build_dict_from_raw_db_row(row: Dict[str, Any]) -> Dict[str, Any]:
@@ -583,7 +780,8 @@ def render_markdown(message: Message,
                     realm_alert_words_automaton: Optional[ahocorasick.Automaton]=None,
                     user_ids: Optional[Set[int]]=None,
                     mention_data: Optional[bugdown.MentionData]=None,
-                    email_gateway: Optional[bool]=False) -> str:
+                    email_gateway: Optional[bool]=False,
+                    batch_data: Optional[bugdown.BatchData]=None) -> str:
     '''
     This is basically just a wrapper for do_render_markdown.
     '''
@@ -610,6 +808,7 @@ def render_markdown(message: Message,
         translate_emoticons=translate_emoticons,
         mention_data=mention_data,
         email_gateway=email_gateway,
+        batch_data=batch_data,
     )
 
     return rendered_content
@@ -622,7 +821,8 @@ def do_render_markdown(message: Message,
                        translate_emoticons: bool,
                        realm_alert_words_automaton: Optional[ahocorasick.Automaton]=None,
                        mention_data: Optional[bugdown.MentionData]=None,
-                       email_gateway: Optional[bool]=False) -> str:
+                       email_gateway: Optional[bool]=False,
+                       batch_data: Optional[bugdown.BatchData]=None) -> str:
     """Return HTML for given markdown. Bugdown may add properties to the
     message object such as `mentions_user_ids`, `mentions_user_group_ids`, and
     `mentions_wildcard`.  These are only on this Django object and are not
@@ -645,7 +845,8 @@ def do_render_markdown(message: Message,
         sent_by_bot=sent_by_bot,
         translate_emoticons=translate_emoticons,
         mention_data=mention_data,
-        email_gateway=email_gateway
+        email_gateway=email_gateway,
+        batch_data=batch_data,
     )
     return rendered_content
 
@@ -755,30 +956,125 @@ def get_starred_message_ids(user_profile: UserProfile) -> List[int]:
         'message_id'
     ).values_list('message_id', flat=True)[0:10000])
 
-def get_raw_unread_data(user_profile: UserProfile) -> RawUnreadMessagesResult:
-
+# (recipient_id, recipient type, recipient type_id, topic, sender_id):
+# what get_raw_unread_data needs to know about an unread message,
+# besides its flags.
+UnreadMessageInfo = Tuple[int, int, int, str, int]
+
+def get_unread_messages(user_profile: UserProfile) -> List[Tuple[int, int, UnreadMessageInfo]]:
+    """Returns (message_id, flags, UnreadMessageInfo) for the user's most
+    recent MAX_UNREAD_MESSAGES unread messages, oldest first.
+
+    An UnreadMessageInfo doesn't change after a message is sent,
+    except for its topic, so we keep the user's unread messages in the
+    cache, as the IDs of those with each UnreadMessageInfo.  When that
+    copy is present, we only need to join against Message for
+    messages that arrived (or were marked as unread) since it was
+    built, rather than for the user's whole unread backlog.
+
+    The copy records the version (see invalidate_unread_message_info)
+    current when we started reading the data it was built from, and is
+    only used while that version is current; so a copy built from data
+    read before a topic edit committed is never used after it."""
     excluded_recipient_ids = get_inactive_recipient_ids(user_profile)
+    version_key = unread_message_info_version_cache_key(user_profile.id)
+    cache_key = unread_message_info_cache_key(user_profile.id)
+    cached = cache_get_many([version_key, cache_key])
+    cached_info = None  # type: Optional[Dict[UnreadMessageInfo, List[int]]]
+    if version_key in cached:
+        version = cached[version_key][0]  # type: Optional[int]
+        if cache_key in cached and cached[cache_key][0][0] == version:
+            cached_info = cached[cache_key][0][1]
+    else:
+        # There's no current version (it expired or was evicted), so
+        # start one before reading anything.  If another request
+        # beats us to it, e.g. a topic edit, we can't tell whether our
+        # data predates that version, so we don't cache it.
+        version = random.getrandbits(32)
+        if not cache_add(version_key, version):
+            version = None
 
     user_msgs = UserMessage.objects.filter(
         user_profile=user_profile
-    ).exclude(
-        message__recipient_id__in=excluded_recipient_ids
-    ).extra(
+    )
+    if excluded_recipient_ids:
+        user_msgs = user_msgs.exclude(
+            message__recipient_id__in=excluded_recipient_ids
+        )
+    user_msgs = user_msgs.extra(
         where=[UserMessage.where_unread()]
-    ).values(
-        'message_id',
-        'message__sender_id',
-        MESSAGE__TOPIC,
-        'message__recipient_id',
-        'message__recipient__type',
-        'message__recipient__type_id',
-        'flags',
     ).order_by("-message_id")
 
-    # Limit unread messages for performance reasons.
-    user_msgs = list(user_msgs[:MAX_UNREAD_MESSAGES])
+    # We limit unread messages for performance reasons.
+    message_info = {}  # type: Dict[int, UnreadMessageInfo]
+    missing_ids = []  # type: List[int]
+    if cached_info is None:
+        # Fetch everything in one query, as we'd have to join against
+        # Message for every row anyway.
+        rows = list(reversed(user_msgs.values_list(
+            'message_id',
+            'flags',
+            'message__recipient_id',
+            'message__recipient__type',
+            'message__recipient__type_id',
+            MESSAGE__TOPIC,
+            'message__sender_id',
+        )[:MAX_UNREAD_MESSAGES]))
+        for row in rows:
+            message_info[row[0]] = row[2:]
+        unread_flags = [(row[0], row[1]) for row in rows]
+    else:
+        unread_flags = list(reversed(user_msgs.values_list(
+            'message_id',
+            'flags',
+        )[:MAX_UNREAD_MESSAGES]))
+        for (info, message_ids) in cached_info.items():
+            for message_id in message_ids:
+                message_info[message_id] = info
+        missing_ids = [message_id for (message_id, flags) in unread_flags
+                       if message_id not in message_info]
+        if missing_ids:
+            for row in Message.objects.filter(id__in=missing_ids).values_list(
+                    'id',
+                    'recipient_id',
+                    'recipient__type',
+                    'recipient__type_id',
+                    DB_TOPIC_NAME,
+                    'sender_id'):
+                message_info[row[0]] = row[1:]
+
+    result = [(message_id, flags, message_info[message_id])
+              for (message_id, flags) in unread_flags
+              # Skip messages deleted since we looked up their UserMessage rows.
+              if message_id in message_info]
+
+    if version is not None and (cached_info is None or missing_ids or
+                                len(message_info) != len(result)):
+        # Update the cached copy to cover exactly the messages that
+        # are unread now.
+        new_info = {}  # type: Dict[UnreadMessageInfo, List[int]]
+        for (message_id, flags, info) in result:
+            new_info.setdefault(info, []).append(message_id)
+        cache_set(cache_key, (version, new_info))
 
-    rows = list(reversed(user_msgs))
+    return result
+
+def invalidate_unread_message_info(message_ids: List[int]) -> None:
+    """Called once a change to the topic of the given messages has
+    committed, to discard the cached get_unread_messages data of users
+    who have any of them unread, by giving it a new version."""
+    user_ids = UserMessage.objects.filter(
+        message_id__in=message_ids
+    ).extra(
+        where=[UserMessage.where_unread()]
+    ).values_list('user_profile_id', flat=True).distinct()
+    cache_set_many({
+        unread_message_info_version_cache_key(user_id): (random.getrandbits(32),)
+        for user_id in user_ids
+    })
+
+def get_raw_unread_data(user_profile: UserProfile) -> RawUnreadMessagesResult:
+    rows = get_unread_messages(user_profile)
 
     muted_stream_ids = get_muted_stream_ids(user_profile)
 
@@ -809,15 +1105,11 @@ def get_raw_unread_data(user_profile: UserProfile) -> RawUnreadMessagesResult:
     huddle_dict = {}
     mentions = set()
 
-    for row in rows:
-        message_id = row['message_id']
-        msg_type = row['message__recipient__type']
-        recipient_id = row['message__recipient_id']
-        sender_id = row['message__sender_id']
+    for (message_id, flags, info) in rows:
+        (recipient_id, msg_type, type_id, topic, sender_id) = info
 
         if msg_type == Recipient.STREAM:
-            stream_id = row['message__recipient__type_id']
-            topic = row[MESSAGE__TOPIC]
+            stream_id = type_id
             stream_dict[message_id] = dict(
                 stream_id=stream_id,
                 topic=topic,
@@ -837,7 +1129,7 @@ def get_raw_unread_data(user_profile: UserProfile) -> RawUnreadMessagesResult:
                 user_ids_string=user_ids_string,
             )
 
-        is_mentioned = (row['flags'] & UserMessage.flags.mentioned) != 0
+        is_mentioned = (flags & UserMessage.flags.mentioned) != 0
         if is_mentioned:
             mentions.add(message_id)
 
@@ -1,8 +1,11 @@
 
 import cProfile
+import time
 
+from collections import OrderedDict
+from django.db import connection
 from functools import wraps
-from typing import Any, TypeVar, Callable
+from typing import Any, Callable, Dict, Optional, Tuple, TypeVar
 
 ReturnT = TypeVar('ReturnT')
 
@@ -31,3 +34,47 @@ def profiled(func: Callable[..., ReturnT]) -> Callable[..., ReturnT]:
         prof.dump_stats(fn)
         return retval
     return wrapped_func
+
+class SectionTimer:
+    """Records the time and number of database queries spent in each of
+    a sequence of named sections of code; e.g. the sections of
+    fetch_initial_state_data.  Calling start() ends the current
+    section, if any, and starts a new one.
+    """
+    def __init__(self) -> None:
+        # Maps each section to its total (seconds, query count).
+        self.sections = OrderedDict()  # type: Dict[str, Tuple[float, int]]
+        self.current_section = None  # type: Optional[str]
+        self.section_start_time = 0.0
+        self.section_start_queries = 0
+
+    def start(self, section: str) -> None:
+        self.stop()
+        self.current_section = section
+        self.section_start_time = time.time()
+        self.section_start_queries = get_query_count()
+
+    def stop(self) -> None:
+        if self.current_section is None:
+            return
+        (seconds, queries) = self.sections.get(self.current_section, (0.0, 0))
+        self.sections[self.current_section] = (
+            seconds + time.time() - self.section_start_time,
+            queries + get_query_count() - self.section_start_queries,
+        )
+        self.current_section = None
+
+    def format(self, min_seconds: float=0.005) -> str:
+        """Formats the sections that took at least min_seconds, slowest
+        first, for a log line."""
+        sections = sorted(self.sections.items(), key=lambda item: -item[1][0])
+        return " ".join("%s:%.0fms/%sq" % (section, seconds * 1000, queries)
+                        for (section, (seconds, queries)) in sections
+                        if seconds >= min_seconds)
+
+def get_query_count() -> int:
+    # zerver.lib.db.TimeTrackingConnection records the queries run on
+    # the connection since the start of the current request.
+    if connection.connection is None:
+        return 0
+    return len(connection.connection.queries)
@@ -3,89 +3,50 @@
 from zerver.lib.logging_util import log_to_file
 from collections import defaultdict
 import logging
-from django.db import transaction
+from django.db import connection, transaction
 from django.db.models import Max
 from django.conf import settings
 from django.utils.timezone import now as timezone_now
-from typing import DefaultDict, Dict, List, Optional, Union, Any
+from typing import DefaultDict, Dict, List, Optional, Tuple, Union, Any
 
 from zerver.models import UserProfile, UserMessage, RealmAuditLog, \
     Subscription, Message, Recipient, UserActivity, Realm
 
 logger = logging.getLogger("zulip.soft_deactivation")
 log_to_file(logger, settings.SOFT_DEACTIVATION_LOG_PATH)
-BULK_CREATE_BATCH_SIZE = 10000
-
-def filter_by_subscription_history(user_profile: UserProfile,
-                                   all_stream_messages: DefaultDict[int, List[Message]],
-                                   all_stream_subscription_logs: DefaultDict[int, List[RealmAuditLog]],
-                                   ) -> List[UserMessage]:
-    user_messages_to_insert = []  # type: List[UserMessage]
-
-    def store_user_message_to_insert(message: Message) -> None:
-        message = UserMessage(user_profile=user_profile,
-                              message_id=message['id'], flags=0)
-        user_messages_to_insert.append(message)
-
-    for (stream_id, stream_messages_raw) in all_stream_messages.items():
-        stream_subscription_logs = all_stream_subscription_logs[stream_id]
-        # Make a copy of the original list of messages, which we will
-        # mutate in the loop below.
-        stream_messages = list(stream_messages_raw)
-
-        for log_entry in stream_subscription_logs:
-            # For each stream, we iterate through all of the changes
-            # to the user's subscription to that stream, ordered by
-            # event_last_message_id, to determine whether the user was
-            # subscribed to the target stream at that time.
-            #
-            # For each message, we're looking for the first event for
-            # the user's subscription to the target stream after the
-            # message was sent.
-            # * If it's an unsubscribe, we know the user was subscribed
-            #   when the message was sent, and create a UserMessage
-            # * If it's a subscribe, we know the user was not, and we
-            #   skip the message by mutating the stream_messages list
-            #   to skip that message.
-
-            if len(stream_messages) == 0:
-                # Because stream_messages gets mutated below, this
-                # check belongs in this inner loop, not the outer loop.
-                break
-
-            if log_entry.event_type == RealmAuditLog.SUBSCRIPTION_DEACTIVATED:
-                # If the event shows the user was unsubscribed after
-                # event_last_message_id, we know they must have been
-                # subscribed immediately before the event.
-                for stream_message in stream_messages:
-                    if stream_message['id'] <= log_entry.event_last_message_id:
-                        store_user_message_to_insert(stream_message)
-                    else:
-                        break
-            elif log_entry.event_type in (RealmAuditLog.SUBSCRIPTION_ACTIVATED,
-                                          RealmAuditLog.SUBSCRIPTION_CREATED):
-                initial_msg_count = len(stream_messages)
-                for i, stream_message in enumerate(stream_messages):
-                    if stream_message['id'] > log_entry.event_last_message_id:
-                        stream_messages = stream_messages[i:]
-                        break
-                final_msg_count = len(stream_messages)
-                if initial_msg_count == final_msg_count:
-                    if stream_messages[-1]['id'] <= log_entry.event_last_message_id:
-                        stream_messages = []
-            else:
-                raise AssertionError('%s is not a Subscription Event.' % (log_entry.event_type,))
-
-        if len(stream_messages) > 0:
-            # We do this check for last event since if the last subscription
-            # event was a subscription_deactivated then we don't want to create
-            # UserMessage rows for any of the remaining messages.
-            if stream_subscription_logs[-1].event_type in (
-                    RealmAuditLog.SUBSCRIPTION_ACTIVATED,
-                    RealmAuditLog.SUBSCRIPTION_CREATED):
-                for stream_message in stream_messages:
-                    store_user_message_to_insert(stream_message)
-    return user_messages_to_insert
+
+def get_subscribed_intervals(subscription_logs: List[RealmAuditLog],
+                             after_id: int) -> List[Tuple[int, Optional[int]]]:
+    """Given the changes to a user's subscription to a stream, ordered by
+    event_last_message_id, returns the ranges of message IDs after
+    after_id that the user was subscribed for, as (after, through)
+    pairs, where through is None if the user is still subscribed.
+
+    Each SUBSCRIPTION_DEACTIVATED event means the user was subscribed
+    to the messages up to its event_last_message_id; each
+    SUBSCRIPTION_ACTIVATED or SUBSCRIPTION_CREATED event means the
+    user wasn't subscribed to the messages up to its
+    event_last_message_id, but was to those after it.
+    """
+    intervals = []  # type: List[Tuple[int, Optional[int]]]
+    start = after_id
+    for log_entry in subscription_logs:
+        assert log_entry.event_last_message_id is not None
+        if log_entry.event_type == RealmAuditLog.SUBSCRIPTION_DEACTIVATED:
+            if log_entry.event_last_message_id > start:
+                intervals.append((start, log_entry.event_last_message_id))
+                start = log_entry.event_last_message_id
+        elif log_entry.event_type in (RealmAuditLog.SUBSCRIPTION_ACTIVATED,
+                                      RealmAuditLog.SUBSCRIPTION_CREATED):
+            start = max(start, log_entry.event_last_message_id)
+        else:
+            raise AssertionError('%s is not a Subscription Event.' % (log_entry.event_type,))
+
+    if subscription_logs and subscription_logs[-1].event_type in (
+            RealmAuditLog.SUBSCRIPTION_ACTIVATED,
+            RealmAuditLog.SUBSCRIPTION_CREATED):
+        intervals.append((start, None))
+    return intervals
 
 def add_missing_messages(user_profile: UserProfile) -> None:
     """This function takes a soft-deactivated user, and computes and adds
@@ -97,29 +58,25 @@ def add_missing_messages(user_profile: UserProfile) -> None:
     At a high level, the algorithm is as follows:
 
     * Find all the streams that the user was at any time a subscriber
-      of when or after they were soft-deactivated (`recipient_ids`
-      below).
-
-    * Find all the messages sent to those streams since the user was
-      soft-deactivated.  This will be a superset of the target
-      UserMessages we need to create in two ways: (1) some UserMessage
-      rows will have already been created in do_send_messages because
-      the user had a nonzero set of flags (the fact that we do so in
-      do_send_messages simplifies things considerably, since it means
-      we don't need to inspect message content to look for things like
-      mentions here), and (2) the user might not have been subscribed
-      to all of the streams in recipient_ids for the entire time
-      window.
-
-    * Correct the list from the previous state by excluding those with
-      existing UserMessage rows.
-
-    * Correct the list from the previous state by excluding those
-      where the user wasn't subscribed at the time, using the
+      of, and the changes to their subscription to each of them.
+
+    * From those changes, compute the ranges of message IDs since the
+      user was soft-deactivated that they were subscribed to each
+      stream for (see get_subscribed_intervals), using the
       RealmAuditLog data to determine exactly when the user was
       subscribed/unsubscribed.
 
-    * Create the UserMessage rows.
+    * Create the UserMessage rows for the messages in those ranges,
+      in a single INSERT ... SELECT, excluding those with existing
+      UserMessage rows; some will have already been created in
+      do_send_messages because the user had a nonzero set of flags
+      (the fact that we do so in do_send_messages simplifies things
+      considerably, since it means we don't need to inspect message
+      content to look for things like mentions here).
+
+    The messages are never loaded into Python, so this takes about the
+    same time for a user who was away for a year in a busy realm as
+    for one who missed a handful of messages.
 
     For further documentation, see:
 
@@ -143,8 +100,7 @@ def add_missing_messages(user_profile: UserProfile) -> None:
     # and then unsubscribed without any messages being sent in the
     # meantime.  Without that tiebreak, we could end up incorrectly
     # processing the ordering of those two subscription changes.
-    subscription_logs = list(RealmAuditLog.objects.select_related(
-        'modified_stream').filter(
+    subscription_logs = list(RealmAuditLog.objects.filter(
         modified_user=user_profile,
         modified_stream__id__in=stream_ids,
         event_type__in=events).order_by('event_last_message_id', 'id'))
@@ -153,49 +109,50 @@ def add_missing_messages(user_profile: UserProfile) -> None:
     for log in subscription_logs:
         all_stream_subscription_logs[log.modified_stream_id].append(log)
 
-    recipient_ids = []
+    intervals = []  # type: List[Tuple[int, int, Optional[int]]]
     for sub in all_stream_subs:
-        stream_subscription_logs = all_stream_subscription_logs[sub['recipient__type_id']]
-        if stream_subscription_logs[-1].event_type == RealmAuditLog.SUBSCRIPTION_DEACTIVATED:
-            assert stream_subscription_logs[-1].event_last_message_id is not None
-            if stream_subscription_logs[-1].event_last_message_id <= user_profile.last_active_message_id:
-                # We are going to short circuit this iteration as its no use
-                # iterating since user unsubscribed before soft-deactivation
-                continue
-        recipient_ids.append(sub['recipient_id'])
-
-    all_stream_msgs = list(Message.objects.filter(
-        recipient__id__in=recipient_ids,
-        id__gt=user_profile.last_active_message_id).order_by('id').values(
-        'id', 'recipient__type_id'))
-    already_created_ums = set(UserMessage.objects.filter(
-        user_profile=user_profile,
-        message__recipient__type=Recipient.STREAM,
-        message__id__gt=user_profile.last_active_message_id).values_list('message__id', flat=True))
-
-    # Filter those messages for which UserMessage rows have been already created
-    all_stream_msgs = [msg for msg in all_stream_msgs
-                       if msg['id'] not in already_created_ums]
-
-    stream_messages = defaultdict(list)  # type: DefaultDict[int, List[Message]]
-    for msg in all_stream_msgs:
-        stream_messages[msg['recipient__type_id']].append(msg)
-
-    # Calling this function to filter out stream messages based upon
-    # subscription logs and then store all UserMessage objects for bulk insert
-    # This function does not perform any SQL related task and gets all the data
-    # required for its operation in its params.
-    user_messages_to_insert = filter_by_subscription_history(
-        user_profile, stream_messages, all_stream_subscription_logs)
-
-    # Doing a bulk create for all the UserMessage objects stored for creation.
-    while len(user_messages_to_insert) > 0:
-        messages, user_messages_to_insert = (
-            user_messages_to_insert[0:BULK_CREATE_BATCH_SIZE],
-            user_messages_to_insert[BULK_CREATE_BATCH_SIZE:])
-        UserMessage.objects.bulk_create(messages)
-        user_profile.last_active_message_id = messages[-1].message_id
+        for (after_id, through_id) in get_subscribed_intervals(
+                all_stream_subscription_logs[sub['recipient__type_id']],
+                user_profile.last_active_message_id):
+            intervals.append((sub['recipient_id'], after_id, through_id))
+    if not intervals:
+        return
+
+    # The casts give the columns of the VALUES list a type even when
+    # every through_id is NULL.
+    query = """
+        WITH inserted AS (
+            INSERT INTO zerver_usermessage (user_profile_id, message_id, flags)
+            SELECT %%s, zerver_message.id, 0
+            FROM zerver_message
+            JOIN (VALUES %s) AS intervals (recipient_id, after_id, through_id)
+            ON
+                zerver_message.recipient_id = intervals.recipient_id AND
+                zerver_message.id > intervals.after_id AND
+                (intervals.through_id IS NULL OR zerver_message.id <= intervals.through_id)
+            WHERE NOT EXISTS (
+                SELECT 1 FROM zerver_usermessage
+                WHERE
+                    zerver_usermessage.user_profile_id = %%s AND
+                    zerver_usermessage.message_id = zerver_message.id
+            )
+            RETURNING message_id
+        )
+        SELECT count(*), max(message_id) FROM inserted
+    """ % (", ".join(["(%s::integer, %s::integer, %s::integer)"] * len(intervals)),)
+    params = [user_profile.id]  # type: List[Optional[int]]
+    for interval in intervals:
+        params.extend(interval)
+    params.append(user_profile.id)
+
+    with connection.cursor() as cursor:
+        cursor.execute(query, params)
+        (count, last_message_id) = cursor.fetchone()
+
+    if count > 0:
+        user_profile.last_active_message_id = last_message_id
         user_profile.save(update_fields=['last_active_message_id'])
+    logger.info('Added %s missing messages for user %s' % (count, user_profile.id))
 
 def do_soft_deactivate_user(user_profile: UserProfile) -> None:
     try:
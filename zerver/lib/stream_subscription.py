@@ -1,7 +1,9 @@
 from typing import Any, Dict, List, Tuple
 from mypy_extensions import TypedDict
 
+from django.db.models import F
 from django.db.models.query import QuerySet
+from zerver.lib.cache import cache_with_key, stream_recipient_info_cache_key
 from zerver.models import (
     Recipient,
     Stream,
@@ -39,6 +41,63 @@ def get_stream_subscriptions_for_users(user_profiles: List[UserProfile]) -> Quer
         recipient__type=Recipient.STREAM,
     )
 
+StreamRecipientInfo = TypedDict('StreamRecipientInfo', {
+    'user_ids': List[int],
+    'push_user_ids': List[int],
+    'email_user_ids': List[int],
+})
+
+@cache_with_key(stream_recipient_info_cache_key, timeout=3600*24*7)
+def get_stream_recipient_info(recipient_id: int) -> StreamRecipientInfo:
+    '''
+    Returns the IDs of the active subscribers to a stream (given its
+    recipient ID), and of those of them who get push and email
+    notifications for its messages, ignoring muted topics, as sorted
+    lists.  We need this for every message sent to the stream, so we
+    cache it; the subscription and user-level notification settings
+    it depends on flush it when they change (see flush_subscription).
+    '''
+    subscription_rows = Subscription.objects.filter(
+        recipient_id=recipient_id,
+        active=True,
+    ).annotate(
+        user_profile_email_notifications=F('user_profile__enable_stream_email_notifications'),
+        user_profile_push_notifications=F('user_profile__enable_stream_push_notifications'),
+    ).values(
+        'user_profile_id',
+        'push_notifications',
+        'email_notifications',
+        'user_profile_email_notifications',
+        'user_profile_push_notifications',
+        'is_muted',
+    ).order_by('user_profile_id')
+
+    def should_send(setting: str, row: Dict[str, Any]) -> bool:
+        # This implements the structure that the UserProfile stream notification settings
+        # are defaults, which can be overridden by the stream-level settings (if those
+        # values are not null).
+        if row['is_muted']:
+            return False
+        if row[setting] is not None:
+            return row[setting]
+        return row['user_profile_' + setting]
+
+    return dict(
+        user_ids=[row['user_profile_id'] for row in subscription_rows],
+        # Note: muting a stream overrides stream_push_notify and
+        # stream_email_notify
+        push_user_ids=[
+            row['user_profile_id']
+            for row in subscription_rows
+            if should_send('push_notifications', row)
+        ],
+        email_user_ids=[
+            row['user_profile_id']
+            for row in subscription_rows
+            if should_send('email_notifications', row)
+        ],
+    )
+
 SubInfo = TypedDict('SubInfo', {
     'sub': Subscription,
     'stream': Stream,
@@ -15,6 +15,7 @@ from django.test import runner as django_runner
 from django.test.runner import DiscoverRunner
 from django.test.signals import template_rendered
 
+from analytics.lib import counts
 from zerver.lib import test_classes, test_helpers
 from zerver.lib.cache import bounce_key_prefix_for_testing
 from zerver.lib.rate_limiter import bounce_redis_key_prefix_for_testing
@@ -25,6 +26,7 @@ from zerver.lib.test_helpers import (
     append_instrumentation_data
 )
 
+import mock
 import os
 import time
 import unittest
@@ -115,6 +117,7 @@ def run_test(test: TestCase, result: TestResult) -> bool:
 
     bounce_key_prefix_for_testing(test_name)
     bounce_redis_key_prefix_for_testing(test_name)
+    counts.bounce_redis_key_prefix_for_testing(test_name)
 
     flush_caches_for_testing()
 
@@ -127,7 +130,10 @@ def run_test(test: TestCase, result: TestResult) -> bool:
 
     start_time = time.time()
 
-    test(result)  # unittest will handle skipping, error, failure and success.
+    # Tests run inside a transaction that's rolled back rather than
+    # committed, so we run on_commit callbacks right away.
+    with mock.patch('django.db.transaction.on_commit', lambda func: func()):
+        test(result)  # unittest will handle skipping, error, failure and success.
 
     delay = time.time() - start_time
     enforce_timely_test_completion(test_method, test_name, delay, result)
@@ -1,7 +1,9 @@
 from types import TracebackType
-from typing import Any, Callable, Optional, Tuple, Type, TypeVar
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type, TypeVar
 
 import six
+import os
+import queue
 import sys
 import time
 import ctypes
@@ -88,3 +90,92 @@ def timeout(timeout: float, func: Callable[..., ResultT], *args: Any, **kwargs:
         six.reraise(thread.exc_info[0], thread.exc_info[1], thread.exc_info[2])
     assert thread.result is not None  # assured if above did not reraise
     return thread.result
+
+class TimeoutWorker(threading.Thread):
+    '''A persistent thread that runs the calls made through
+    deadline_call(), one at a time.'''
+
+    def __init__(self) -> None:
+        threading.Thread.__init__(self, name='timeout-worker')
+        self.daemon = True
+        # Calls to make, as (func, args, kwargs); None tells the
+        # thread to exit.
+        self.calls = queue.Queue()  # type: queue.Queue[Optional[Tuple[Callable[..., Any], Tuple[Any, ...], Dict[str, Any]]]]
+        self.done = threading.Event()
+        self.result = None  # type: Any
+        self.exc_info = None  # type: Optional[Tuple[Optional[Type[BaseException]], Optional[BaseException], Optional[TracebackType]]]
+
+    def run(self) -> None:
+        try:
+            while True:
+                call = self.calls.get()
+                if call is None:
+                    return
+                (func, args, kwargs) = call
+                try:
+                    self.result = func(*args, **kwargs)
+                except BaseException:
+                    self.exc_info = sys.exc_info()
+                self.done.set()
+        except TimeoutExpired:
+            # Delivered after the call it was meant for finished;
+            # deadline_call has given up on this thread, so we exit.
+            pass
+
+# Idle TimeoutWorkers, and the process they belong to, since threads
+# don't survive a fork.
+idle_workers = []  # type: List[TimeoutWorker]
+idle_workers_pid = None  # type: Optional[int]
+idle_workers_lock = threading.Lock()
+
+def set_async_exc(thread_ident: int, exc: Type[BaseException]) -> None:
+    tid = ctypes.c_long(thread_ident)
+    result = ctypes.pythonapi.PyThreadState_SetAsyncExc(tid, ctypes.py_object(exc))
+    if result > 1:  # nocoverage
+        # See the comment in timeout().
+        ctypes.pythonapi.PyThreadState_SetAsyncExc(tid, None)
+
+def deadline_call(timeout: float, func: Callable[..., ResultT], *args: Any, **kwargs: Any) -> ResultT:
+    '''Like timeout(), but calls the function in a persistent worker
+    thread, rather than starting a thread for each call.
+
+    As with timeout(), we return or raise within approximately
+    'timeout' seconds (plus at most a second spent trying to interrupt
+    the function), even if the function can't be interrupted, e.g.
+    because it's stuck matching a regular expression or catches
+    TimeoutExpired.  A worker whose call timed out is never reused,
+    since it may still be running, or receive a TimeoutExpired later;
+    it exits once the call returns.  The same caveats as timeout()
+    apply to the function itself.'''
+    global idle_workers_pid
+    with idle_workers_lock:
+        if idle_workers_pid != os.getpid():
+            del idle_workers[:]
+            idle_workers_pid = os.getpid()
+        worker = idle_workers.pop() if idle_workers else None
+    if worker is None:
+        worker = TimeoutWorker()
+        worker.start()
+
+    worker.done.clear()
+    worker.calls.put((func, args, kwargs))
+    if not worker.done.wait(timeout):
+        # As in timeout(), we retry, because an async exception
+        # received while the thread is in a system call is ignored.
+        assert worker.ident is not None
+        for i in range(10):
+            set_async_exc(worker.ident, TimeoutExpired)
+            if worker.done.wait(0.1):
+                break
+        worker.calls.put(None)
+        raise TimeoutExpired
+
+    (result, exc_info) = (worker.result, worker.exc_info)
+    worker.result = worker.exc_info = None
+    with idle_workers_lock:
+        if idle_workers_pid == os.getpid():
+            idle_workers.append(worker)
+
+    if exc_info:
+        six.reraise(exc_info[0], exc_info[1], exc_info[2])
+    return result
@@ -0,0 +1,117 @@
+import logging
+import time
+from argparse import ArgumentParser
+from typing import Any, List, Set, Tuple
+
+from django.db import connection
+from django.db.models import Max
+
+from zerver.lib.management import CommandError, ZulipBaseCommand
+from zerver.lib.message import rerender_stale_messages
+from zerver.lib.parallel import run_parallel
+from zerver.models import Message
+
+class Command(ZulipBaseCommand):
+    help = """Re-render all messages whose rendered_content is from an older
+version of our markdown processor, in parallel.
+
+Otherwise, such messages are re-rendered one at a time when they're
+next fetched, which makes the first fetch of old history slow after an
+upgrade that changes the markdown version.
+
+Messages are processed in chunks of consecutive IDs; the command
+reports the ID below which all messages are done as it goes, so it can
+be resumed from there with --start-id if it's interrupted.
+
+Usage: ./manage.py rerender_messages --processes=6 [--start-id=N] [--sleep=0.5]"""
+
+    def add_arguments(self, parser: ArgumentParser) -> None:
+        parser.add_argument('--start-id',
+                            dest='start_id',
+                            type=int,
+                            default=0,
+                            help='ID of the first message to consider')
+        parser.add_argument('--end-id',
+                            dest='end_id',
+                            type=int,
+                            default=None,
+                            help='ID of the last message to consider (default: the latest)')
+        parser.add_argument('--chunk-size',
+                            dest='chunk_size',
+                            type=int,
+                            default=1000,
+                            help='Number of consecutive message IDs in each chunk')
+        parser.add_argument('--processes',
+                            dest='processes',
+                            type=int,
+                            default=6,
+                            help='Number of processes to re-render chunks in')
+        parser.add_argument('--sleep',
+                            dest='sleep',
+                            type=float,
+                            default=0.0,
+                            help='Seconds for each process to sleep after each chunk, '
+                                 'to limit the load on the database')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        start_id = options['start_id']
+        end_id = options['end_id']
+        if end_id is None:
+            end_id = Message.objects.aggregate(Max('id'))['id__max'] or 0
+        chunk_size = options['chunk_size']
+        if chunk_size < 1 or options['processes'] < 1:
+            raise CommandError("--chunk-size and --processes must be positive")
+
+        chunks = [
+            (chunk_start, min(chunk_start + chunk_size, end_id + 1))
+            for chunk_start in range(start_id, end_id + 1, chunk_size)
+        ]
+        done = set()  # type: Set[int]
+        self.start_time = time.time()
+
+        def rerender_chunk(chunk: Tuple[int, int]) -> int:
+            try:
+                count = rerender_stale_messages(*chunk)
+            except Exception:
+                logging.exception("Failed to re-render messages %s-%s" % (chunk[0], chunk[1] - 1))
+                return 1
+            logging.info("Re-rendered %s messages with IDs %s-%s" % (count, chunk[0], chunk[1] - 1))
+            if options['sleep']:
+                time.sleep(options['sleep'])
+            return 0
+
+        if options['processes'] == 1:
+            for chunk in chunks:
+                if rerender_chunk(chunk) != 0:
+                    self.fail(chunks, done)
+                self.report_progress(chunk, chunks, done)
+        else:
+            # The child processes can't share our database connection.
+            connection.close()
+            for (status, chunk) in run_parallel(rerender_chunk, chunks, options['processes']):
+                if status != 0:
+                    self.fail(chunks, done)
+                self.report_progress(chunk, chunks, done)
+
+    def resume_id(self, chunks: List[Tuple[int, int]], done: Set[int]) -> int:
+        # Chunks can finish out of order; every message before the
+        # first unfinished chunk is done.
+        for (chunk_start, chunk_end) in chunks:
+            if chunk_start not in done:
+                return chunk_start
+        return chunks[-1][1]
+
+    def report_progress(self, chunk: Tuple[int, int], chunks: List[Tuple[int, int]],
+                        done: Set[int]) -> None:
+        done.add(chunk[0])
+        elapsed = time.time() - self.start_time
+        ids_done = sum(chunk_end - chunk_start for (chunk_start, chunk_end) in chunks
+                       if chunk_start in done)
+        self.stdout.write("%d/%d chunks done (%.0f message IDs/second); "
+                          "all messages before ID %d are done" % (
+                              len(done), len(chunks), ids_done / max(elapsed, 0.001),
+                              self.resume_id(chunks, done)))
+
+    def fail(self, chunks: List[Tuple[int, int]], done: Set[int]) -> None:
+        raise CommandError("Re-rendering failed; resume with --start-id=%d" % (
+            self.resume_id(chunks, done),))
@@ -25,6 +25,7 @@ from zerver.tornado.application import create_tornado_application, \
 from zerver.tornado.autoreload import start as zulip_autoreload_start
 from zerver.tornado.event_queue import add_client_gc_hook, \
     missedmessage_hook, process_notification, setup_event_queue
+from zerver.tornado.notify_socket import setup_notify_socket
 from zerver.tornado.sharding import notify_tornado_queue_name, tornado_return_queue_name
 from zerver.tornado.socket import respond_send_message
 
@@ -95,6 +96,10 @@ class Command(BaseCommand):
                                                     process_notification)
                 queue_client.register_json_consumer(tornado_return_queue_name(int(port)),
                                                     respond_send_message)
+            if settings.USING_TORNADO_NOTIFY_SOCKET:
+                # Process notifications sent directly by Django processes
+                # on this host; RabbitMQ is their fallback.
+                setup_notify_socket(int(port), process_notification)
 
             try:
                 # Application is an instance of Django's standard wsgi handler.
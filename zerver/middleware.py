@@ -19,7 +19,8 @@ from django.utils.translation import ugettext as _
 from django.views.csrf import csrf_failure as html_csrf_failure
 
 from zerver.lib.bugdown import get_bugdown_requests, get_bugdown_time
-from zerver.lib.cache import get_remote_cache_requests, get_remote_cache_time
+from zerver.lib.cache import check_local_cache_generation, get_local_cache_hits, \
+    get_remote_cache_requests, get_remote_cache_time
 from zerver.lib.debug import maybe_tracemalloc_listen
 from zerver.lib.db import reset_queries
 from zerver.lib.exceptions import ErrorCode, JsonableError, RateLimited
@@ -37,6 +38,7 @@ def record_request_stop_data(log_data: MutableMapping[str, Any]) -> None:
     log_data['time_stopped'] = time.time()
     log_data['remote_cache_time_stopped'] = get_remote_cache_time()
     log_data['remote_cache_requests_stopped'] = get_remote_cache_requests()
+    log_data['local_cache_hits_stopped'] = get_local_cache_hits()
     log_data['bugdown_time_stopped'] = get_bugdown_time()
     log_data['bugdown_requests_stopped'] = get_bugdown_requests()
     if settings.PROFILE_ALL_REQUESTS:
@@ -51,6 +53,7 @@ def record_request_restart_data(log_data: MutableMapping[str, Any]) -> None:
     log_data['time_restarted'] = time.time()
     log_data['remote_cache_time_restarted'] = get_remote_cache_time()
     log_data['remote_cache_requests_restarted'] = get_remote_cache_requests()
+    log_data['local_cache_hits_restarted'] = get_local_cache_hits()
     log_data['bugdown_time_restarted'] = get_bugdown_time()
     log_data['bugdown_requests_restarted'] = get_bugdown_requests()
 
@@ -70,6 +73,7 @@ def record_request_start_data(log_data: MutableMapping[str, Any]) -> None:
     log_data['time_started'] = time.time()
     log_data['remote_cache_time_start'] = get_remote_cache_time()
     log_data['remote_cache_requests_start'] = get_remote_cache_requests()
+    log_data['local_cache_hits_start'] = get_local_cache_hits()
     log_data['bugdown_time_start'] = get_bugdown_time()
     log_data['bugdown_requests_start'] = get_bugdown_requests()
 
@@ -141,20 +145,26 @@ def write_log_line(log_data: MutableMapping[str, Any], path: str, method: str, r
     if 'remote_cache_time_start' in log_data:
         remote_cache_time_delta = get_remote_cache_time() - log_data['remote_cache_time_start']
         remote_cache_count_delta = get_remote_cache_requests() - log_data['remote_cache_requests_start']
+        local_cache_hits_delta = get_local_cache_hits() - log_data['local_cache_hits_start']
         if 'remote_cache_requests_stopped' in log_data:
             # (now - restarted) + (stopped - start) = (now - start) + (stopped - restarted)
             remote_cache_time_delta += (log_data['remote_cache_time_stopped'] -
                                         log_data['remote_cache_time_restarted'])
             remote_cache_count_delta += (log_data['remote_cache_requests_stopped'] -
                                          log_data['remote_cache_requests_restarted'])
+            local_cache_hits_delta += (log_data['local_cache_hits_stopped'] -
+                                       log_data['local_cache_hits_restarted'])
 
         if (remote_cache_time_delta > 0.005):
             remote_cache_output = " (mem: %s/%s)" % (format_timedelta(remote_cache_time_delta),
                                                      remote_cache_count_delta)
+        if local_cache_hits_delta > 0:
+            remote_cache_output += " (local: %s)" % (local_cache_hits_delta,)
 
         if not suppress_statsd:
             statsd.timing("%s.remote_cache.time" % (statsd_path,), timedelta_ms(remote_cache_time_delta))
             statsd.incr("%s.remote_cache.querycount" % (statsd_path,), remote_cache_count_delta)
+            statsd.incr("%s.local_cache.hitcount" % (statsd_path,), local_cache_hits_delta)
 
     startup_output = ""
     if 'startup_time_delta' in log_data and log_data["startup_time_delta"] > 0.005:
@@ -349,6 +359,11 @@ class RateLimitMiddleware(MiddlewareMixin):
         return None
 
 class FlushDisplayRecipientCache(MiddlewareMixin):
+    def process_request(self, request: HttpRequest) -> None:
+        # Values in the local cache may have been changed by other
+        # processes since the last request.
+        check_local_cache_generation()
+
     def process_response(self, request: HttpRequest, response: HttpResponse) -> HttpResponse:
         # We flush the per-request caches after every request, so they
         # are not shared at all between requests.
@@ -21,6 +21,7 @@ from zerver.lib.user_groups import create_user_group
 from zerver.lib.test_classes import (
     ZulipTestCase,
 )
+from zerver.lib.test_helpers import queries_captured
 from zerver.lib.test_runner import slow
 from zerver.lib import mdiff
 from zerver.lib.tex import render_tex
@@ -242,6 +243,73 @@ class BugdownMiscTest(ZulipTestCase):
         assert(user is not None)
         self.assertEqual(user['email'], hamlet.email)
 
+    def test_batch_mention_data(self) -> None:
+        realm = get_realm('zulip')
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        self.create_user_group_for_test('support')
+        contents = ['@**King Hamlet** @*support*', '@**Cordelia lear**', 'no mentions']
+        batch_mention_data = bugdown.MentionData.for_batch(realm.id, contents)
+        self.assertEqual(batch_mention_data.get_user_ids(), {hamlet.id, cordelia.id})
+
+        # The data for each message is picked out of the batch's data
+        # without any further queries, and matches what we'd fetch for
+        # that message alone.
+        with queries_captured() as queries:
+            mention_datas = [
+                bugdown.MentionData(realm.id, content, batch_mention_data=batch_mention_data)
+                for content in contents
+            ]
+        self.assert_length(queries, 0)
+        for (content, mention_data) in zip(contents, mention_datas):
+            expected = bugdown.MentionData(realm.id, content)
+            self.assertEqual(mention_data.user_id_info, expected.user_id_info)
+            self.assertEqual(mention_data.full_name_info, expected.full_name_info)
+            self.assertEqual(mention_data.user_group_name_info, expected.user_group_name_info)
+            self.assertEqual(dict(mention_data.user_group_members),
+                             dict(expected.user_group_members))
+
+    def test_convert_many(self) -> None:
+        realm = get_realm('zulip')
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        contents = [
+            '@**King Hamlet** see #**Denmark**',
+            '@**Cordelia Lear** :green_tick:',
+            'hello !avatar(%s)' % (cordelia.email,),
+        ]
+
+        def make_messages() -> List[Message]:
+            messages = []
+            for content in contents:
+                message = Message(sender=hamlet, sending_client=get_client("test"))
+                message.mentions_wildcard = False
+                message.mentions_user_ids = set()
+                message.mentions_user_group_ids = set()
+                message.alert_words = set()
+                message.links_for_preview = set()
+                message.user_ids_with_alert_words = set()
+                messages.append(message)
+            return messages
+
+        messages = make_messages()
+        with queries_captured() as queries:
+            expected = [
+                bugdown.convert(content, message=message, message_realm=realm)
+                for (content, message) in zip(contents, messages)
+            ]
+        separate_queries = len(queries)
+
+        messages = make_messages()
+        with queries_captured() as queries:
+            rendered = bugdown.convert_many(contents, realm, messages,
+                                            sent_by_bot=[False] * 3,
+                                            translate_emoticons=[False] * 3)
+        self.assertEqual(rendered, expected)
+        self.assertLess(len(queries), separate_queries)
+        self.assertEqual([message.mentions_user_ids for message in messages],
+                         [{hamlet.id}, {cordelia.id}, set()])
+
     def test_invalid_katex_path(self) -> None:
         with self.settings(DEPLOY_ROOT="/nonexistent"):
             with mock.patch('logging.error') as mock_logger:
@@ -886,6 +954,69 @@ class BugdownTest(ZulipTestCase):
         self.assertEqual(zulip_filters[0],
                          (u'#(?P<id>[0-9]{2,8})', u'https://trac.zulip.net/ticket/%(id)s', realm_filter.id))
 
+    def test_markdown_engine_pool(self) -> None:
+        realm = get_realm('zulip')
+        other_realm = Realm.objects.create(string_id='engine_pool_test')
+        RealmFilter.objects.create(realm=realm,
+                                   pattern=r"#(?P<id>[0-9]{2,8})",
+                                   url_format_string=r"https://trac.zulip.net/ticket/%(id)s")
+        msg = "We should fix #224"
+        linked = '<p>We should fix <a href="https://trac.zulip.net/ticket/224" target="_blank" title="https://trac.zulip.net/ticket/224">#224</a></p>'
+        unlinked = '<p>We should fix #224</p>'
+
+        # With room for only one engine, each realm takes over the
+        # other's engine, with its own realm filters swapped in.
+        pool = bugdown.MarkdownEnginePool(1)
+        with mock.patch('zerver.lib.bugdown.md_engines', pool):
+            self.assertEqual(bugdown.convert(msg, message_realm=realm), linked)
+            self.assertEqual(bugdown.convert(msg, message_realm=other_realm), unlinked)
+            self.assertEqual(bugdown.convert(msg, message_realm=realm), linked)
+            self.assertEqual(bugdown.convert(msg, message_realm=realm), linked)
+        self.assertEqual(pool.stats(), dict(size=1, max_size=1, hits=1, misses=3,
+                                            evictions=2, builds=1))
+
+        # An email gateway engine can't take over a normal one.
+        pool = bugdown.MarkdownEnginePool(1)
+        with mock.patch('zerver.lib.bugdown.md_engines', pool):
+            self.assertEqual(bugdown.convert(msg, message_realm=realm), linked)
+            self.assertEqual(bugdown.convert(msg, message_realm=realm, email_gateway=True), linked)
+        self.assertEqual(pool.stats(), dict(size=1, max_size=1, hits=0, misses=2,
+                                            evictions=1, builds=2))
+
+    @override_settings(BUGDOWN_RENDER_CACHE_SIZE=2)
+    def test_render_cache(self) -> None:
+        realm = get_realm('zulip')
+        sender = self.example_user('othello')
+
+        def render(content: str) -> str:
+            msg = Message(sender=sender, sending_client=get_client("test"))
+            return render_markdown(msg, content)
+
+        content = 'Build #224 **passed**: https://ci.example.com/builds/224'
+        render_cache = bugdown.RenderCache()
+        with mock.patch('zerver.lib.bugdown.render_cache', render_cache):
+            rendered = render(content)
+            self.assertEqual(render(content), rendered)
+            self.assertEqual(render_cache.stats(),
+                             dict(size=1, hits=1, misses=1, evictions=0))
+
+            # Content that might mention users isn't cached.
+            render('Build #224 failed @**Cordelia Lear**')
+            self.assertEqual(render_cache.stats(),
+                             dict(size=1, hits=1, misses=1, evictions=0))
+
+            # Changing the realm's filters changes the rendering.
+            RealmFilter.objects.create(realm=realm,
+                                       pattern=r"#(?P<id>[0-9]{2,8})",
+                                       url_format_string=r"https://ci.example.com/builds/%(id)s")
+            self.assertNotEqual(render(content), rendered)
+            self.assertEqual(render_cache.stats(),
+                             dict(size=2, hits=1, misses=2, evictions=0))
+
+            render('Build #225 **passed**: https://ci.example.com/builds/225')
+            self.assertEqual(render_cache.stats(),
+                             dict(size=2, hits=1, misses=3, evictions=1))
+
     def test_flush_realm_filter(self) -> None:
         realm = get_realm('zulip')
 
@@ -1723,7 +1854,7 @@ class BugdownErrorTests(ZulipTestCase):
         throws an exception"""
         msg = u'mock rendered message\n' * MAX_MESSAGE_LENGTH
 
-        with mock.patch('zerver.lib.bugdown.timeout', return_value=msg), \
+        with mock.patch('zerver.lib.bugdown.deadline_call', return_value=msg), \
                 mock.patch('zerver.lib.bugdown.bugdown_logger'):
             with self.assertRaises(BugdownRenderingException):
                 bugdown_convert(msg)
@@ -1,7 +1,18 @@
+import time
+
+from django.core.cache import cache as djcache
+from django.test import override_settings
 from mock import Mock, patch
 
 from zerver.apps import flush_cache
+from zerver.lib import cache
+from zerver.lib.actions import do_add_realm_filter
+from zerver.lib.cache import LOCAL_CACHE_GENERATION_KEY, LOCAL_CACHE_MAX_GENERATIONS_BEHIND, \
+    LocalCache, check_local_cache_generation, get_remote_cache_requests, local_cache
 from zerver.lib.test_classes import ZulipTestCase
+from zerver.lib.test_helpers import queries_captured
+from zerver.models import RealmFilter, get_realm, get_realm_filters_cache_key, \
+    realm_filters_for_realm_remote_cache
 
 class AppsTest(ZulipTestCase):
     def test_cache_gets_flushed(self) -> None:
@@ -11,3 +22,85 @@ class AppsTest(ZulipTestCase):
                 flush_cache(Mock())
                 mock.assert_called_once()
             mock_logging.assert_called_once()
+
+class LocalCacheTest(ZulipTestCase):
+    @override_settings(LOCAL_CACHE_SIZE=2, LOCAL_CACHE_TIMEOUT=30)
+    def test_local_cache(self) -> None:
+        realm = get_realm('zulip')
+        check_local_cache_generation()
+
+        realm_filters_for_realm_remote_cache(realm.id)
+        remote_cache_requests = get_remote_cache_requests()
+        with queries_captured() as queries:
+            filters = realm_filters_for_realm_remote_cache(realm.id)
+        self.assert_length(queries, 0)
+        self.assertEqual(get_remote_cache_requests(), remote_cache_requests)
+
+        # Callers get their own copies.
+        filters.append(('#(?P<id>[0-9]+)', 'https://example.com/%(id)s', 0))
+        self.assertEqual(len(realm_filters_for_realm_remote_cache(realm.id)), len(filters) - 1)
+
+        # Flushes in this process take effect immediately...
+        filter_id = do_add_realm_filter(realm, '#(?P<id>[0-9]+)', 'https://example.com/%(id)s')
+        self.assertIn(('#(?P<id>[0-9]+)', 'https://example.com/%(id)s', filter_id),
+                      realm_filters_for_realm_remote_cache(realm.id))
+
+        # ... and those in other processes from the next request.
+        RealmFilter.objects.filter(id=filter_id).update(url_format_string='https://other.example.com/%(id)s')
+        djcache.delete(cache.KEY_PREFIX + get_realm_filters_cache_key(realm.id))
+        djcache.incr(cache.KEY_PREFIX + LOCAL_CACHE_GENERATION_KEY)
+        self.assertIn(('#(?P<id>[0-9]+)', 'https://example.com/%(id)s', filter_id),
+                      realm_filters_for_realm_remote_cache(realm.id))
+        check_local_cache_generation()
+        self.assertIn(('#(?P<id>[0-9]+)', 'https://other.example.com/%(id)s', filter_id),
+                      realm_filters_for_realm_remote_cache(realm.id))
+
+        # Entries expire.
+        remote_cache_requests = get_remote_cache_requests()
+        with patch('zerver.lib.cache.time.time', return_value=time.time() + 31):
+            realm_filters_for_realm_remote_cache(realm.id)
+        self.assertEqual(get_remote_cache_requests(), remote_cache_requests + 1)
+
+        # The cache is bounded.
+        realm_filters_for_realm_remote_cache(get_realm('zephyr').id)
+        realm_filters_for_realm_remote_cache(get_realm('lear').id)
+        self.assertEqual(local_cache.stats()['size'], 2)
+        self.assertNotIn(get_realm_filters_cache_key(realm.id), local_cache.entries)
+
+    @override_settings(LOCAL_CACHE_SIZE=10, LOCAL_CACHE_TIMEOUT=30)
+    def test_local_cache_unrelated_flushes(self) -> None:
+        zulip = get_realm('zulip')
+        lear = get_realm('lear')
+        check_local_cache_generation()
+        realm_filters_for_realm_remote_cache(zulip.id)
+        realm_filters_for_realm_remote_cache(lear.id)
+
+        # Other processes flushing other realms' keys, concurrently
+        # with each other, only drop those keys from our local cache.
+        other_processes = [LocalCache(), LocalCache()]
+        for (i, realm_id) in enumerate([get_realm('zephyr').id, lear.id, 1000, 1001]):
+            key = get_realm_filters_cache_key(realm_id)
+            djcache.delete(cache.KEY_PREFIX + key)
+            other_processes[i % 2].bump_generation([key])
+        check_local_cache_generation()
+        self.assertIn(get_realm_filters_cache_key(zulip.id), local_cache.entries)
+        self.assertNotIn(get_realm_filters_cache_key(lear.id), local_cache.entries)
+
+        remote_cache_requests = get_remote_cache_requests()
+        with queries_captured() as queries:
+            realm_filters_for_realm_remote_cache(zulip.id)
+        self.assert_length(queries, 0)
+        self.assertEqual(get_remote_cache_requests(), remote_cache_requests)
+
+        # If we can't tell which keys were flushed, we drop everything.
+        for i in range(LOCAL_CACHE_MAX_GENERATIONS_BEHIND + 1):
+            other_processes[0].bump_generation([get_realm_filters_cache_key(lear.id)])
+        check_local_cache_generation()
+        self.assertEqual(local_cache.stats()['size'], 0)
+
+    def test_local_cache_disabled(self) -> None:
+        realm = get_realm('zulip')
+        realm_filters_for_realm_remote_cache(realm.id)
+        remote_cache_requests = get_remote_cache_requests()
+        realm_filters_for_realm_remote_cache(realm.id)
+        self.assertEqual(get_remote_cache_requests(), remote_cache_requests + 1)
@@ -3,15 +3,15 @@
 import datetime
 import mock
 import time
-from typing import List
+from typing import List, Set
 
 from django.test import override_settings
 from django.utils.timezone import now as timezone_now
 
 from confirmation.models import one_click_unsubscribe_link
 from zerver.lib.actions import create_stream_if_needed, do_create_user
-from zerver.lib.digest import gather_new_streams, handle_digest_email, enqueue_emails, \
-    exclude_subscription_modified_streams
+from zerver.lib.digest import DIGEST_BATCH_SIZE, gather_new_streams, handle_digest_email, \
+    handle_digest_emails, enqueue_emails, exclude_subscription_modified_streams
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import queries_captured
 from zerver.models import get_client, get_realm, flush_per_request_caches, \
@@ -47,7 +47,7 @@ class TestDigestEmailMessages(ZulipTestCase):
         with queries_captured() as queries:
             handle_digest_email(othello.id, cutoff)
 
-        self.assert_length(queries, 6)
+        self.assert_length(queries, 7)
 
         self.assertEqual(mock_send_future_email.call_count, 1)
         kwargs = mock_send_future_email.call_args[1]
@@ -66,6 +66,43 @@ class TestDigestEmailMessages(ZulipTestCase):
         self.assertIn('some content', teaser_messages[0]['content'][0]['plain'])
         self.assertIn(teaser_messages[0]['sender'], expected_participants)
 
+    @mock.patch('zerver.lib.digest.enough_traffic')
+    @mock.patch('zerver.lib.digest.send_future_email')
+    def test_batch_of_users(self,
+                            mock_send_future_email: mock.MagicMock,
+                            mock_enough_traffic: mock.MagicMock) -> None:
+        othello = self.example_user('othello')
+        cordelia = self.example_user('cordelia')
+        self.subscribe(othello, 'Verona')
+        self.subscribe(cordelia, 'Verona')
+        self.subscribe(cordelia, 'Digest stream')
+
+        one_day_ago = timezone_now() - datetime.timedelta(days=1)
+        Message.objects.all().update(pub_date=one_day_ago)
+        one_hour_ago = timezone_now() - datetime.timedelta(seconds=3600)
+        cutoff = time.mktime(one_hour_ago.timetuple())
+
+        senders = ['hamlet', 'iago', 'prospero']
+        self.simulate_stream_conversation('Verona', senders)
+        self.simulate_stream_conversation('Digest stream', senders)
+
+        handle_digest_emails([othello.id, cordelia.id], cutoff)
+        self.assertEqual(mock_send_future_email.call_count, 2)
+        hot_conversations = {
+            call[1]['to_user_ids'][0]: call[1]['context']['hot_conversations']
+            for call in mock_send_future_email.call_args_list
+        }
+        self.assertEqual(len(hot_conversations[othello.id]), 1)
+        self.assertEqual(len(hot_conversations[cordelia.id]), 2)
+
+        # A failure for one user doesn't stop the rest of the batch.
+        mock_send_future_email.reset_mock()
+        mock_send_future_email.side_effect = [Exception("failed"), None]
+        with mock.patch('zerver.lib.digest.logger.exception') as mock_logger:
+            handle_digest_emails([othello.id, cordelia.id], cutoff)
+        self.assertEqual(mock_send_future_email.call_count, 2)
+        mock_logger.assert_called_once()
+
     @mock.patch('zerver.lib.digest.enough_traffic')
     @mock.patch('zerver.lib.digest.send_future_email')
     def test_soft_deactivated_user_multiple_stream_senders(self,
@@ -155,11 +192,11 @@ class TestDigestEmailMessages(ZulipTestCase):
         self.assertIn(stream_ids['Scotland'], filtered_stream_ids)
         self.assertIn(stream_ids['Denmark'], filtered_stream_ids)
 
-    @mock.patch('zerver.lib.digest.queue_digest_recipient')
+    @mock.patch('zerver.lib.digest.queue_digest_recipients')
     @mock.patch('zerver.lib.digest.timezone_now')
     @override_settings(SEND_DIGEST_EMAILS=True)
     def test_inactive_users_queued_for_digest(self, mock_django_timezone: mock.MagicMock,
-                                              mock_queue_digest_recipient: mock.MagicMock) -> None:
+                                              mock_queue_digest_recipients: mock.MagicMock) -> None:
         # Turn on realm digest emails for all realms
         Realm.objects.update(digest_emails_enabled=True)
         cutoff = timezone_now()
@@ -170,8 +207,9 @@ class TestDigestEmailMessages(ZulipTestCase):
         # Check that all users without an a UserActivity entry are considered
         # inactive users and get enqueued.
         enqueue_emails(cutoff)
-        self.assertEqual(mock_queue_digest_recipient.call_count, all_user_profiles.count())
-        mock_queue_digest_recipient.reset_mock()
+        self.assertEqual(self.queued_user_ids(mock_queue_digest_recipients),
+                         set(all_user_profiles.values_list('id', flat=True)))
+        mock_queue_digest_recipients.reset_mock()
         for realm in Realm.objects.filter(deactivated=False, digest_emails_enabled=True):
             user_profiles = all_user_profiles.filter(realm=realm)
             for user_profile in user_profiles:
@@ -182,17 +220,26 @@ class TestDigestEmailMessages(ZulipTestCase):
                     client=get_client('test_client'))
         # Check that inactive users are enqueued
         enqueue_emails(cutoff)
-        self.assertEqual(mock_queue_digest_recipient.call_count, all_user_profiles.count())
-
-    @mock.patch('zerver.lib.digest.queue_digest_recipient')
+        self.assertEqual(self.queued_user_ids(mock_queue_digest_recipients),
+                         set(all_user_profiles.values_list('id', flat=True)))
+
+    def queued_user_ids(self, mock_queue_digest_recipients: mock.MagicMock) -> Set[int]:
+        user_ids = set()  # type: Set[int]
+        for args in mock_queue_digest_recipients.call_args_list:
+            batch = args[0][0]
+            self.assertLessEqual(len(batch), DIGEST_BATCH_SIZE)
+            user_ids.update(batch)
+        return user_ids
+
+    @mock.patch('zerver.lib.digest.queue_digest_recipients')
     @mock.patch('zerver.lib.digest.timezone_now')
     def test_disabled(self, mock_django_timezone: mock.MagicMock,
-                      mock_queue_digest_recipient: mock.MagicMock) -> None:
+                      mock_queue_digest_recipients: mock.MagicMock) -> None:
         cutoff = timezone_now()
         # A Tuesday
         mock_django_timezone.return_value = datetime.datetime(year=2016, month=1, day=5)
         enqueue_emails(cutoff)
-        mock_queue_digest_recipient.assert_not_called()
+        mock_queue_digest_recipients.assert_not_called()
 
     @mock.patch('zerver.lib.digest.enough_traffic', return_value=True)
     @mock.patch('zerver.lib.digest.timezone_now')
@@ -214,28 +261,28 @@ class TestDigestEmailMessages(ZulipTestCase):
                     count=0,
                     client=get_client('test_client'))
         # Check that an active user is not enqueued
-        with mock.patch('zerver.lib.digest.queue_digest_recipient') as mock_queue_digest_recipient:
+        with mock.patch('zerver.lib.digest.queue_digest_recipients') as mock_queue_digest_recipients:
             enqueue_emails(cutoff)
-            self.assertEqual(mock_queue_digest_recipient.call_count, 0)
+            self.assertEqual(mock_queue_digest_recipients.call_count, 0)
 
-    @mock.patch('zerver.lib.digest.queue_digest_recipient')
+    @mock.patch('zerver.lib.digest.queue_digest_recipients')
     @mock.patch('zerver.lib.digest.timezone_now')
     @override_settings(SEND_DIGEST_EMAILS=True)
     def test_only_enqueue_on_valid_day(self, mock_django_timezone: mock.MagicMock,
-                                       mock_queue_digest_recipient: mock.MagicMock) -> None:
+                                       mock_queue_digest_recipients: mock.MagicMock) -> None:
         # Not a Tuesday
         mock_django_timezone.return_value = datetime.datetime(year=2016, month=1, day=6)
 
         # Check that digests are not sent on days other than Tuesday.
         cutoff = timezone_now()
         enqueue_emails(cutoff)
-        self.assertEqual(mock_queue_digest_recipient.call_count, 0)
+        self.assertEqual(mock_queue_digest_recipients.call_count, 0)
 
-    @mock.patch('zerver.lib.digest.queue_digest_recipient')
+    @mock.patch('zerver.lib.digest.queue_digest_recipients')
     @mock.patch('zerver.lib.digest.timezone_now')
     @override_settings(SEND_DIGEST_EMAILS=True)
     def test_no_email_digest_for_bots(self, mock_django_timezone: mock.MagicMock,
-                                      mock_queue_digest_recipient: mock.MagicMock) -> None:
+                                      mock_queue_digest_recipients: mock.MagicMock) -> None:
         # Turn on realm digest emails for all realms
         Realm.objects.update(digest_emails_enabled=True)
         cutoff = timezone_now()
@@ -251,9 +298,7 @@ class TestDigestEmailMessages(ZulipTestCase):
 
         # Check that bots are not sent emails
         enqueue_emails(cutoff)
-        for arg in mock_queue_digest_recipient.call_args_list:
-            user = arg[0][0]
-            self.assertNotEqual(user.id, bot.id)
+        self.assertNotIn(bot.id, self.queued_user_ids(mock_queue_digest_recipients))
 
     @mock.patch('zerver.lib.digest.timezone_now')
     @override_settings(SEND_DIGEST_EMAILS=True)
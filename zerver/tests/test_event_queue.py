@@ -1,17 +1,31 @@
 import mock
+import socket
+import struct
+import tempfile
 import time
 import ujson
 
 from django.http import HttpRequest, HttpResponse
 from typing import Any, Callable, Dict, Tuple
 
+from scripts.lib.zulip_tools import get_or_create_dev_uuid_var_path
 from zerver.lib.actions import do_mute_topic, do_change_subscription_property
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import POSTRequestMock
-from zerver.models import Recipient, Stream, Subscription, UserProfile, get_stream
+from zerver.models import Recipient, Stream, Subscription, UserProfile, get_realm, \
+    get_stream
+from zerver.tornado import event_queue
 from zerver.tornado.event_queue import maybe_enqueue_notifications, \
-    allocate_client_descriptor, \
-    get_client_descriptor, missedmessage_hook, persistent_queue_filename
+    allocate_client_descriptor, clear_client_event_queues_for_testing, \
+    dump_event_queues, fetch_events, gc_event_queues, get_client_descriptor, \
+    get_client_descriptors_for_user, load_event_queue_batch, load_event_queues, \
+    missedmessage_hook, persistent_queue_filename, process_notification, \
+    send_events, snapshot_event_queues, ClientDescriptor
+from zerver.tornado.exceptions import BadEventQueueIdError
+from zerver.tornado.notify_socket import encode_notice_batch, notify_socket_path, \
+    send_notices_via_socket, FRAME_HEADER_FORMAT, FRAME_HEADER_SIZE
+from zerver.tornado.sharding import get_hashed_shard_index, get_tornado_port, \
+    get_tornado_uri, murmur_hash2, notify_tornado_queue_name
 from zerver.tornado.views import get_events
 
 class MissedMessageNotificationsTest(ZulipTestCase):
@@ -341,3 +355,247 @@ class FileReloadLogicTest(ZulipTestCase):
                              "/home/zulip/tornado/event_queues.9993.json")
             self.assertEqual(persistent_queue_filename(9993, last=True),
                              "/home/zulip/tornado/event_queues.9993.last.json")
+
+    def allocate_queue(self, user_profile: UserProfile) -> ClientDescriptor:
+        return allocate_client_descriptor(dict(
+            all_public_streams=False,
+            apply_markdown=True,
+            client_gravatar=True,
+            client_type_name='website',
+            event_types=None,
+            last_connection_time=time.time(),
+            queue_timeout=0,
+            realm_id=user_profile.realm_id,
+            user_profile_id=user_profile.id,
+        ))
+
+    def test_dump_and_load_event_queues(self) -> None:
+        hamlet = self.example_user('hamlet')
+        othello = self.example_user('othello')
+        clear_client_event_queues_for_testing()
+        client = self.allocate_queue(hamlet)
+        queue_id = client.event_queue.id
+        client.add_event(dict(type='unknown'))
+        othello_queue_id = self.allocate_queue(othello).event_queue.id
+
+        output_dir = tempfile.mkdtemp(dir=get_or_create_dev_uuid_var_path('test-backend'))
+        with self.settings(JSON_PERSISTENT_QUEUE_FILENAME_PATTERN=output_dir + "/event_queues%s.json"):
+            dump_event_queues(9993)
+            clear_client_event_queues_for_testing()
+
+            # Queues are read from disk, but only deserialized when
+            # needed, or in the background.
+            load_event_queues(9993)
+            self.assertEqual(len(event_queue.clients), 0)
+            self.assertIn(queue_id, event_queue.unloaded_clients)
+
+            # A notification loads just the queues it is for, and is
+            # delivered right away.
+            process_notification(dict(event=dict(type='unknown'), users=[hamlet.id]))
+            self.assertEqual(list(event_queue.clients.keys()), [queue_id])
+            self.assertIn(othello_queue_id, event_queue.unloaded_clients)
+
+            client = get_client_descriptor(queue_id)
+            self.assertEqual(client.user_profile_id, hamlet.id)
+            self.assertEqual(get_client_descriptors_for_user(hamlet.id), [client])
+            self.assertEqual([event['id'] for event in client.event_queue.contents()], [0, 1])
+            self.assertIsNone(client.event_queue.snapshot_next_event_id)
+
+            with mock.patch('zerver.tornado.event_queue.send_restart_events'):
+                load_event_queue_batch(9993, time.time())
+            self.assertEqual(len(event_queue.unloaded_clients), 0)
+            self.assertEqual(get_client_descriptor(othello_queue_id).user_profile_id, othello.id)
+
+    def test_load_event_queues_from_snapshot(self) -> None:
+        hamlet = self.example_user('hamlet')
+        clear_client_event_queues_for_testing()
+        client = self.allocate_queue(hamlet)
+        queue_id = client.event_queue.id
+        client.add_event(dict(type='unknown'))
+
+        output_dir = tempfile.mkdtemp(dir=get_or_create_dev_uuid_var_path('test-backend'))
+        with self.settings(JSON_PERSISTENT_QUEUE_FILENAME_PATTERN=output_dir + "/event_queues%s.json"):
+            snapshot_event_queues(9993)
+            # Events pushed after the snapshot are lost in a crash
+            client.add_event(dict(type='unknown'))
+            clear_client_event_queues_for_testing()
+
+            load_event_queues(9993)
+            with mock.patch('zerver.tornado.event_queue.send_restart_events'):
+                load_event_queue_batch(9993, time.time())
+            client = get_client_descriptor(queue_id)
+            self.assertEqual(client.event_queue.snapshot_next_event_id, 1)
+
+            # That survives a clean restart.
+            dump_event_queues(9993)
+            clear_client_event_queues_for_testing()
+            load_event_queues(9993)
+            client = get_client_descriptor(queue_id)
+            self.assertEqual(client.event_queue.snapshot_next_event_id, 1)
+
+        def fetch(last_event_id: int) -> Dict[str, Any]:
+            query = dict(queue_id=queue_id, dont_block=True, last_event_id=last_event_id,
+                         user_profile_id=hamlet.id, user_profile_email=hamlet.email,
+                         client_type_name='website', handler_id=1)
+            return fetch_events(query)
+
+        # A client that saw the lost event has to re-register.
+        result = fetch(1)
+        self.assertEqual(result['type'], 'error')
+        self.assertIsInstance(result['exception'], BadEventQueueIdError)
+
+        # One that didn't can keep using the queue.
+        result = fetch(0)
+        self.assertEqual(result['type'], 'response')
+        self.assertIsNone(client.event_queue.snapshot_next_event_id)
+        client.add_event(dict(type='unknown'))
+        result = fetch(0)
+        self.assertEqual(result['type'], 'response')
+        self.assertEqual([event['id'] for event in result['response']['events']], [1])
+
+class TornadoShardingTest(ZulipTestCase):
+    def test_murmur_hash2(self) -> None:
+        # Reference values computed with nginx's ngx_murmur_hash2.
+        self.assertEqual(murmur_hash2(b"a"), 2456313694)
+        self.assertEqual(murmur_hash2(b"ab"), 446775395)
+        self.assertEqual(murmur_hash2(b"abc"), 324500635)
+        self.assertEqual(murmur_hash2(b"abcd"), 646393889)
+        self.assertEqual(murmur_hash2(b"zulip.example.com"), 1100804361)
+        self.assertEqual(murmur_hash2(b"chat.zulip.org"), 2775528158)
+
+    def test_hashed_shard_index(self) -> None:
+        self.assertEqual(get_hashed_shard_index("zulip.example.com", 1), 0)
+        # 1100804361 is in the first third of the 32-bit hash space
+        self.assertEqual(get_hashed_shard_index("zulip.example.com", 3), 0)
+        # 2775528158 is in the middle third of the 32-bit hash space
+        self.assertEqual(get_hashed_shard_index("chat.zulip.org", 3), 1)
+        # nginx's $host is lowercased and excludes the port
+        self.assertEqual(get_hashed_shard_index("Chat.Zulip.org:9991", 3), 1)
+
+    def test_get_tornado_port(self) -> None:
+        realm = get_realm("zulip")
+        with self.settings(TORNADO_SERVER="http://127.0.0.1:9993", TORNADO_PROCESSES=1):
+            self.assertEqual(get_tornado_port(realm), 9993)
+            self.assertEqual(get_tornado_uri(realm), "http://127.0.0.1:9993")
+            self.assertEqual(notify_tornado_queue_name(9993), "notify_tornado")
+
+        with self.settings(TORNADO_SERVER="http://127.0.0.1:9993", TORNADO_PROCESSES=4,
+                           TORNADO_SHARDING_MAP={}):
+            port = get_tornado_port(realm)
+            self.assertEqual(port, 9800 + get_hashed_shard_index(realm.host, 4))
+            self.assertEqual(get_tornado_uri(realm), "http://127.0.0.1:%d" % (port,))
+            self.assertEqual(notify_tornado_queue_name(port), "notify_tornado_port_%d" % (port,))
+
+        with self.settings(TORNADO_SERVER="http://127.0.0.1:9993", TORNADO_PROCESSES=4,
+                           TORNADO_SHARDING_MAP={realm.host: 9803}):
+            self.assertEqual(get_tornado_port(realm), 9803)
+            self.assertEqual(get_tornado_uri(realm), "http://127.0.0.1:9803")
+
+class GarbageCollectionTest(ZulipTestCase):
+    def test_gc_event_queues(self) -> None:
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        clear_client_event_queues_for_testing()
+        now = time.time()
+
+        def allocate(user_profile: UserProfile) -> ClientDescriptor:
+            return allocate_client_descriptor(dict(
+                all_public_streams=False,
+                apply_markdown=True,
+                client_gravatar=True,
+                client_type_name='website',
+                event_types=None,
+                last_connection_time=now,
+                queue_timeout=600,
+                realm_id=user_profile.realm_id,
+                user_profile_id=user_profile.id,
+            ))
+
+        idle_client = allocate(hamlet)
+        active_client = allocate(hamlet)
+        other_client = allocate(cordelia)
+        self.assertEqual(len(event_queue.queue_expiry_heap), 3)
+
+        # Nothing is due yet, so GC doesn't even look at the queues.
+        with mock.patch('zerver.tornado.event_queue.time.time', return_value=now + 60), \
+                mock.patch.object(ClientDescriptor, 'expired') as expired:
+            gc_event_queues(9993)
+        expired.assert_not_called()
+
+        # active_client reconnected later, and other_client was
+        # deleted by its client.
+        active_client.last_connection_time = now + 300
+        other_client.cleanup()
+
+        with mock.patch('zerver.tornado.event_queue.time.time', return_value=now + 700):
+            gc_event_queues(9993)
+
+        self.assertIsNone(get_client_descriptor(idle_client.event_queue.id))
+        self.assertEqual(get_client_descriptor(active_client.event_queue.id), active_client)
+        self.assertEqual(get_client_descriptors_for_user(hamlet.id), [active_client])
+        self.assertEqual(event_queue.queue_expiry_heap,
+                         [(active_client.expiry_time(), active_client.event_queue.id)])
+
+        with mock.patch('zerver.tornado.event_queue.time.time', return_value=now + 901):
+            gc_event_queues(9993)
+        self.assertIsNone(get_client_descriptor(active_client.event_queue.id))
+        self.assertEqual(event_queue.queue_expiry_heap, [])
+
+class NotifySocketTest(ZulipTestCase):
+    def test_send_notices_via_socket(self) -> None:
+        output_dir = tempfile.mkdtemp(dir=get_or_create_dev_uuid_var_path('test-backend'))
+        notices = [dict(event=dict(type='heartbeat'), users=[1, 2])]
+        with self.settings(TORNADO_NOTIFY_SOCKET_PATTERN=output_dir + "/notify%s.sock"):
+            # Nothing is listening, so the caller should fall back to RabbitMQ.
+            self.assertFalse(send_notices_via_socket(9993, notices))
+
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            listener.bind(notify_socket_path(9993))
+            listener.listen(1)
+            try:
+                self.assertTrue(send_notices_via_socket(9993, notices))
+                (conn, address) = listener.accept()
+                frame = conn.recv(4096)
+                conn.close()
+            finally:
+                listener.close()
+
+        self.assertEqual(frame, encode_notice_batch(notices))
+        (length,) = struct.unpack(FRAME_HEADER_FORMAT, frame[:FRAME_HEADER_SIZE])
+        self.assertEqual(ujson.loads(frame[FRAME_HEADER_SIZE:].decode('utf-8')), notices)
+        self.assertEqual(length, len(frame) - FRAME_HEADER_SIZE)
+
+class BatchedNotificationTest(ZulipTestCase):
+    def test_send_events(self) -> None:
+        hamlet = self.example_user('hamlet')
+        realm = hamlet.realm
+        clear_client_event_queues_for_testing()
+        client = allocate_client_descriptor(dict(
+            all_public_streams=False,
+            apply_markdown=True,
+            client_gravatar=True,
+            client_type_name='website',
+            event_types=None,
+            last_connection_time=time.time(),
+            queue_timeout=0,
+            realm_id=realm.id,
+            user_profile_id=hamlet.id,
+        ))
+
+        # Several events for the same Tornado process are published
+        # as a single batch.
+        with mock.patch('zerver.tornado.event_queue.queue_json_publish') as m:
+            send_events([(realm, dict(type='unknown', n=1), [hamlet.id]),
+                         (realm, dict(type='unknown', n=2), [hamlet.id])])
+        self.assertEqual(m.call_count, 1)
+        notice = m.call_args[0][1]
+        self.assertEqual([batched['event']['n'] for batched in notice['notices']], [1, 2])
+
+        # ... which Tornado processes in order.
+        process_notification(notice)
+        self.assertEqual([event['n'] for event in client.event_queue.contents()], [1, 2])
+
+        # A single event is sent just like send_event would.
+        with mock.patch('zerver.tornado.event_queue.send_event') as m:
+            send_events([(realm, dict(type='unknown', n=3), [hamlet.id])])
+        m.assert_called_once_with(realm, dict(type='unknown', n=3), [hamlet.id])
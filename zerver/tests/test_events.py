@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 # See https://zulip.readthedocs.io/en/latest/subsystems/events-system.html for
 # high-level documentation on how this system works.
-from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from typing import Any, Callable, Dict, List, Mapping, Optional, Set, Tuple
 import copy
 import os
 import shutil
@@ -105,10 +105,12 @@ from zerver.lib.actions import (
     check_delete_user_group,
     do_update_user_custom_profile_data,
 )
+import zerver.lib.events
 from zerver.lib.events import (
     apply_events,
     fetch_initial_state_data,
     post_process_state,
+    start_section_fetches,
 )
 from zerver.lib.message import (
     aggregate_unread_data,
@@ -117,10 +119,12 @@ from zerver.lib.message import (
     UnreadMessagesResult,
 )
 from zerver.lib.test_helpers import POSTRequestMock, get_subscription, \
-    get_test_image_file, stub_event_queue_user_events, queries_captured
+    get_test_image_file, stub_event_queue_user_events, queries_captured, \
+    tornado_redirected_to_list
 from zerver.lib.test_classes import (
     ZulipTestCase,
 )
+from zerver.lib.profile import SectionTimer
 from zerver.lib.test_runner import slow
 from zerver.lib.topic import (
     ORIG_TOPIC,
@@ -140,6 +144,7 @@ from zerver.views.events_register import _default_all_public_streams, _default_n
 
 from zerver.tornado.event_queue import (
     allocate_client_descriptor,
+    ClientDescriptor,
     clear_client_event_queues_for_testing,
     get_client_info_for_message_event,
     process_message_event,
@@ -254,6 +259,63 @@ class EventsEndpointTest(ZulipTestCase):
         self.assertEqual(result_dict['pointer'], 15)
         self.assertEqual(result_dict['queue_id'], '15:13')
 
+    def test_events_register_deferred_event_types(self) -> None:
+        email = self.example_email("hamlet")
+        return_user_events = [
+            {
+                'id': 6,
+                'type': 'pointer',
+                'pointer': 15,
+            }
+        ]
+        events = []  # type: List[Mapping[str, Any]]
+        with stub_event_queue_user_events('15:14', return_user_events):
+            with tornado_redirected_to_list(events):
+                result = self.api_post(email, '/json/register',
+                                       dict(event_types=ujson.dumps(['pointer', 'realm_emoji']),
+                                            deferred_event_types=ujson.dumps(['pointer'])))
+        self.assert_json_success(result)
+        result_dict = result.json()
+        self.assertNotIn('pointer', result_dict)
+        self.assertIn('realm_emoji', result_dict)
+        self.assertEqual(result_dict['deferred_event_types'], ['pointer'])
+
+        # The deferred sections are sent to the new queue afterwards,
+        # with the events already in it applied.
+        self.assert_length(events, 1)
+        event = events[0]['event']
+        self.assertEqual(event['type'], 'initial_state')
+        self.assertEqual(event['queue_id'], '15:14')
+        self.assertEqual(event['state'], dict(pointer=15))
+        self.assertEqual(event['last_event_id'], 6)
+
+    def test_events_register_deferred_event_type_groups(self) -> None:
+        email = self.example_email("hamlet")
+        events = []  # type: List[Mapping[str, Any]]
+        with stub_event_queue_user_events('15:14', []):
+            with tornado_redirected_to_list(events):
+                result = self.api_post(email, '/json/register',
+                                       dict(deferred_event_types=ujson.dumps(['subscription',
+                                                                              'message'])))
+        self.assert_json_success(result)
+        result_dict = result.json()
+
+        # Stream events update the subscriptions data, and unread
+        # messages need both message and flag events, so those are
+        # deferred too.
+        self.assertEqual(result_dict['deferred_event_types'],
+                         ['delete_message', 'message', 'starred_messages', 'stream',
+                          'subscription', 'update_message', 'update_message_flags'])
+        for key in ['subscriptions', 'never_subscribed', 'streams', 'max_message_id',
+                    'unread_msgs', 'starred_messages']:
+            self.assertNotIn(key, result_dict)
+
+        self.assert_length(events, 1)
+        state = events[0]['event']['state']
+        for key in ['subscriptions', 'never_subscribed', 'streams', 'max_message_id',
+                    'unread_msgs', 'starred_messages']:
+            self.assertIn(key, state)
+
     def test_tornado_endpoint(self) -> None:
 
         # This test is mostly intended to get minimal coverage on
@@ -2778,6 +2840,34 @@ class FetchInitialStateDataTest(ZulipTestCase):
         result = fetch_initial_state_data(user_profile, None, "", client_gravatar=False)
         self.assertEqual(result['max_message_id'], -1)
 
+    def test_start_section_fetches(self) -> None:
+        calls = []  # type: List[str]
+
+        def fetch(section: str) -> Callable[[], str]:
+            def fetch_section() -> str:
+                calls.append(section)
+                return section
+            return fetch_section
+
+        # By default, each section is only fetched when it's needed.
+        fetched = start_section_fetches(dict(a=fetch('a'), b=fetch('b')))
+        self.assertEqual(calls, [])
+        self.assertEqual(fetched['b'](), 'b')
+        self.assertEqual(calls, ['b'])
+
+        calls = []
+        with self.settings(INITIAL_STATE_FETCH_THREADS=2):
+            fetched = start_section_fetches(dict(a=fetch('a'), b=fetch('b')))
+            self.assertEqual(fetched['a'](), 'a')
+            self.assertEqual(fetched['b'](), 'b')
+        self.assertEqual(set(calls), {'a', 'b'})
+
+        # The thread pool follows changes to the setting.
+        with self.settings(INITIAL_STATE_FETCH_THREADS=3):
+            fetched = start_section_fetches(dict(a=fetch('a')))
+            self.assertEqual(fetched['a'](), 'a')
+            self.assertEqual(zerver.lib.events.initial_state_executor_threads, 3)
+
 class GetUnreadMsgsTest(ZulipTestCase):
     def mute_stream(self, user_profile: UserProfile, stream: Stream) -> None:
         recipient = Recipient.objects.get(type_id=stream.id, type=Recipient.STREAM)
@@ -3158,6 +3248,32 @@ class EventQueueTest(TestCase):
                            'type': 'unknown',
                            "timestamp": "1"}])
 
+    def test_shared_event_bodies(self) -> None:
+        queue1 = EventQueue("1")
+        queue2 = EventQueue("2")
+        queue2.push({"type": "unknown"})
+
+        event = {"type": "realm_emoji", "op": "update"}
+        queue1.push(event)
+        queue2.push(event)
+
+        # The pushed event is shared, not copied or modified.
+        self.assertEqual(event, {"type": "realm_emoji", "op": "update"})
+        self.assertIs(queue1.queue[0][1], queue2.queue[1][1])
+
+        self.assertEqual(queue1.contents(),
+                         [{'id': 0, 'type': 'realm_emoji', 'op': 'update'}])
+        self.assertEqual(queue2.contents(),
+                         [{'id': 0, 'type': 'unknown'},
+                          {'id': 1, 'type': 'realm_emoji', 'op': 'update'}])
+
+        # Serialization round-trips through the materialized form.
+        restored = EventQueue.from_dict(queue2.to_dict())
+        self.assertEqual(restored.contents(), queue2.contents())
+        restored.prune(0)
+        self.assertEqual(restored.pop(), {'id': 1, 'type': 'realm_emoji', 'op': 'update'})
+        self.assertTrue(restored.empty())
+
 class ClientDescriptorsTest(ZulipTestCase):
     def test_get_client_info_for_all_public_streams(self) -> None:
         hamlet = self.example_user('hamlet')
@@ -3277,6 +3393,7 @@ class ClientDescriptorsTest(ZulipTestCase):
                 self.apply_markdown = apply_markdown
                 self.client_gravatar = client_gravatar
                 self.client_type_name = 'whatever'
+                self.narrow = []  # type: List[List[str]]
                 self.events = []  # type: List[Dict[str, Any]]
 
             def accepts_messages(self) -> bool:
@@ -3440,6 +3557,67 @@ class ClientDescriptorsTest(ZulipTestCase):
             ),
         ])
 
+    def test_process_message_event_shares_work_between_clients(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        realm = hamlet.realm
+
+        clear_client_event_queues_for_testing()
+
+        def allocate(user_profile: UserProfile, narrow: List[List[str]]) -> ClientDescriptor:
+            return allocate_client_descriptor(dict(
+                all_public_streams=False,
+                apply_markdown=True,
+                client_gravatar=True,
+                client_type_name='website',
+                event_types=['message'],
+                last_connection_time=time.time(),
+                queue_timeout=0,
+                realm_id=realm.id,
+                user_profile_id=user_profile.id,
+                narrow=narrow,
+            ))
+
+        hamlet_client = allocate(hamlet, [])
+        cordelia_client = allocate(cordelia, [])
+        narrowed_client = allocate(cordelia, [["is", "starred"]])
+
+        message_event = dict(
+            realm_id=realm.id,
+            message_dict=dict(
+                id=999,
+                content='**hello**',
+                rendered_content='<b>hello</b>',
+                sender_id=hamlet.id,
+                type='stream',
+                client='website',
+                sender_email=hamlet.email,
+                sender_realm_id=hamlet.realm_id,
+                sender_avatar_source=UserProfile.AVATAR_FROM_GRAVATAR,
+                sender_avatar_version=1,
+                sender_is_mirror_dummy=None,
+                raw_display_recipient=None,
+                recipient_type=None,
+                recipient_type_id=None,
+            ),
+        )
+        users = [dict(id=hamlet.id, flags=['read']), dict(id=cordelia.id, flags=['read'])]
+
+        with mock.patch.object(ClientDescriptor, 'accepts_event', autospec=True,
+                               side_effect=ClientDescriptor.accepts_event) as accepts_event:
+            process_message_event(message_event, users)
+
+        # hamlet_client and cordelia_client get the same event, so we
+        # only check it against one of their (identical) narrows.
+        self.assertEqual(accepts_event.call_count, 2)
+
+        hamlet_event = hamlet_client.event_queue.contents()[0]
+        cordelia_event = cordelia_client.event_queue.contents()[0]
+        self.assertEqual(hamlet_event, cordelia_event)
+        self.assertIsNot(hamlet_event, cordelia_event)
+        self.assertEqual(hamlet_event['flags'], ['read'])
+        self.assertTrue(narrowed_client.event_queue.empty())
+
 class FetchQueriesTest(ZulipTestCase):
     def test_queries(self) -> None:
         user = self.example_user("hamlet")
@@ -3512,6 +3690,26 @@ class FetchQueriesTest(ZulipTestCase):
                 )
             self.assert_length(queries, count)
 
+    def test_section_timer(self) -> None:
+        user = self.example_user("hamlet")
+        section_timer = SectionTimer()
+        flush_per_request_caches()
+        fetch_initial_state_data(
+            user_profile=user,
+            event_types=['realm_user', 'stop_words', 'zulip_version'],
+            queue_id='x',
+            client_gravatar=False,
+            section_timer=section_timer,
+        )
+        self.assertEqual(list(section_timer.sections), ['realm_user', 'stop_words', 'zulip_version'])
+        self.assertGreater(section_timer.sections['realm_user'][1], 0)
+        self.assertEqual(section_timer.sections['zulip_version'][1], 0)
+
+        section_timer.sections['realm_user'] = (0.0123, 3)
+        section_timer.sections['stop_words'] = (0.001, 0)
+        section_timer.sections['zulip_version'] = (0.5, 0)
+        self.assertEqual(section_timer.format(), "zulip_version:500ms/0q realm_user:12ms/3q")
+
 
 class TestEventsRegisterAllPublicStreamsDefaults(ZulipTestCase):
     def setUp(self) -> None:
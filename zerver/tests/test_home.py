@@ -239,7 +239,7 @@ class HomeTest(ZulipTestCase):
                 result = self._get_home_page(stream='Denmark')
 
         self.assert_length(queries, 45)
-        self.assert_length(cache_mock.call_args_list, 7)
+        self.assert_length(cache_mock.call_args_list, 8)
 
         html = result.content.decode('utf-8')
 
@@ -303,7 +303,7 @@ class HomeTest(ZulipTestCase):
             with patch('zerver.lib.cache.cache_set') as cache_mock:
                 result = self._get_home_page()
                 self.assertEqual(result.status_code, 200)
-                self.assert_length(cache_mock.call_args_list, 6)
+                self.assert_length(cache_mock.call_args_list, 7)
             self.assert_length(queries, 42)
 
     @slow("Creates and subscribes 10 users in a loop.  Should use bulk queries.")
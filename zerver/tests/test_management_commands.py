@@ -13,7 +13,10 @@ from django.conf import settings
 from django.core.management import call_command
 from django.test import TestCase, override_settings
 from zerver.lib.actions import do_create_user, do_add_reaction
+from zerver.lib.bugdown import version as bugdown_version
+from zerver.lib.cache import cache_delete, cache_get, to_dict_cache_key_id
 from zerver.lib.management import ZulipBaseCommand, CommandError, check_config
+from zerver.lib.message import bulk_save_rendered_content, extract_message_dict
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import stdout_suppressed
 from zerver.lib.test_runner import slow
@@ -291,6 +294,43 @@ class TestCalculateFirstVisibleMessageID(ZulipTestCase):
         calls = [call(realm, 35) for realm in Realm.objects.all()]
         m.has_calls(calls, any_order=True)
 
+class TestRerenderMessages(ZulipTestCase):
+    COMMAND_NAME = 'rerender_messages'
+
+    def test_rerender_messages(self) -> None:
+        stale_id = self.send_stream_message(self.example_email("hamlet"), "Denmark",
+                                            content="**stale**")
+        current_id = self.send_stream_message(self.example_email("hamlet"), "Denmark",
+                                              content="**current**")
+        Message.objects.filter(id=stale_id).update(rendered_content="<p>old</p>",
+                                                   rendered_content_version=0)
+        Message.objects.filter(id=current_id).update(rendered_content="<p>unchanged</p>")
+        cache_delete(to_dict_cache_key_id(stale_id))
+
+        with stdout_suppressed(), self.assertLogs(level='INFO') as logs:
+            call_command(self.COMMAND_NAME, "--start-id={}".format(stale_id),
+                         "--chunk-size=1", "--processes=1")
+        self.assertIn("Re-rendered 1 messages with IDs {0}-{0}".format(stale_id), logs.output[0])
+        self.assertIn("Re-rendered 0 messages with IDs {0}-{0}".format(current_id), logs.output[1])
+
+        stale_message = Message.objects.get(id=stale_id)
+        self.assertEqual(stale_message.rendered_content, "<p><strong>stale</strong></p>")
+        self.assertEqual(stale_message.rendered_content_version, bugdown_version)
+        self.assertEqual(Message.objects.get(id=current_id).rendered_content, "<p>unchanged</p>")
+
+        # The to_dict cache is populated with the new rendering.
+        cached = cache_get(to_dict_cache_key_id(stale_id))
+        assert cached is not None
+        self.assertEqual(extract_message_dict(cached[0])['rendered_content'],
+                         "<p><strong>stale</strong></p>")
+
+        # A message edited since we read it keeps the edit's rendering.
+        stale_message.rendered_content = "<p>rerendered</p>"
+        Message.objects.filter(id=stale_id).update(rendered_content="<p>edited</p>",
+                                                   rendered_content_version=bugdown_version)
+        bulk_save_rendered_content([stale_message])
+        self.assertEqual(Message.objects.get(id=stale_id).rendered_content, "<p>edited</p>")
+
 class TestPasswordRestEmail(ZulipTestCase):
     COMMAND_NAME = "send_password_reset_email"
 
@@ -9,7 +9,9 @@ from django.utils.timezone import now as timezone_now
 from zerver.lib import bugdown
 from zerver.decorator import JsonableError
 from zerver.lib.test_runner import slow
-from zerver.lib.cache import get_stream_cache_key, cache_delete
+from zerver.lib.cache import get_stream_cache_key, cache_delete, cache_get, cache_set, \
+    to_dict_cache_key_id, unread_message_info_cache_key, \
+    unread_message_info_version_cache_key
 
 from zerver.lib.addressee import Addressee
 
@@ -46,12 +48,14 @@ from zerver.lib.create_user import (
 from zerver.lib.message import (
     MessageDict,
     bulk_access_messages,
+    extract_message_dict_compact,
     get_first_visible_message_id,
     get_raw_unread_data,
     get_recent_private_conversations,
     maybe_update_first_visible_message_id,
     messages_for_ids,
     sew_messages_and_reactions,
+    stringify_message_dict_compact,
     update_first_visible_message_id,
 )
 
@@ -1000,14 +1004,14 @@ class StreamMessagesTest(ZulipTestCase):
         self.assertTrue(UserMessage.objects.get(user_profile=user_profile, message=message).flags.is_private.is_set)
 
     def _send_stream_message(self, email: str, stream_name: str, content: str) -> Set[int]:
-        with mock.patch('zerver.lib.actions.send_event') as m:
+        with mock.patch('zerver.lib.actions.send_events') as m:
             self.send_stream_message(
                 email,
                 stream_name,
                 content=content
             )
         self.assertEqual(m.call_count, 1)
-        users = m.call_args[0][2]
+        [(realm, event, users)] = m.call_args[0][0]
         user_ids = {u['id'] for u in users}
         return user_ids
 
@@ -1113,6 +1117,23 @@ class StreamMessagesTest(ZulipTestCase):
         """
         self.assert_stream_message("Scotland")
 
+    def test_message_to_stream_with_copy(self) -> None:
+        """
+        Large numbers of UserMessage rows are inserted with COPY, rather
+        than an INSERT statement, which should make no difference.
+        """
+        with mock.patch('zerver.lib.actions.BULK_INSERT_UMS_COPY_THRESHOLD', 0):
+            self.assert_stream_message("Scotland")
+            msg_id = self.send_stream_message(self.example_email('othello'), "Verona",
+                                              content="@**Cordelia Lear** hello")
+
+        um = UserMessage.objects.get(user_profile=self.example_user('cordelia'),
+                                     message_id=msg_id)
+        self.assertEqual(um.flags_list(), ['mentioned'])
+        um = UserMessage.objects.get(user_profile=self.example_user('othello'),
+                                     message_id=msg_id)
+        self.assertEqual(um.flags_list(), ['read'])
+
     def test_non_ascii_stream_message(self) -> None:
         """
         Sending a stream message containing non-ASCII characters in the stream
@@ -1163,6 +1184,53 @@ class StreamMessagesTest(ZulipTestCase):
                                                                    user != users[1]))
         self.assertEqual(recent_conversation['max_message_id'], message2_id)
 
+    def test_get_raw_unread_data_caches_message_info(self) -> None:
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        self.subscribe(hamlet, 'Denmark')
+        self.subscribe(cordelia, 'Denmark')
+        message_id = self.send_stream_message(hamlet.email, 'Denmark', topic_name='lunch')
+
+        msg_data = get_raw_unread_data(cordelia)
+        self.assertEqual(msg_data['stream_dict'][message_id]['topic'], 'lunch')
+
+        # Once cached, we don't need to look up the messages again.
+        with queries_captured() as queries:
+            msg_data = get_raw_unread_data(cordelia)
+        self.assertFalse(any('subject' in query['sql'] for query in queries))
+        self.assertEqual(msg_data['stream_dict'][message_id]['topic'], 'lunch')
+
+        # Editing the topic invalidates the cached copy, even if a
+        # concurrent request that read the old topic writes its copy
+        # afterwards.
+        cache_key = unread_message_info_cache_key(cordelia.id)
+        stale_copy = cache_get(cache_key)[0]
+        self.login(hamlet.email)
+        result = self.client_patch("/json/messages/" + str(message_id), {
+            'message_id': message_id,
+            'topic': 'dinner'
+        })
+        self.assert_json_success(result)
+        cache_set(cache_key, stale_copy)
+        msg_data = get_raw_unread_data(cordelia)
+        self.assertEqual(msg_data['stream_dict'][message_id]['topic'], 'dinner')
+
+        # Without a version, nothing is trusted.
+        cache_delete(unread_message_info_version_cache_key(cordelia.id))
+        cache_set(cache_key, stale_copy)
+        msg_data = get_raw_unread_data(cordelia)
+        self.assertEqual(msg_data['stream_dict'][message_id]['topic'], 'dinner')
+
+        # Messages that have been read are dropped.
+        self.login(cordelia.email)
+        result = self.client_post("/json/messages/flags",
+                                  {"messages": ujson.dumps([message_id]),
+                                   "op": "add",
+                                   "flag": "read"})
+        self.assert_json_success(result)
+        msg_data = get_raw_unread_data(cordelia)
+        self.assertNotIn(message_id, msg_data['stream_dict'])
+
 class MessageDictTest(ZulipTestCase):
     @slow('builds lots of messages')
     def test_bulk_message_fetching(self) -> None:
@@ -1216,7 +1284,7 @@ class MessageDictTest(ZulipTestCase):
         # slower.
         error_msg = "Number of ids: {}. Time delay: {}".format(num_ids, delay)
         self.assertTrue(delay < 0.0015 * num_ids, error_msg)
-        self.assert_length(queries, 7)
+        self.assert_length(queries, 5)
         self.assertEqual(len(rows), num_ids)
 
     def test_applying_markdown(self) -> None:
@@ -1304,6 +1372,55 @@ class MessageDictTest(ZulipTestCase):
         self.assertEqual(msg_dict['reactions'][0]['user']['full_name'],
                          sender.full_name)
 
+    def test_compact_cache_format(self) -> None:
+        sender = self.example_user('othello')
+        receiver = self.example_user('hamlet')
+        recipient = Recipient.objects.get(type_id=receiver.id, type=Recipient.PERSONAL)
+        sending_client = make_client(name="test suite")
+        message = Message(
+            sender=sender,
+            recipient=recipient,
+            content='hello **world**',
+            pub_date=timezone_now(),
+            sending_client=sending_client,
+            last_edit_time=timezone_now(),
+            edit_history='[]'
+        )
+        message.set_topic_name('whatever')
+        message.save()
+        Reaction.objects.create(message=message, user_profile=sender,
+                                emoji_name='simple_smile')
+
+        row = MessageDict.get_raw_db_rows([message.id])[0]
+        msg_dict = MessageDict.build_dict_from_raw_db_row(row)
+        unedited_dict = dict(msg_dict)
+        del unedited_dict['last_edit_timestamp']
+        del unedited_dict['edit_history']
+        long_dict = dict(msg_dict, rendered_content='<p>' + 'hello ' * 500 + '</p>')
+        extra_dict = dict(msg_dict, new_field=[1, 2])
+        for dct in [msg_dict, unedited_dict, long_dict, extra_dict]:
+            data = stringify_message_dict_compact(dct)
+            self.assertEqual(extract_message_dict_compact(data), dct)
+        self.assertEqual(stringify_message_dict_compact(msg_dict)[:1], b'j')
+        self.assertEqual(stringify_message_dict_compact(long_dict)[:1], b'z')
+
+        # The formats use different cache keys, so that changing
+        # MESSAGE_CACHE_FORMAT doesn't require flushing the cache.
+        with self.settings(MESSAGE_CACHE_FORMAT='compact'):
+            self.assertEqual(to_dict_cache_key_id(message.id),
+                             'message_dict_compact1:%d' % (message.id,))
+            for i in range(2):
+                messages = messages_for_ids(
+                    message_ids=[message.id],
+                    user_message_flags={message.id: []},
+                    search_fields={},
+                    apply_markdown=True,
+                    client_gravatar=False,
+                    allow_edit_history=True,
+                )
+                self.assertEqual(messages[0]['content'], msg_dict['rendered_content'])
+                self.assertEqual(messages[0]['reactions'][0]['emoji_name'], 'simple_smile')
+
     def test_missing_anchor(self) -> None:
         self.login(self.example_email("hamlet"))
         result = self.client_get(
@@ -3853,7 +3970,7 @@ class SoftDeactivationMessageTest(ZulipTestCase):
         self.assertNotEqual(idle_user_msg_list[-1], sent_message)
         with queries_captured() as queries:
             add_missing_messages(long_term_idle_user)
-        self.assert_length(queries, 6)
+        self.assert_length(queries, 4)
         idle_user_msg_list = get_user_messages(long_term_idle_user)
         self.assertEqual(len(idle_user_msg_list), idle_user_msg_count + 1)
         self.assertEqual(idle_user_msg_list[-1], sent_message)
@@ -3870,7 +3987,7 @@ class SoftDeactivationMessageTest(ZulipTestCase):
         self.assertNotEqual(idle_user_msg_list[-1], sent_message)
         with queries_captured() as queries:
             add_missing_messages(long_term_idle_user)
-        self.assert_length(queries, 6)
+        self.assert_length(queries, 4)
         idle_user_msg_list = get_user_messages(long_term_idle_user)
         self.assertEqual(len(idle_user_msg_list), idle_user_msg_count + 1)
         self.assertEqual(idle_user_msg_list[-1], sent_message)
@@ -3895,7 +4012,7 @@ class SoftDeactivationMessageTest(ZulipTestCase):
             self.assertNotEqual(idle_user_msg_list.pop(), sent_message)
         with queries_captured() as queries:
             add_missing_messages(long_term_idle_user)
-        self.assert_length(queries, 6)
+        self.assert_length(queries, 4)
         idle_user_msg_list = get_user_messages(long_term_idle_user)
         self.assertEqual(len(idle_user_msg_list), idle_user_msg_count + 2)
         for sent_message in sent_message_list:
@@ -3927,7 +4044,7 @@ class SoftDeactivationMessageTest(ZulipTestCase):
             self.assertNotEqual(idle_user_msg_list.pop(), sent_message)
         with queries_captured() as queries:
             add_missing_messages(long_term_idle_user)
-        self.assert_length(queries, 6)
+        self.assert_length(queries, 4)
         idle_user_msg_list = get_user_messages(long_term_idle_user)
         self.assertEqual(len(idle_user_msg_list), idle_user_msg_count + 2)
         for sent_message in sent_message_list:
@@ -3953,9 +4070,8 @@ class SoftDeactivationMessageTest(ZulipTestCase):
         self.assertEqual(idle_user_msg_list[-1].id, sent_message_id)
         with queries_captured() as queries:
             add_missing_messages(long_term_idle_user)
-        # There are no streams to fetch missing messages from, so
-        # the Message.objects query will be avoided.
-        self.assert_length(queries, 4)
+        # Nothing was added, so last_active_message_id isn't updated.
+        self.assert_length(queries, 3)
         idle_user_msg_list = get_user_messages(long_term_idle_user)
         # No new UserMessage rows should have been created.
         self.assertEqual(len(idle_user_msg_list), idle_user_msg_count)
@@ -3982,7 +4098,7 @@ class SoftDeactivationMessageTest(ZulipTestCase):
             self.assertNotEqual(idle_user_msg_list.pop(), sent_message)
         with queries_captured() as queries:
             add_missing_messages(long_term_idle_user)
-        self.assert_length(queries, 6)
+        self.assert_length(queries, 4)
         idle_user_msg_list = get_user_messages(long_term_idle_user)
         self.assertEqual(len(idle_user_msg_list), idle_user_msg_count + 2)
         for sent_message in sent_message_list:
@@ -3990,8 +4106,7 @@ class SoftDeactivationMessageTest(ZulipTestCase):
         long_term_idle_user.refresh_from_db()
         self.assertEqual(long_term_idle_user.last_active_message_id, sent_message_list[0].id)
 
-    @mock.patch('zerver.lib.soft_deactivation.BULK_CREATE_BATCH_SIZE', 2)
-    def test_add_missing_messages_pagination(self) -> None:
+    def test_add_missing_messages_backlog(self) -> None:
         recipient_list  = [self.example_user("hamlet"), self.example_user("iago")]
         stream_name = 'Denmark'
         for user_profile in recipient_list:
@@ -4002,7 +4117,7 @@ class SoftDeactivationMessageTest(ZulipTestCase):
         self.send_stream_message(long_term_idle_user.email, stream_name)
         do_soft_deactivate_users([long_term_idle_user])
 
-        num_new_messages = 5
+        num_new_messages = 50
         message_ids = []
         for _ in range(num_new_messages):
             message_id = self.send_stream_message(sender.email, stream_name)
@@ -4012,7 +4127,8 @@ class SoftDeactivationMessageTest(ZulipTestCase):
         idle_user_msg_count = len(idle_user_msg_list)
         with queries_captured() as queries:
             add_missing_messages(long_term_idle_user)
-        self.assert_length(queries, 10)
+        # The rows are all added by a single query.
+        self.assert_length(queries, 4)
         idle_user_msg_list = get_user_messages(long_term_idle_user)
         self.assertEqual(len(idle_user_msg_list), idle_user_msg_count + num_new_messages)
         long_term_idle_user.refresh_from_db()
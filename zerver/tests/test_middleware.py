@@ -16,7 +16,8 @@ class SlowQueryTest(ZulipTestCase):
                 'bugdown_requests_start': 0,
                 'bugdown_time_start': 0,
                 'remote_cache_time_start': 0,
-                'remote_cache_requests_start': 0}
+                'remote_cache_requests_start': 0,
+                'local_cache_hits_start': 0}
 
     def test_is_slow_query(self) -> None:
         self.assertFalse(is_slow_query(1.1, '/some/random/url'))
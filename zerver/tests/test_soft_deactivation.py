@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import mock
+from typing import List, Tuple
 
 from django.utils.timezone import now as timezone_now
 
@@ -11,11 +12,12 @@ from zerver.lib.soft_deactivation import (
     do_soft_activate_users,
     get_soft_deactivated_users_for_catch_up,
     do_catch_up_soft_deactivated_users,
-    do_auto_soft_deactivate_users
+    do_auto_soft_deactivate_users,
+    get_subscribed_intervals
 )
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.models import (
-    Client, UserProfile, UserActivity, get_realm, UserMessage
+    Client, UserProfile, UserActivity, get_realm, UserMessage, RealmAuditLog
 )
 
 class UserSoftDeactivationTests(ZulipTestCase):
@@ -217,3 +219,24 @@ class UserSoftDeactivationTests(ZulipTestCase):
         received_count = UserMessage.objects.filter(user_profile__in=users,
                                                     message_id=message_id).count()
         self.assertEqual(0, received_count)
+
+    def test_get_subscribed_intervals(self) -> None:
+        def logs(*events: Tuple[int, int]) -> List[RealmAuditLog]:
+            return [RealmAuditLog(event_type=event_type, event_last_message_id=message_id)
+                    for (event_type, message_id) in events]
+        created = RealmAuditLog.SUBSCRIPTION_CREATED
+        activated = RealmAuditLog.SUBSCRIPTION_ACTIVATED
+        deactivated = RealmAuditLog.SUBSCRIPTION_DEACTIVATED
+
+        self.assertEqual(get_subscribed_intervals(logs((created, 5)), 10), [(10, None)])
+        self.assertEqual(get_subscribed_intervals(logs((created, 15)), 10), [(15, None)])
+        self.assertEqual(get_subscribed_intervals(logs((created, 5), (deactivated, 8)), 10), [])
+        self.assertEqual(get_subscribed_intervals(
+            logs((created, 5), (deactivated, 12), (activated, 20), (deactivated, 30),
+                 (activated, 30), (deactivated, 30), (activated, 35)), 10),
+            [(10, 12), (20, 30), (35, None)])
+        # Consecutive unsubscriptions don't produce overlapping intervals.
+        self.assertEqual(get_subscribed_intervals(
+            logs((deactivated, 12), (deactivated, 15)), 10), [(10, 12), (12, 15)])
+        with self.assertRaises(AssertionError):
+            get_subscribed_intervals(logs((RealmAuditLog.USER_CREATED, 5)), 10)
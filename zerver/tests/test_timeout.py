@@ -0,0 +1,51 @@
+import time
+
+from zerver.lib.test_classes import ZulipTestCase
+from zerver.lib.timeout import deadline_call, timeout, TimeoutExpired
+
+class TimeoutTestCase(ZulipTestCase):
+    # We can't interrupt a single long sleep, so we sleep in short
+    # increments instead.
+    def sleep_for(self, seconds: float) -> int:
+        end = time.time() + seconds
+        while time.time() < end:
+            time.sleep(0.01)
+        return 42
+
+    def test_timeout_returns(self) -> None:
+        self.assertEqual(timeout(1, self.sleep_for, 0), 42)
+        self.assertEqual(deadline_call(1, self.sleep_for, 0), 42)
+
+    def test_timeout_expires(self) -> None:
+        with self.assertRaises(TimeoutExpired):
+            timeout(0.1, self.sleep_for, 1)
+        with self.assertRaises(TimeoutExpired):
+            deadline_call(0.1, self.sleep_for, 1)
+
+    def test_deadline_call_exceptions(self) -> None:
+        def fail() -> None:
+            raise ValueError("failed")
+
+        with self.assertRaises(ValueError):
+            deadline_call(1, fail)
+        # A call that finished (or failed) before its deadline is never
+        # interrupted afterwards.
+        self.assertEqual(deadline_call(0.05, self.sleep_for, 0), 42)
+        self.sleep_for(0.2)
+
+    def test_deadline_call_uninterruptible(self) -> None:
+        def ignore_timeouts() -> int:
+            end = time.time() + 3
+            while time.time() < end:
+                try:
+                    time.sleep(0.01)
+                except TimeoutExpired:
+                    pass
+            return 42
+
+        # We get control back even if the call never stops.
+        start = time.time()
+        with self.assertRaises(TimeoutExpired):
+            deadline_call(0.1, ignore_timeouts)
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(deadline_call(1, self.sleep_for, 0), 42)
@@ -31,6 +31,9 @@ from zerver.lib.actions import (
     do_change_is_admin,
     do_create_user,
     do_set_realm_property,
+    do_change_notification_settings,
+    do_change_subscription_property,
+    bulk_remove_subscriptions,
 )
 from zerver.lib.create_user import copy_user_settings
 from zerver.lib.events import do_events_register
@@ -1112,6 +1115,49 @@ class RecipientInfoTest(ZulipTestCase):
         )
         self.assertEqual(info['default_bot_user_ids'], {normal_bot.id})
 
+    def test_stream_recipient_info_cache(self) -> None:
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        realm = hamlet.realm
+
+        stream_name = 'Test Stream'
+        for user in [hamlet, cordelia]:
+            self.subscribe(user, stream_name)
+        stream = get_stream(stream_name, realm)
+        recipient = get_stream_recipient(stream.id)
+        stream_topic = StreamTopicTarget(
+            stream_id=stream.id,
+            topic_name='test topic',
+        )
+
+        def get_info() -> Dict[str, Any]:
+            return get_recipient_info(
+                recipient=recipient,
+                sender_id=hamlet.id,
+                stream_topic=stream_topic,
+            )
+
+        get_info()
+        with queries_captured() as queries:
+            info = get_info()
+        self.assertFalse(any('zerver_subscription' in query['sql'] for query in queries))
+        self.assertEqual(info['active_user_ids'], {hamlet.id, cordelia.id})
+        self.assertEqual(info['stream_email_user_ids'], set())
+
+        # Each of these has to flush the cached subscriber info.
+        do_change_notification_settings(cordelia, 'enable_stream_email_notifications', True)
+        self.assertEqual(get_info()['stream_email_user_ids'], {cordelia.id})
+
+        do_change_subscription_property(cordelia, get_subscription(stream_name, cordelia),
+                                        stream, 'in_home_view', False)
+        self.assertEqual(get_info()['stream_email_user_ids'], set())
+
+        bulk_remove_subscriptions([cordelia], [stream], get_client('website'))
+        self.assertEqual(get_info()['active_user_ids'], {hamlet.id})
+
+        self.subscribe(cordelia, stream_name)
+        self.assertEqual(get_info()['active_user_ids'], {hamlet.id, cordelia.id})
+
     def test_get_recipient_info_invalid_recipient_type(self) -> None:
         hamlet = self.example_user('hamlet')
         realm = hamlet.realm
@@ -1,12 +1,14 @@
 # See https://zulip.readthedocs.io/en/latest/subsystems/events-system.html for
 # high-level documentation on how this system works.
 from typing import cast, AbstractSet, Any, Callable, Dict, List, \
-    Mapping, MutableMapping, Optional, Iterable, Sequence, Set, Union
+    Mapping, MutableMapping, Optional, Iterable, Sequence, Set, Tuple, Union
 from mypy_extensions import TypedDict
 
 from django.utils.translation import ugettext as _
 from django.conf import settings
-from collections import deque
+from collections import deque, OrderedDict
+import heapq
+import itertools
 import os
 import time
 import logging
@@ -30,6 +32,7 @@ from zerver.lib.queue import queue_json_publish
 from zerver.lib.request import JsonableError
 from zerver.tornado.descriptors import clear_descriptor_by_handler_id, set_descriptor_by_handler_id
 from zerver.tornado.exceptions import BadEventQueueIdError
+from zerver.tornado.notify_socket import send_notices_via_socket
 from zerver.tornado.sharding import get_tornado_uri, get_tornado_port, \
     notify_tornado_queue_name
 import copy
@@ -45,10 +48,18 @@ for host in ['127.0.0.1', 'localhost']:
 # situation, queues from dead browser sessions would grow quite large
 # due to the accumulation of message data in those queues.
 DEFAULT_EVENT_QUEUE_TIMEOUT_SECS = 60 * 10
-# We garbage-collect every minute; this is totally fine given that the
-# GC scan takes ~2ms with 1000 event queues.
+# We garbage-collect every minute; each GC run only looks at the
+# queues that are due to expire (see queue_expiry_heap).
 EVENT_QUEUE_GC_FREQ_MSECS = 1000 * 60 * 1
 
+# We snapshot all event queues to disk every minute, so that if
+# Tornado crashes, we can restore them on restart.  Snapshots (and
+# loading event queues on restart) are processed in batches of
+# EVENT_QUEUE_PERSISTENCE_BATCH_SIZE queues per ioloop callback, so
+# that Tornado keeps serving requests in the meantime.
+EVENT_QUEUE_SNAPSHOT_FREQ_MSECS = 1000 * 60 * 1
+EVENT_QUEUE_PERSISTENCE_BATCH_SIZE = 1000
+
 # Capped limit for how long a client can request an event queue
 # to live
 MAX_QUEUE_TIMEOUT_SECS = 7 * 24 * 60 * 60
@@ -151,7 +162,7 @@ class ClientDescriptor:
         self.current_handler_id = None
         self._timeout_handle = None
 
-    def add_event(self, event: Dict[str, Any]) -> None:
+    def add_event(self, event: Mapping[str, Any]) -> None:
         if self.current_handler_id is not None:
             handler = get_handler_by_id(self.current_handler_id)
             async_request_timer_restart(handler._request)
@@ -173,6 +184,10 @@ class ClientDescriptor:
         return False
 
     def accepts_event(self, event: Mapping[str, Any]) -> bool:
+        if event["type"] == "initial_state":
+            # Sections of the initial state that the client deferred
+            # when registering this queue; see do_events_register.
+            return event["queue_id"] == self.event_queue.id
         if self.event_types is not None and event["type"] not in self.event_types:
             return False
         if event["type"] == "message":
@@ -187,6 +202,11 @@ class ClientDescriptor:
         return (self.current_handler_id is None and
                 now - self.last_connection_time >= self.queue_timeout)
 
+    def expiry_time(self) -> float:
+        # The earliest time at which this queue could be expired; it
+        # may be later, if the client is connected then.
+        return self.last_connection_time + self.queue_timeout
+
     def connect_handler(self, handler_id: int, client_name: str) -> None:
         self.current_handler_id = handler_id
         self.current_client_name = client_name
@@ -237,11 +257,24 @@ def compute_full_event_type(event: Mapping[str, Any]) -> str:
     return event["type"]
 
 class EventQueue:
+    # Events are often delivered to many queues at once (e.g. a message
+    # to a large stream, or a realm-wide event), so rather than storing
+    # a copy of the event in each queue, the queue stores (event_id,
+    # event) pairs where the event body may be shared between queues;
+    # the full event with its per-queue "id" is only materialized in
+    # contents(), pop() and to_dict().  Event bodies are therefore
+    # never modified after being pushed.
     def __init__(self, id: str) -> None:
-        self.queue = deque()  # type: ignore # Should be Deque[Dict[str, Any]], but Deque isn't available in Python 3.4
+        self.queue = deque()  # type: ignore # Should be Deque[Tuple[int, Mapping[str, Any]]], but Deque isn't available in Python 3.4
         self.next_event_id = 0  # type: int
         self.id = id  # type: str
         self.virtual_events = {}  # type: Dict[str, Dict[str, Any]]
+        # When this queue was restored from a periodic snapshot after
+        # a crash, rather than a clean shutdown, the snapshot's
+        # next_event_id: events from that ID on may have been given to
+        # the client and then lost.  Cleared by the first poll that
+        # shows the client didn't see any of them; see fetch_events.
+        self.snapshot_next_event_id = None  # type: Optional[int]
 
     def to_dict(self) -> Dict[str, Any]:
         # If you add a new key to this dict, make sure you add appropriate
@@ -249,29 +282,33 @@ class EventQueue:
         # loading event queues that lack that key.
         return dict(id=self.id,
                     next_event_id=self.next_event_id,
-                    queue=list(self.queue),
-                    virtual_events=self.virtual_events)
+                    queue=[materialize_event(event_id, event) for (event_id, event) in self.queue],
+                    virtual_events=self.virtual_events,
+                    snapshot_next_event_id=self.snapshot_next_event_id)
 
     @classmethod
     def from_dict(cls, d: Dict[str, Any]) -> 'EventQueue':
         ret = cls(d['id'])
         ret.next_event_id = d['next_event_id']
-        ret.queue = deque(d['queue'])
+        ret.queue = deque((event['id'], event) for event in d['queue'])
         ret.virtual_events = d.get("virtual_events", {})
+        ret.snapshot_next_event_id = d.get("snapshot_next_event_id")
         return ret
 
-    def push(self, event: Dict[str, Any]) -> None:
-        event['id'] = self.next_event_id
+    def push(self, event: Mapping[str, Any]) -> None:
+        event_id = self.next_event_id
         self.next_event_id += 1
         full_event_type = compute_full_event_type(event)
         if (full_event_type in ["pointer", "restart"] or
                 full_event_type.startswith("flags/")):
             if full_event_type not in self.virtual_events:
-                self.virtual_events[full_event_type] = copy.deepcopy(event)
+                virtual_event = copy.deepcopy(dict(event))
+                virtual_event["id"] = event_id
+                self.virtual_events[full_event_type] = virtual_event
                 return
             # Update the virtual event with the values from the event
             virtual_event = self.virtual_events[full_event_type]
-            virtual_event["id"] = event["id"]
+            virtual_event["id"] = event_id
             if "timestamp" in event:
                 virtual_event["timestamp"] = event["timestamp"]
             if full_event_type == "pointer":
@@ -281,44 +318,47 @@ class EventQueue:
             elif full_event_type.startswith("flags/"):
                 virtual_event["messages"] += event["messages"]
         else:
-            self.queue.append(event)
+            self.queue.append((event_id, event))
 
     # Note that pop ignores virtual events.  This is fine in our
     # current usage since virtual events should always be resolved to
     # a real event before being given to users.
     def pop(self) -> Dict[str, Any]:
-        return self.queue.popleft()
+        (event_id, event) = self.queue.popleft()
+        return materialize_event(event_id, event)
 
     def empty(self) -> bool:
         return len(self.queue) == 0 and len(self.virtual_events) == 0
 
     # See the comment on pop; that applies here as well
     def prune(self, through_id: int) -> None:
-        while len(self.queue) != 0 and self.queue[0]['id'] <= through_id:
-            self.pop()
+        while len(self.queue) != 0 and self.queue[0][0] <= through_id:
+            self.queue.popleft()
 
     def contents(self) -> List[Dict[str, Any]]:
-        contents = []  # type: List[Dict[str, Any]]
-        virtual_id_map = {}  # type: Dict[str, Dict[str, Any]]
-        for event_type in self.virtual_events:
-            virtual_id_map[self.virtual_events[event_type]["id"]] = self.virtual_events[event_type]
-        virtual_ids = sorted(list(virtual_id_map.keys()))
-
-        # Merge the virtual events into their final place in the queue
-        index = 0
-        length = len(virtual_ids)
-        for event in self.queue:
-            while index < length and virtual_ids[index] < event["id"]:
-                contents.append(virtual_id_map[virtual_ids[index]])
-                index += 1
-            contents.append(event)
-        while index < length:
-            contents.append(virtual_id_map[virtual_ids[index]])
-            index += 1
-
-        self.virtual_events = {}
-        self.queue = deque(contents)
-        return contents
+        if self.virtual_events:
+            # Merge the virtual events into their final place in the
+            # queue; after that, they're ordinary queued events.
+            virtual_events = sorted((virtual_event["id"], virtual_event)
+                                    for virtual_event in self.virtual_events.values())
+            self.virtual_events = {}
+            merged = deque()  # type: ignore # Should be Deque[Tuple[int, Mapping[str, Any]]]
+            index = 0
+            length = len(virtual_events)
+            for (event_id, event) in self.queue:
+                while index < length and virtual_events[index][0] < event_id:
+                    merged.append(virtual_events[index])
+                    index += 1
+                merged.append((event_id, event))
+            merged.extend(virtual_events[index:])
+            self.queue = merged
+
+        return [materialize_event(event_id, event) for (event_id, event) in self.queue]
+
+def materialize_event(event_id: int, event: Mapping[str, Any]) -> Dict[str, Any]:
+    ret = dict(event)
+    ret["id"] = event_id
+    return ret
 
 # maps queue ids to client descriptors
 clients = {}  # type: Dict[str, ClientDescriptor]
@@ -326,6 +366,25 @@ clients = {}  # type: Dict[str, ClientDescriptor]
 user_clients = {}  # type: Dict[int, List[ClientDescriptor]]
 # maps realm id to list of client descriptors with all_public_streams=True
 realm_clients_all_streams = {}  # type: Dict[int, List[ClientDescriptor]]
+# heap of (expiry time, queue id) for each queue, so that GC doesn't
+# have to scan all the queues.  Entries aren't updated when a client
+# reconnects; instead, gc_event_queues pushes a new entry for a queue
+# that turns out not to be expired yet.  Entries for queues that were
+# deleted by other means are skipped when popped.
+queue_expiry_heap = []  # type: List[Tuple[float, str]]
+
+# Serialized client descriptors, by queue ID, that we have read from
+# disk on startup but not yet deserialized into `clients`.
+unloaded_clients = OrderedDict()  # type: MutableMapping[str, str]
+# The IDs of the queues in unloaded_clients, by user ID and (for
+# queues that would be in realm_clients_all_streams) by realm ID, so
+# that process_notification can load the queues an event is for.
+# These may contain queues that have since been loaded.
+unloaded_user_clients = {}  # type: Dict[int, List[str]]
+unloaded_realm_clients_all_streams = {}  # type: Dict[int, List[str]]
+# Whether unloaded_clients came from a snapshot taken before a crash,
+# rather than a dump on clean shutdown.
+unloaded_clients_from_snapshot = False
 
 # list of registered gc hooks.
 # each one will be called with a user profile id, queue, and bool
@@ -341,15 +400,25 @@ def clear_client_event_queues_for_testing() -> None:
     clients.clear()
     user_clients.clear()
     realm_clients_all_streams.clear()
+    queue_expiry_heap.clear()
     gc_hooks.clear()
-    global next_queue_id
+    unloaded_clients.clear()
+    unloaded_user_clients.clear()
+    unloaded_realm_clients_all_streams.clear()
+    global next_queue_id, unloaded_clients_from_snapshot
     next_queue_id = 0
+    unloaded_clients_from_snapshot = False
 
 def add_client_gc_hook(hook: Callable[[int, ClientDescriptor, bool], None]) -> None:
     gc_hooks.append(hook)
 
 def get_client_descriptor(queue_id: str) -> ClientDescriptor:
-    return clients.get(queue_id)
+    client = clients.get(queue_id)
+    if client is None and queue_id in unloaded_clients:
+        # We're still loading event queues after a restart; load
+        # this one right away, so that its client can be served.
+        client = load_client_descriptor(queue_id)
+    return client
 
 def get_client_descriptors_for_user(user_profile_id: int) -> List[ClientDescriptor]:
     return user_clients.get(user_profile_id, [])
@@ -361,6 +430,7 @@ def add_to_client_dicts(client: ClientDescriptor) -> None:
     user_clients.setdefault(client.user_profile_id, []).append(client)
     if client.all_public_streams or client.narrow != []:
         realm_clients_all_streams.setdefault(client.realm_id, []).append(client)
+    heapq.heappush(queue_expiry_heap, (client.expiry_time(), client.event_queue.id))
 
 def allocate_client_descriptor(new_queue_data: MutableMapping[str, Any]) -> ClientDescriptor:
     global next_queue_id
@@ -400,22 +470,35 @@ def gc_event_queues(port: int) -> None:
     to_remove = set()  # type: Set[str]
     affected_users = set()  # type: Set[int]
     affected_realms = set()  # type: Set[int]
-    for (id, client) in clients.items():
+    while len(queue_expiry_heap) != 0 and queue_expiry_heap[0][0] <= start:
+        (expiry_time, id) = heapq.heappop(queue_expiry_heap)
+        client = clients.get(id)
+        if client is None:
+            # Already deleted, e.g. by ClientDescriptor.cleanup.
+            continue
         if client.expired(start):
             to_remove.add(id)
             affected_users.add(client.user_profile_id)
             affected_realms.add(client.realm_id)
+        else:
+            # The client has reconnected since this entry was pushed,
+            # or is connected right now; check again later.
+            next_check = max(client.expiry_time(), start + EVENT_QUEUE_GC_FREQ_MSECS / 1000)
+            heapq.heappush(queue_expiry_heap, (next_check, id))
 
     # We don't need to call e.g. finish_current_handler on the clients
     # being removed because they are guaranteed to be idle (because
     # they are expired) and thus not have a current handler.
     do_gc_event_queues(to_remove, affected_users, affected_realms)
 
+    gc_time = time.time() - start
     if settings.PRODUCTION:
         logging.info(('Tornado %d removed %d expired event queues owned by %d users in %.3fs.' +
                       '  Now %d active queues, %s')
-                     % (port, len(to_remove), len(affected_users), time.time() - start,
+                     % (port, len(to_remove), len(affected_users), gc_time,
                         len(clients), handler_stats_string()))
+    statsd.timing('tornado.gc_event_queues.time', 1000 * gc_time)
+    statsd.incr('tornado.gc_event_queues.removed', len(to_remove))
     statsd.gauge('tornado.active_queues', len(clients))
     statsd.gauge('tornado.active_users', len(user_clients))
 
@@ -429,41 +512,179 @@ def persistent_queue_filename(port: int, last: bool=False) -> str:
         return settings.JSON_PERSISTENT_QUEUE_FILENAME_PATTERN % ('.' + str(port) + '.last',)
     return settings.JSON_PERSISTENT_QUEUE_FILENAME_PATTERN % ('.' + str(port),)
 
+# Event queues are persisted as one line per queue, after a JSON
+# header line.  Each line contains, separated by tabs, the queue ID,
+# the user and realm IDs, whether the queue gets all of the realm's
+# public stream messages, and the JSON-encoded ClientDescriptor.  This
+# lets us read the file, and find the queues an event is for, without
+# deserializing every queue up front; see load_event_queues.
+EVENT_QUEUE_FILE_FORMAT_VERSION = 3
+
+snapshot_in_progress = False
+
+def serialize_client_descriptor(queue_id: str, client: ClientDescriptor) -> str:
+    all_streams = client.all_public_streams or client.narrow != []
+    return "%s\t%d\t%d\t%d\t%s\n" % (queue_id, client.user_profile_id, client.realm_id,
+                                    all_streams, ujson.dumps(client.to_dict()))
+
+def event_queue_file_header(clean_shutdown: bool) -> str:
+    return ujson.dumps(dict(version=EVENT_QUEUE_FILE_FORMAT_VERSION,
+                            clean_shutdown=clean_shutdown)) + "\n"
+
 def dump_event_queues(port: int) -> None:
     start = time.time()
 
-    with open(persistent_queue_filename(port), "w") as stored_queues:
-        ujson.dump([(qid, client.to_dict()) for (qid, client) in clients.items()],
-                   stored_queues)
+    if unloaded_clients_from_snapshot:
+        # Queues restored from a snapshot must stay marked as such
+        # (see fetch_events), and only loaded queues record that.
+        for qid in list(unloaded_clients.keys()):
+            load_client_descriptor(qid)
+
+    filename = persistent_queue_filename(port)
+    with open(filename + ".tmp", "w") as stored_queues:
+        stored_queues.write(event_queue_file_header(clean_shutdown=True))
+        for (qid, client) in clients.items():
+            stored_queues.write(serialize_client_descriptor(qid, client))
+        # Queues that we never got around to loading are written back
+        # as-is, so they aren't lost by a quick restart.
+        for (qid, data) in unloaded_clients.items():
+            stored_queues.write("%s\t%s\n" % (qid, data))
+    os.rename(filename + ".tmp", filename)
 
     logging.info('Tornado %d dumped %d event queues in %.3fs'
-                 % (port, len(clients), time.time() - start))
+                 % (port, len(clients) + len(unloaded_clients), time.time() - start))
+
+def snapshot_event_queues(port: int) -> None:
+    """Writes a snapshot of all event queues to the persistent queue file,
+    to be loaded on restart if Tornado exits without running
+    dump_event_queues.  Queues are serialized in batches across ioloop
+    callbacks; a queue removed or added while the snapshot is in
+    progress is simply left out of it."""
+    global snapshot_in_progress
+    if snapshot_in_progress or unloaded_clients:
+        return
+    snapshot_in_progress = True
+
+    start = time.time()
+    queue_ids = list(clients.keys())
+    filename = persistent_queue_filename(port)
+    stored_queues = open(filename + ".snapshot", "w")
+    stored_queues.write(event_queue_file_header(clean_shutdown=False))
+
+    def write_batch(offset: int) -> None:
+        global snapshot_in_progress
+        try:
+            for qid in queue_ids[offset:offset + EVENT_QUEUE_PERSISTENCE_BATCH_SIZE]:
+                client = clients.get(qid)
+                if client is not None:
+                    stored_queues.write(serialize_client_descriptor(qid, client))
+            offset += EVENT_QUEUE_PERSISTENCE_BATCH_SIZE
+            if offset < len(queue_ids):
+                tornado.ioloop.IOLoop.instance().add_callback(write_batch, offset)
+                return
+            stored_queues.close()
+            os.rename(filename + ".snapshot", filename)
+            snapshot_in_progress = False
+        except Exception:
+            logging.exception("Tornado %d could not snapshot event queues" % (port,))
+            stored_queues.close()
+            snapshot_in_progress = False
+            return
+
+        logging.info('Tornado %d snapshotted %d event queues in %.3fs'
+                     % (port, len(queue_ids), time.time() - start))
+
+    write_batch(0)
 
 def load_event_queues(port: int) -> None:
-    global clients
+    """Reads the event queues persisted by the last Tornado process into
+    unloaded_clients; they are deserialized later, by
+    load_event_queue_batch or on demand by get_client_descriptor."""
+    global unloaded_clients_from_snapshot
     start = time.time()
 
-    # ujson chokes on bad input pretty easily.  We separate out the actual
-    # file reading from the loading so that we don't silently fail if we get
-    # bad input.
     try:
         with open(persistent_queue_filename(port), "r") as stored_queues:
-            json_data = stored_queues.read()
-        try:
-            clients = dict((qid, ClientDescriptor.from_dict(client))
-                           for (qid, client) in ujson.loads(json_data))
-        except Exception:
-            logging.exception("Tornado %d could not deserialize event queues" % (port,))
+            header_line = stored_queues.readline()
+            try:
+                header = ujson.loads(header_line)
+                if isinstance(header, list):
+                    # Legacy format: the whole file is a single JSON
+                    # list of (queue ID, client descriptor) pairs.
+                    for (qid, client) in header:
+                        clients[qid] = ClientDescriptor.from_dict(client)
+                        add_to_client_dicts(clients[qid])
+                elif header["version"] < 3:
+                    # Lines don't say who the queue is for, so we
+                    # can't defer deserializing them; see
+                    # process_notification.
+                    for line in stored_queues:
+                        (qid, data) = line.rstrip("\n").split("\t", 1)
+                        clients[qid] = ClientDescriptor.from_dict(ujson.loads(data))
+                        add_to_client_dicts(clients[qid])
+                else:
+                    unloaded_clients_from_snapshot = not header["clean_shutdown"]
+                    for line in stored_queues:
+                        (qid, data) = line.rstrip("\n").split("\t", 1)
+                        (user_profile_id, realm_id, all_streams, ignored) = data.split("\t", 3)
+                        unloaded_clients[qid] = data
+                        unloaded_user_clients.setdefault(int(user_profile_id), []).append(qid)
+                        if all_streams == "1":
+                            unloaded_realm_clients_all_streams.setdefault(
+                                int(realm_id), []).append(qid)
+            except Exception:
+                logging.exception("Tornado %d could not deserialize event queues" % (port,))
     except (IOError, EOFError):
         pass
 
-    for client in clients.values():
-        # Put code for migrations due to event queue data format changes here
+    logging.info('Tornado %d read %d event queues%s in %.3fs'
+                 % (port, len(clients) + len(unloaded_clients),
+                    " from a snapshot" if unloaded_clients_from_snapshot else "",
+                    time.time() - start))
+
+def load_client_descriptor(queue_id: str) -> Optional[ClientDescriptor]:
+    data = unloaded_clients.pop(queue_id)
+    try:
+        client = ClientDescriptor.from_dict(ujson.loads(data.split("\t", 3)[3]))
+    except Exception:
+        logging.exception("Tornado could not deserialize event queue %s" % (queue_id,))
+        return None
+
+    # Put code for migrations due to event queue data format changes here
+
+    if unloaded_clients_from_snapshot and client.event_queue.snapshot_next_event_id is None:
+        client.event_queue.snapshot_next_event_id = client.event_queue.next_event_id
+    clients[queue_id] = client
+    add_to_client_dicts(client)
+    return client
 
-        add_to_client_dicts(client)
+def load_event_queue_batch(port: int, start: float) -> None:
+    for qid in list(itertools.islice(unloaded_clients.keys(), EVENT_QUEUE_PERSISTENCE_BATCH_SIZE)):
+        load_client_descriptor(qid)
+    if unloaded_clients:
+        tornado.ioloop.IOLoop.instance().add_callback(load_event_queue_batch, port, start)
+        return
 
+    unloaded_user_clients.clear()
+    unloaded_realm_clients_all_streams.clear()
     logging.info('Tornado %d loaded %d event queues in %.3fs'
                  % (port, len(clients), time.time() - start))
+    send_restart_events(immediate=settings.DEVELOPMENT)
+
+def load_client_descriptors_for_notice(event: Mapping[str, Any],
+                                       users: Union[List[int], List[Mapping[str, Any]]]) -> None:
+    """Loads the not-yet-loaded event queues that might receive this
+    event, so that it can be processed without waiting for all event
+    queues to be loaded."""
+    queue_ids = []  # type: List[str]
+    for user in users:
+        user_profile_id = user if isinstance(user, int) else user['id']
+        queue_ids += unloaded_user_clients.pop(user_profile_id, [])
+    if event['type'] == "message" and 'realm_id' in event:
+        queue_ids += unloaded_realm_clients_all_streams.pop(event['realm_id'], [])
+    for qid in queue_ids:
+        if qid in unloaded_clients:
+            load_client_descriptor(qid)
 
 def send_restart_events(immediate: bool=False) -> None:
     event = dict(type='restart', server_generation=settings.SERVER_GENERATION)  # type: Dict[str, Any]
@@ -471,7 +692,7 @@ def send_restart_events(immediate: bool=False) -> None:
         event['immediate'] = True
     for client in clients.values():
         if client.accepts_event(event):
-            client.add_event(event.copy())
+            client.add_event(event)
 
 def setup_event_queue(port: int) -> None:
     if not settings.TEST_SUITE:
@@ -492,7 +713,17 @@ def setup_event_queue(port: int) -> None:
                                          EVENT_QUEUE_GC_FREQ_MSECS, ioloop)
     pc.start()
 
-    send_restart_events(immediate=settings.DEVELOPMENT)
+    if not settings.TEST_SUITE:
+        snapshot_pc = tornado.ioloop.PeriodicCallback(lambda: snapshot_event_queues(port),
+                                                      EVENT_QUEUE_SNAPSHOT_FREQ_MSECS, ioloop)
+        snapshot_pc.start()
+
+    if unloaded_clients:
+        # Deserialize the event queues we read in the background;
+        # this sends the restart events once it's done.
+        ioloop.add_callback(load_event_queue_batch, port, time.time())
+    else:
+        send_restart_events(immediate=settings.DEVELOPMENT)
 
 def fetch_events(query: Mapping[str, Any]) -> Dict[str, Any]:
     queue_id = query["queue_id"]  # type: str
@@ -522,6 +753,15 @@ def fetch_events(query: Mapping[str, Any]) -> Dict[str, Any]:
                 raise BadEventQueueIdError(queue_id)
             if user_profile_id != client.user_profile_id:
                 raise JsonableError(_("You are not authorized to get events from this queue"))
+            snapshot_next_event_id = client.event_queue.snapshot_next_event_id
+            if snapshot_next_event_id is not None:
+                if last_event_id >= snapshot_next_event_id:
+                    # Tornado crashed after giving the client events
+                    # newer than the snapshot this queue was restored
+                    # from; those are lost, and new events will reuse
+                    # their IDs, so make the client reload.
+                    raise BadEventQueueIdError(queue_id)
+                client.event_queue.snapshot_next_event_id = None
             client.event_queue.prune(last_event_id)
             was_connected = client.finish_current_handler()
 
@@ -790,6 +1030,7 @@ def process_message_event(event_template: Mapping[str, Any], users: Iterable[Map
     https://zulip.readthedocs.io/en/latest/subsystems/sending-messages.html
     for high-level documentation on this subsystem.
     """
+    start_time = time.time()
     send_to_clients = get_client_info_for_message_event(event_template, users)
 
     presence_idle_user_ids = set(event_template.get('presence_idle_user_ids', []))
@@ -833,6 +1074,13 @@ def process_message_event(event_template: Mapping[str, Any], users: Iterable[Map
             result['stream_email_notify'] = stream_email_notify
             extra_user_data[user_profile_id] = result
 
+    # Many clients (e.g. every open browser tab of every subscriber of
+    # a large stream) receive exactly the same event, so we build the
+    # event, and check it against the client's narrow, once per group
+    # of identical clients rather than once per client.
+    shared_events = {}  # type: Dict[Tuple[Any, ...], Optional[Dict[str, Any]]]
+    num_clients = 0
+
     for client_data in send_to_clients.values():
         client = client_data['client']
         flags = client_data['flags']
@@ -845,36 +1093,56 @@ def process_message_event(event_template: Mapping[str, Any], users: Iterable[Map
             # message data unnecessarily
             continue
 
-        message_dict = get_client_payload(client.apply_markdown, client.client_gravatar)
+        # The below prevents (Zephyr) mirroring loops.
+        if ('mirror' in sending_client and
+                sending_client.lower() == client.client_type_name.lower()):
+            continue
 
         # Make sure Zephyr mirroring bots know whether stream is invite-only
-        if "mirror" in client.client_type_name and event_template.get("invite_only"):
-            message_dict = message_dict.copy()
-            message_dict["invite_only_stream"] = True
-
-        user_event = dict(type='message', message=message_dict, flags=flags)  # type: Dict[str, Any]
-        if extra_data is not None:
-            user_event.update(extra_data)
-
+        invite_only_mirror = bool("mirror" in client.client_type_name and
+                                  event_template.get("invite_only"))
+        local_message_id = None
         if is_sender:
             local_message_id = event_template.get('local_id', None)
+
+        group_key = (client.apply_markdown, client.client_gravatar, invite_only_mirror,
+                     tuple(flags), tuple(tuple(element) for element in client.narrow),
+                     tuple(sorted(extra_data.items())) if extra_data is not None else None,
+                     local_message_id)
+        if group_key not in shared_events:
+            message_dict = get_client_payload(client.apply_markdown, client.client_gravatar)
+            if invite_only_mirror:
+                message_dict = message_dict.copy()
+                message_dict["invite_only_stream"] = True
+
+            user_event = dict(type='message', message=message_dict, flags=flags)  # type: Dict[str, Any]
+            if extra_data is not None:
+                user_event.update(extra_data)
             if local_message_id is not None:
                 user_event["local_message_id"] = local_message_id
 
-        if not client.accepts_event(user_event):
-            continue
+            # accepts_event only depends on the client's event_types
+            # (already checked by accepts_messages above) and narrow,
+            # which are part of the group key.
+            shared_events[group_key] = user_event if client.accepts_event(user_event) else None
 
-        # The below prevents (Zephyr) mirroring loops.
-        if ('mirror' in sending_client and
-                sending_client.lower() == client.client_type_name.lower()):
+        shared_event = shared_events[group_key]
+        if shared_event is None:
             continue
-        client.add_event(user_event)
+
+        client.add_event(shared_event)
+        num_clients += 1
+
+    fanout_time = time.time() - start_time
+    statsd.timing("tornado.message_fanout.time", 1000 * fanout_time)
+    logging.debug("Tornado: Message %s fanned out to %d clients in %d groups in %sms" % (
+        message_id, num_clients, len(shared_events), int(1000 * fanout_time)))
 
 def process_event(event: Mapping[str, Any], users: Iterable[int]) -> None:
     for user_profile_id in users:
         for client in get_client_descriptors_for_user(user_profile_id):
             if client.accepts_event(event):
-                client.add_event(dict(event))
+                client.add_event(event)
 
 def process_userdata_event(event_template: Mapping[str, Any], users: Iterable[Mapping[str, Any]]) -> None:
     for user_data in users:
@@ -978,9 +1246,19 @@ def maybe_enqueue_notifications_for_message_update(user_profile_id: UserProfile,
     )
 
 def process_notification(notice: Mapping[str, Any]) -> None:
+    if 'notices' in notice:
+        # A batch of notices from send_events, which we process in
+        # the order they were sent.
+        for batched_notice in notice['notices']:
+            process_notification(batched_notice)
+        return
+
     event = notice['event']  # type: Mapping[str, Any]
     users = notice['users']  # type: Union[List[int], List[Mapping[str, Any]]]
     start_time = time.time()
+    if unloaded_clients:
+        # We're still loading event queues after a restart.
+        load_client_descriptors_for_notice(event, users)
     if event['type'] == "message":
         process_message_event(event, cast(Iterable[Mapping[str, Any]], users))
     elif event['type'] == "update_message":
@@ -1003,6 +1281,9 @@ def send_notification_http(realm: Realm, data: Mapping[str, Any]) -> None:
         requests_client.post(tornado_uri + '/notify_tornado', data=dict(
             data   = ujson.dumps(data),
             secret = settings.SHARED_SECRET))
+    elif 'notices' in data:
+        for notice in data['notices']:
+            process_notification(notice)
     else:
         process_notification(data)
 
@@ -1012,6 +1293,35 @@ def send_event(realm: Realm, event: Mapping[str, Any],
     events, a list of dicts describing the users and metadata about
     the user/message pair."""
     port = get_tornado_port(realm)
+    notice = dict(event=event, users=users)
+    if (settings.USING_TORNADO_NOTIFY_SOCKET and not settings.RUNNING_INSIDE_TORNADO and
+            send_notices_via_socket(port, [notice])):
+        return
     queue_json_publish(notify_tornado_queue_name(port),
-                       dict(event=event, users=users),
+                       notice,
                        lambda *args, **kwargs: send_notification_http(realm, *args, **kwargs))
+
+def send_events(notices: Iterable[Tuple[Realm, Mapping[str, Any],
+                                        Union[Iterable[int], Iterable[Mapping[str, Any]]]]]) -> None:
+    """Like send_event, for a sequence of (realm, event, users) tuples.
+    Notices for the same Tornado process are delivered as a single
+    batch, which Tornado processes in order; this saves a round trip
+    per event when sending many events at once (e.g. bulk message
+    sends)."""
+    batches = OrderedDict()  # type: Dict[int, Tuple[Realm, List[Dict[str, Any]]]]
+    for (realm, event, users) in notices:
+        port = get_tornado_port(realm)
+        if port not in batches:
+            batches[port] = (realm, [])
+        batches[port][1].append(dict(event=event, users=users))
+
+    for port, (realm, batch) in batches.items():
+        if len(batch) == 1:
+            send_event(realm, batch[0]['event'], batch[0]['users'])
+            continue
+        if (settings.USING_TORNADO_NOTIFY_SOCKET and not settings.RUNNING_INSIDE_TORNADO and
+                send_notices_via_socket(port, batch)):
+            continue
+        queue_json_publish(notify_tornado_queue_name(port),
+                           dict(notices=batch),
+                           lambda *args, **kwargs: send_notification_http(realm, *args, **kwargs))
@@ -0,0 +1,98 @@
+# An optional transport for delivering events from Django to a
+# Tornado process on the same host, over a Unix socket, rather than
+# via RabbitMQ.  Each write on the socket is a batch of notices (the
+# same `dict(event=..., users=...)` objects we'd otherwise publish to
+# the notify_tornado queue), JSON-encoded and prefixed with its
+# length.
+#
+# RabbitMQ remains the fallback: if the socket can't be written to
+# (e.g. because Tornado is restarting), send_event publishes to the
+# queue as usual.
+import logging
+import socket
+import struct
+import threading
+from typing import Any, Callable, Generator, Iterable, Mapping
+
+import ujson
+from django.conf import settings
+from tornado import gen
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.netutil import bind_unix_socket
+from tornado.tcpserver import TCPServer
+
+# Big-endian unsigned 32-bit payload length.
+FRAME_HEADER_FORMAT = "!I"
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_HEADER_FORMAT)
+
+# Writes should never block for long, since Tornado reads
+# continuously; if they do, we'd rather fall back to RabbitMQ.
+NOTIFY_SOCKET_TIMEOUT_SECS = 1
+
+def notify_socket_path(port: int) -> str:
+    return settings.TORNADO_NOTIFY_SOCKET_PATTERN % ('.' + str(port),)
+
+def encode_notice_batch(notices: Iterable[Mapping[str, Any]]) -> bytes:
+    payload = ujson.dumps(list(notices)).encode("utf-8")
+    return struct.pack(FRAME_HEADER_FORMAT, len(payload)) + payload
+
+# Each thread of a Django process keeps its own connection to each
+# Tornado port, so that batches from different threads can't be
+# interleaved on the socket.
+connections = threading.local()
+
+def send_notices_via_socket(port: int, notices: Iterable[Mapping[str, Any]]) -> bool:
+    """Returns whether the notices were written to the socket for the
+    Tornado process on the given port; the caller is responsible for
+    falling back to RabbitMQ if not."""
+    frame = encode_notice_batch(notices)
+    path = notify_socket_path(port)
+    if not hasattr(connections, "sockets"):
+        connections.sockets = {}
+
+    # If Tornado was restarted since we connected, our first write
+    # fails, so we retry once with a new connection.
+    for attempt in range(2):
+        sock = connections.sockets.get(path)
+        try:
+            if sock is None:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(NOTIFY_SOCKET_TIMEOUT_SECS)
+                sock.connect(path)
+                connections.sockets[path] = sock
+            sock.sendall(frame)
+            return True
+        except OSError:
+            # A partially written frame is discarded by Tornado when
+            # the connection is closed, so it's safe to resend it.
+            if sock is not None:
+                sock.close()
+            connections.sockets.pop(path, None)
+    return False
+
+class NotifySocketServer(TCPServer):
+    def __init__(self, process_notification: Callable[[Mapping[str, Any]], None]) -> None:
+        super().__init__()
+        self.process_notification = process_notification
+
+    @gen.coroutine
+    def handle_stream(self, stream: IOStream, address: Any) -> Generator[Any, Any, None]:
+        try:
+            while True:
+                header = yield stream.read_bytes(FRAME_HEADER_SIZE)
+                (length,) = struct.unpack(FRAME_HEADER_FORMAT, header)
+                payload = yield stream.read_bytes(length)
+                for notice in ujson.loads(payload.decode("utf-8")):
+                    try:
+                        self.process_notification(notice)
+                    except Exception:
+                        logging.exception("Error processing notification from notify socket")
+        except StreamClosedError:
+            pass
+
+def setup_notify_socket(port: int,
+                        process_notification: Callable[[Mapping[str, Any]], None]) -> None:
+    server = NotifySocketServer(process_notification)
+    # bind_unix_socket replaces any stale socket left by a previous
+    # Tornado process.
+    server.add_socket(bind_unix_socket(notify_socket_path(port), mode=0o600))
@@ -2,12 +2,73 @@ from django.conf import settings
 
 from zerver.models import Realm
 
+# When running multiple Tornado processes, they listen on consecutive
+# ports starting here; this must match the supervisor and nginx
+# configuration in puppet/zulip/.
+TORNADO_SHARD_BASE_PORT = 9800
+
+def murmur_hash2(data: bytes) -> int:
+    """A port of nginx's ngx_murmur_hash2, which is the hash used by its
+    `split_clients` directive.  We need a bit-for-bit identical
+    implementation so that Django and nginx agree on which Tornado
+    shard serves a realm that isn't listed in TORNADO_SHARDING_MAP."""
+    m = 0x5bd1e995
+    length = len(data)
+    h = length & 0xffffffff
+    index = 0
+    while length >= 4:
+        k = (data[index] | (data[index + 1] << 8) |
+             (data[index + 2] << 16) | (data[index + 3] << 24))
+        k = (k * m) & 0xffffffff
+        k ^= k >> 24
+        k = (k * m) & 0xffffffff
+        h = (h * m) & 0xffffffff
+        h ^= k
+        index += 4
+        length -= 4
+
+    if length == 3:
+        h ^= data[index + 2] << 16
+    if length >= 2:
+        h ^= data[index + 1] << 8
+    if length >= 1:
+        h ^= data[index]
+        h = (h * m) & 0xffffffff
+
+    h ^= h >> 13
+    h = (h * m) & 0xffffffff
+    h ^= h >> 15
+    return h
+
+def get_hashed_shard_index(host: str, num_processes: int) -> int:
+    """Mirrors nginx's split_clients lookup over `$host`, as configured
+    in puppet/zulip/templates/nginx/tornado-upstreams.template.erb:
+    num_processes - 1 equal buckets of (10000 // num_processes)
+    hundredths of a percent each, then a final catch-all bucket."""
+    # nginx's $host is lowercased and never includes the port.
+    host = host.split(":")[0].lower()
+    hash_value = murmur_hash2(host.encode("utf-8"))
+    percent = 10000 // num_processes
+    last = 0
+    for index in range(num_processes - 1):
+        last += percent * 0xffffffff // 10000
+        if hash_value < last:
+            return index
+    return num_processes - 1
+
+def get_tornado_port_for_host(host: str) -> int:
+    host = host.split(":")[0].lower()
+    if host in settings.TORNADO_SHARDING_MAP:
+        return int(settings.TORNADO_SHARDING_MAP[host])
+    index = get_hashed_shard_index(host, settings.TORNADO_PROCESSES)
+    return TORNADO_SHARD_BASE_PORT + index
+
 def get_tornado_port(realm: Realm) -> int:
     if settings.TORNADO_SERVER is None:
         return 9993
     if settings.TORNADO_PROCESSES == 1:
         return int(settings.TORNADO_SERVER.split(":")[-1])
-    return 9993
+    return get_tornado_port_for_host(realm.host)
 
 def get_tornado_uri(realm: Realm) -> str:
     if settings.TORNADO_PROCESSES == 1:
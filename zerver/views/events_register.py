@@ -3,6 +3,7 @@ from django.http import HttpRequest, HttpResponse
 from typing import Dict, Iterable, Optional, Sequence
 
 from zerver.lib.events import do_events_register
+from zerver.lib.profile import SectionTimer
 from zerver.lib.request import REQ, has_request_variables
 from zerver.lib.response import json_success
 from zerver.lib.validator import check_dict, check_string, check_list, check_bool
@@ -36,6 +37,7 @@ def events_register_backend(
         event_types: Optional[Iterable[str]]=REQ(validator=check_list(check_string), default=None),
         fetch_event_types: Optional[Iterable[str]]=REQ(validator=check_list(check_string), default=None),
         narrow: NarrowT=REQ(validator=check_list(check_list(check_string, length=2)), default=[]),
+        deferred_event_types: Iterable[str]=REQ(validator=check_list(check_string), default=[]),
         queue_lifespan_secs: int=REQ(converter=int, default=0, documentation_pending=True)
 ) -> HttpResponse:
     all_public_streams = _default_all_public_streams(user_profile, all_public_streams)
@@ -45,9 +47,13 @@ def events_register_backend(
         client_capabilities = {}
     notification_settings_null = client_capabilities.get("notification_settings_null", False)
 
+    section_timer = SectionTimer()
     ret = do_events_register(user_profile, request.client, apply_markdown, client_gravatar,
                              event_types, queue_lifespan_secs, all_public_streams,
                              narrow=narrow, include_subscribers=include_subscribers,
                              notification_settings_null=notification_settings_null,
-                             fetch_event_types=fetch_event_types)
+                             fetch_event_types=fetch_event_types,
+                             section_timer=section_timer,
+                             deferred_event_types=deferred_event_types)
+    request._log_data['extra'] = "[%s]" % (section_timer.format(),)
     return json_success(ret)
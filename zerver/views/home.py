@@ -23,6 +23,7 @@ from zerver.lib.avatar import avatar_url
 from zerver.lib.i18n import get_language_list, get_language_name, \
     get_language_list_for_templates, get_language_translation_data
 from zerver.lib.json_encoder_for_html import JSONEncoderForHTML
+from zerver.lib.profile import SectionTimer
 from zerver.lib.push_notifications import num_push_devices_for_user
 from zerver.lib.streams import access_stream_by_name
 from zerver.lib.subdomains import get_subdomain
@@ -127,10 +128,11 @@ def home_real(request: HttpRequest) -> HttpResponse:
         if narrow_stream is not None and narrow_topic is not None:
             narrow.append(["topic", narrow_topic])
 
+    section_timer = SectionTimer()
     register_ret = do_events_register(user_profile, request.client,
                                       apply_markdown=True, client_gravatar=True,
                                       notification_settings_null=True,
-                                      narrow=narrow)
+                                      narrow=narrow, section_timer=section_timer)
     user_has_messages = (register_ret['max_message_id'] != -1)
 
     # Reset our don't-spam-users-with-email counter since the
@@ -269,7 +271,8 @@ def home_real(request: HttpRequest) -> HttpResponse:
         if user_profile.realm.plan_type == Realm.LIMITED:
             show_plans = True
 
-    request._log_data['extra'] = "[%s]" % (register_ret["queue_id"],)
+    request._log_data['extra'] = "[%s] [%s]" % (register_ret["queue_id"],
+                                                 section_timer.format())
 
     page_params['translation_data'] = {}
     if request_language != 'en':
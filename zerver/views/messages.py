@@ -53,7 +53,7 @@ from zerver.models import Message, UserProfile, Stream, Subscription, Client,\
     get_user_including_cross_realm, get_stream_recipient
 
 from sqlalchemy import func
-from sqlalchemy.sql import select, join, column, literal_column, literal, and_, \
+from sqlalchemy.sql import select, join, outerjoin, column, literal_column, literal, and_, \
     or_, not_, union_all, alias, Selectable, ColumnElement, table
 
 from dateutil.parser import parse as dateparser
@@ -819,7 +819,23 @@ def get_messages_backend(request: HttpRequest, user_profile: UserProfile,
     )
 
     main_query = alias(query)
-    query = select(main_query.c, None, main_query).order_by(column("message_id").asc())
+    if include_history:
+        # Fetch the user's flags for the messages they have
+        # UserMessage rows for in the same query, with an outer join
+        # (so that the rows have the same shape as in the
+        # need_user_message case).
+        query = select(
+            [main_query.c.message_id, literal_column("zerver_usermessage.flags")] +
+            [col for col in main_query.c if col.name != "message_id"],
+            None,
+            outerjoin(main_query, table("zerver_usermessage"), and_(
+                literal_column("zerver_usermessage.message_id") == main_query.c.message_id,
+                literal_column("zerver_usermessage.user_profile_id") == literal(user_profile.id),
+            )),
+        )
+    else:
+        query = select(main_query.c, None, main_query)
+    query = query.order_by(column("message_id").asc())
     # This is a hack to tag the query we use for testing
     query = query.prefix_with("/* get_messages */")
     rows = list(sa_conn.execute(query).fetchall())
@@ -845,23 +861,16 @@ def get_messages_backend(request: HttpRequest, user_profile: UserProfile,
     # 'messages' list.
     message_ids = []  # type: List[int]
     user_message_flags = {}  # type: Dict[int, List[str]]
-    if include_history:
-        message_ids = [row[0] for row in rows]
-
-        # TODO: This could be done with an outer join instead of two queries
-        um_rows = UserMessage.objects.filter(user_profile=user_profile,
-                                             message__id__in=message_ids)
-        user_message_flags = {um.message_id: um.flags_list() for um in um_rows}
-
-        for message_id in message_ids:
-            if message_id not in user_message_flags:
-                user_message_flags[message_id] = ["read", "historical"]
-    else:
-        for row in rows:
-            message_id = row[0]
-            flags = row[1]
+    for row in rows:
+        message_id = row[0]
+        flags = row[1]
+        if flags is None:
+            # Only possible with include_history, for messages the
+            # user doesn't have a UserMessage row for.
+            user_message_flags[message_id] = ["read", "historical"]
+        else:
             user_message_flags[message_id] = UserMessage.flags_list_for_flags(flags)
-            message_ids.append(message_id)
+        message_ids.append(message_id)
 
     search_fields = dict()  # type: Dict[int, Dict[str, str]]
     if is_search:
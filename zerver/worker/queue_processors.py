@@ -18,6 +18,7 @@ from zerver.models import \
     get_client, get_system_bot, PreregistrationUser, \
     get_user_profile_by_id, Message, Realm, UserMessage, UserProfile, \
     Client
+from zerver.lib.cache import check_local_cache_generation
 from zerver.lib.context_managers import lockfile
 from zerver.lib.error_notify import do_report_error
 from zerver.lib.feedback import handle_feedback
@@ -31,7 +32,8 @@ from zerver.lib.actions import do_send_confirmation_email, \
     internal_send_message, internal_send_private_message, notify_export_completed, \
     render_incoming_message, do_update_embedded_data, do_mark_stream_messages_as_read
 from zerver.lib.url_preview import preview as url_preview
-from zerver.lib.digest import handle_digest_email
+from zerver.lib.digest import handle_digest_email, handle_digest_emails
+from zerver.lib.events import send_deferred_initial_state
 from zerver.lib.send_email import send_future_email, send_email_from_dict, \
     FromAddress, EmailNotDeliveredException, handle_send_email_format_changes
 from zerver.lib.email_mirror import process_message as mirror_email, rate_limit_mirror_by_realm, \
@@ -131,6 +133,7 @@ class QueueProcessingWorker:
 
     def consume_wrapper(self, data: Dict[str, Any]) -> None:
         try:
+            check_local_cache_generation()
             self.consume(data)
         except Exception:
             self._log_problem()
@@ -168,6 +171,7 @@ class LoopQueueProcessingWorker(QueueProcessingWorker):
             # TODO: Probably it'd be better to share code with consume_wrapper()
             events = self.q.drain_queue(self.queue_name, json=True)
             try:
+                check_local_cache_generation()
                 self.consume_batch(events)
             finally:
                 reset_queries()
@@ -479,7 +483,11 @@ class DigestWorker(QueueProcessingWorker):  # nocoverage
     # management command, not here.
     def consume(self, event: Mapping[str, Any]) -> None:
         logging.info("Received digest event: %s" % (event,))
-        handle_digest_email(event["user_profile_id"], event["cutoff"])
+        if "user_profile_ids" in event:
+            handle_digest_emails(event["user_profile_ids"], event["cutoff"])
+        else:
+            # Events queued before digests were handled in batches
+            handle_digest_email(event["user_profile_id"], event["cutoff"])
 
 @assign_queue('email_mirror')
 class MirrorWorker(QueueProcessingWorker):
@@ -611,6 +619,14 @@ class DeferredWorker(QueueProcessingWorker):
                 (stream, recipient, sub) = access_stream_by_id(user_profile, stream_id,
                                                                require_active=False)
                 do_mark_stream_messages_as_read(user_profile, client, stream)
+        elif event['type'] == 'send_deferred_initial_state':
+            user_profile = get_user_profile_by_id(event['user_profile_id'])
+            send_deferred_initial_state(
+                user_profile, event['queue_id'], event['event_types'],
+                client_gravatar=event['client_gravatar'],
+                include_subscribers=event['include_subscribers'],
+                notification_settings_null=event['notification_settings_null'],
+            )
         elif event['type'] == 'realm_exported':
             realm = Realm.objects.get(id=event['realm_id'])
             output_dir = tempfile.mkdtemp(prefix="zulip-export-")
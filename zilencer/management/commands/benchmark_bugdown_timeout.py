@@ -0,0 +1,48 @@
+import time
+from typing import Any, Callable
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.lib import bugdown
+from zerver.lib.timeout import deadline_call, timeout
+
+class Command(BaseCommand):
+    help = """Measure the overhead of enforcing the markdown rendering
+timeout, with a thread per call (timeout) and with a persistent worker
+thread (deadline_call), relative to calling the function directly.
+
+Usage: ./manage.py benchmark_bugdown_timeout --calls=2000"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--calls', dest='calls', type=int, default=2000,
+                            help='Number of calls to time for each method')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        calls = options['calls']
+        content = ("**Hello** world, see https://zulip.com and `code`:\n\n"
+                   "* one\n* two\n\n```python\nprint('three')\n```\n")
+        # Render once normally, to set up the engine with the default
+        # (realm-less) settings; we then call it directly.
+        bugdown.convert(content)
+        md_engine = bugdown.md_engines.get(bugdown.DEFAULT_BUGDOWN_KEY, False)
+
+        def render() -> str:
+            md_engine.reset()
+            return md_engine.convert(content)
+
+        def noop() -> int:
+            return 1
+
+        for (name, func) in [('no-op', noop), ('render', render)]:
+            direct = self.time_calls(calls, func)
+            self.stdout.write("%s: %.1fus per call" % (name, direct))
+            for (method, wrapper) in [('timeout', timeout), ('deadline_call', deadline_call)]:
+                wrapped = self.time_calls(calls, lambda: wrapper(5, func))
+                self.stdout.write("  %15s: %.1fus per call (+%.1fus)" % (
+                    method, wrapped, wrapped - direct))
+
+    def time_calls(self, calls: int, func: Callable[[], Any]) -> float:
+        start = time.time()
+        for i in range(calls):
+            func()
+        return 1000000 * (time.time() - start) / calls
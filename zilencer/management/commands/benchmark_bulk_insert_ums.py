@@ -0,0 +1,48 @@
+import time
+from typing import Any, Callable, List
+
+from django.core.management.base import BaseCommand, CommandParser
+from django.db import connection, transaction
+
+from zerver.lib.actions import UserMessageLite, copy_ums, insert_ums
+from zerver.lib.db import CursorObj
+
+class Command(BaseCommand):
+    help = """Compare inserting the UserMessage rows for a message with a
+single INSERT statement and with COPY, at various numbers of
+recipients, to tune BULK_INSERT_UMS_COPY_THRESHOLD.
+
+The rows are inserted in a transaction that is rolled back, so this
+doesn't leave anything behind (and the IDs don't need to refer to real
+users or messages, since foreign keys are only checked at commit).
+
+Usage: ./manage.py benchmark_bulk_insert_ums --recipients=1000,10000,50000"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--recipients', dest='recipients', type=str,
+                            default='1000,10000,50000',
+                            help='Comma-separated numbers of recipients to time')
+        parser.add_argument('--runs', dest='runs', type=int, default=5,
+                            help='Number of times to insert the rows with each method')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        for num_recipients in [int(n) for n in options['recipients'].split(',')]:
+            ums = [
+                UserMessageLite(user_profile_id=user_profile_id, message_id=1, flags=1)
+                for user_profile_id in range(1, num_recipients + 1)
+            ]
+            self.stdout.write("%d recipients:" % (num_recipients,))
+            for (method, insert) in [('INSERT', insert_ums), ('COPY', copy_ums)]:
+                times = [self.time_insert(insert, ums) for i in range(options['runs'])]
+                self.stdout.write("  %6s: mean %.1fms, min %.1fms" % (
+                    method, 1000 * sum(times) / len(times), 1000 * min(times)))
+
+    def time_insert(self, insert: Callable[[CursorObj, List[UserMessageLite]], None],
+                    ums: List[UserMessageLite]) -> float:
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                start = time.time()
+                insert(cursor, ums)
+                elapsed = time.time() - start
+            transaction.set_rollback(True)
+        return elapsed
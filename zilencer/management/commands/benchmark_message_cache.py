@@ -0,0 +1,49 @@
+import time
+from typing import Any, Callable, List
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.lib.message import MessageDict, extract_message_dict_compact, \
+    extract_message_dict_json, stringify_message_dict_compact, \
+    stringify_message_dict_json
+from zerver.models import Message
+
+class Command(BaseCommand):
+    help = """Compare the formats for message dicts in the remote cache
+(see MESSAGE_CACHE_FORMAT): the time to encode and decode the most
+recent messages in each format, and the bytes they take up.
+
+Usage: ./manage.py benchmark_message_cache --messages=1000"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--messages', dest='messages', type=int, default=1000,
+                            help='Number of recent messages to encode')
+        parser.add_argument('--runs', dest='runs', type=int, default=5,
+                            help='Number of times to encode and decode them')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        ids = list(Message.objects.order_by('-id').values_list(
+            'id', flat=True)[:options['messages']])
+        message_dicts = [MessageDict.build_dict_from_raw_db_row(row)
+                         for row in MessageDict.get_raw_db_rows(ids)]
+        self.stdout.write("%d messages:" % (len(message_dicts),))
+
+        formats = [
+            ('json', stringify_message_dict_json, extract_message_dict_json),
+            ('compact', stringify_message_dict_compact, extract_message_dict_compact),
+        ]
+        for (name, stringify, extract) in formats:
+            encoded = [stringify(message_dict) for message_dict in message_dicts]
+            assert [extract(data) for data in encoded] == message_dicts
+            encode_time = self.time_calls(options['runs'], stringify, message_dicts)
+            decode_time = self.time_calls(options['runs'], extract, encoded)
+            self.stdout.write("  %8s: encode %.1fus, decode %.1fus, %.0f bytes per message" % (
+                name, encode_time, decode_time,
+                sum(len(data) for data in encoded) / max(len(encoded), 1)))
+
+    def time_calls(self, runs: int, func: Callable[[Any], Any], args: List[Any]) -> float:
+        start = time.time()
+        for i in range(runs):
+            for arg in args:
+                func(arg)
+        return 1000000 * (time.time() - start) / max(runs * len(args), 1)
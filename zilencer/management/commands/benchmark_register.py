@@ -0,0 +1,118 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+
+from django.core.management.base import BaseCommand, CommandParser
+from django.utils.timezone import now as timezone_now
+
+from zerver.lib.actions import UserMessageLite, bulk_add_subscriptions, \
+    bulk_insert_ums, create_streams_if_needed, do_create_realm
+from zerver.lib.bulk_create import bulk_create_users
+from zerver.lib.db import reset_queries
+from zerver.lib.events import fetch_initial_state_data, post_process_state
+from zerver.lib.profile import SectionTimer
+from zerver.models import Message, Realm, Recipient, UserProfile, get_client, \
+    get_realm
+
+class Command(BaseCommand):
+    help = """Benchmark the state assembly done by /register (i.e.
+fetch_initial_state_data), section by section, against a synthetic
+realm of the given size.  The realm is created on the first run with a
+given shape, and reused after that.
+
+Usage: ./manage.py benchmark_register --users=1000 --streams=100 --messages=5000"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--users', dest='users', type=int, default=100,
+                            help='Number of users in the realm')
+        parser.add_argument('--streams', dest='streams', type=int, default=20,
+                            help='Number of streams, each of which all users are subscribed to')
+        parser.add_argument('--messages', dest='messages', type=int, default=1000,
+                            help='Number of (unread) stream messages')
+        parser.add_argument('--topics', dest='topics', type=int, default=10,
+                            help='Number of topics per stream')
+        parser.add_argument('--runs', dest='runs', type=int, default=5,
+                            help='Number of times to fetch the initial state')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        realm = self.get_or_create_realm(options['users'], options['streams'],
+                                         options['messages'], options['topics'])
+        user_profile = UserProfile.objects.filter(realm=realm, is_bot=False).order_by('id')[0]
+
+        totals = OrderedDict()  # type: Dict[str, List[Tuple[float, int]]]
+        run_times = []  # type: List[float]
+        for i in range(options['runs']):
+            reset_queries()
+            section_timer = SectionTimer()
+            start = time.time()
+            state = fetch_initial_state_data(user_profile, None, 'benchmark',
+                                             client_gravatar=True,
+                                             section_timer=section_timer)
+            section_timer.start('post_process')
+            post_process_state(user_profile, state, notification_settings_null=False)
+            section_timer.stop()
+            run_times.append(time.time() - start)
+            for (section, timing) in section_timer.sections.items():
+                totals.setdefault(section, []).append(timing)
+
+        self.stdout.write("Realm %s: %d users, %d streams, %d messages" % (
+            realm.string_id, options['users'], options['streams'], options['messages']))
+        self.stdout.write("Total: mean %.1fms, min %.1fms over %d runs" % (
+            1000 * sum(run_times) / len(run_times), 1000 * min(run_times), len(run_times)))
+        sections = sorted(totals.items(),
+                          key=lambda item: -sum(seconds for (seconds, queries) in item[1]))
+        for (section, timings) in sections:
+            self.stdout.write("%30s: mean %7.1fms, min %7.1fms, %3d queries" % (
+                section,
+                1000 * sum(seconds for (seconds, queries) in timings) / len(timings),
+                1000 * min(seconds for (seconds, queries) in timings),
+                timings[-1][1]))
+
+    def get_or_create_realm(self, num_users: int, num_streams: int,
+                            num_messages: int, num_topics: int) -> Realm:
+        string_id = "benchmark-%du-%ds-%dm-%dt" % (num_users, num_streams, num_messages, num_topics)
+        try:
+            return get_realm(string_id)
+        except Realm.DoesNotExist:
+            pass
+
+        self.stdout.write("Creating realm %s..." % (string_id,))
+        realm = do_create_realm(string_id, string_id)
+        bulk_create_users(realm, {
+            ("user%d@%s.example.com" % (i, string_id), "User %d" % (i,), "user%d" % (i,), True)
+            for i in range(num_users)
+        })
+        users = list(UserProfile.objects.filter(realm=realm).order_by('id'))
+
+        (streams, _) = create_streams_if_needed(realm, [
+            {"name": "stream %d" % (i,)} for i in range(num_streams)
+        ])
+        bulk_add_subscriptions(streams, users)
+
+        recipients = list(Recipient.objects.filter(type=Recipient.STREAM,
+                                                   type_id__in=[stream.id for stream in streams]))
+        sending_client = get_client("benchmark_register")
+        now = timezone_now()
+        messages = []  # type: List[Message]
+        for i in range(num_messages):
+            message = Message(
+                sender=users[i % len(users)],
+                recipient=recipients[i % len(recipients)],
+                content="message %d" % (i,),
+                rendered_content="<p>message %d</p>" % (i,),
+                rendered_content_version=1,
+                pub_date=now,
+                sending_client=sending_client,
+            )
+            message.set_topic_name("topic %d" % ((i // len(recipients)) % num_topics,))
+            messages.append(message)
+        Message.objects.bulk_create(messages)
+
+        # Every user is subscribed to every stream, and has every
+        # message unread.
+        for message in messages:
+            bulk_insert_ums([
+                UserMessageLite(user_profile_id=user.id, message_id=message.id, flags=0)
+                for user in users
+            ])
+        return realm
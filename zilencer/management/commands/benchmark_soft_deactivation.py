@@ -0,0 +1,82 @@
+import time
+from typing import Any, List
+
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.db import transaction
+from django.utils.timezone import now as timezone_now
+
+from zerver.lib.soft_deactivation import add_missing_messages, do_soft_deactivate_user
+from zerver.models import Message, Recipient, Subscription, UserMessage, \
+    UserProfile, get_client, get_realm
+
+class Command(BaseCommand):
+    help = """Time catching up a soft-deactivated user (add_missing_messages)
+with backlogs of various sizes: the user is soft-deactivated, the given
+number of messages are sent to the streams they're subscribed to, and
+the user is caught up.
+
+Everything is done in a transaction that is rolled back, so this
+doesn't leave anything behind.
+
+Usage: ./manage.py benchmark_soft_deactivation --realm=zulip --backlogs=1000,10000,100000"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--realm', dest='realm', type=str, default='zulip',
+                            help='String ID of the realm to take the user from')
+        parser.add_argument('--backlogs', dest='backlogs', type=str,
+                            default='1000,10000,100000',
+                            help='Comma-separated numbers of missed messages to time')
+        parser.add_argument('--runs', dest='runs', type=int, default=3,
+                            help='Number of times to catch up each backlog')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        realm = get_realm(options['realm'])
+        user_profile = UserProfile.objects.filter(
+            realm=realm, is_active=True, is_bot=False).order_by('id')[0]
+        recipients = list(Recipient.objects.filter(
+            id__in=Subscription.objects.filter(
+                user_profile=user_profile, active=True,
+                recipient__type=Recipient.STREAM).values('recipient_id')))
+        if not recipients:
+            raise CommandError("%s isn't subscribed to any streams" % (user_profile.email,))
+        self.stdout.write("Catching up %s, subscribed to %d streams" % (
+            user_profile.email, len(recipients)))
+
+        for backlog in [int(n) for n in options['backlogs'].split(',')]:
+            times = [self.time_catch_up(user_profile, recipients, backlog)
+                     for i in range(options['runs'])]
+            self.stdout.write("%7d messages: mean %.1fms, min %.1fms (%.0f messages/second)" % (
+                backlog, 1000 * sum(times) / len(times), 1000 * min(times),
+                backlog / max(min(times), 0.001)))
+
+    def time_catch_up(self, user_profile: UserProfile, recipients: List[Recipient],
+                      backlog: int) -> float:
+        with transaction.atomic():
+            do_soft_deactivate_user(user_profile)
+            sending_client = get_client("benchmark_soft_deactivation")
+            now = timezone_now()
+            messages = []  # type: List[Message]
+            for i in range(backlog):
+                message = Message(
+                    sender=user_profile,
+                    recipient=recipients[i % len(recipients)],
+                    content="message %d" % (i,),
+                    rendered_content="<p>message %d</p>" % (i,),
+                    rendered_content_version=1,
+                    pub_date=now,
+                    sending_client=sending_client,
+                )
+                message.set_topic_name("benchmark")
+                messages.append(message)
+            Message.objects.bulk_create(messages, batch_size=10000)
+
+            start = time.time()
+            add_missing_messages(user_profile)
+            elapsed = time.time() - start
+
+            assert UserMessage.objects.filter(
+                user_profile=user_profile,
+                message_id__gte=messages[0].id).count() == backlog
+            transaction.set_rollback(True)
+        user_profile.refresh_from_db()
+        return elapsed
@@ -0,0 +1,79 @@
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+from django.conf import settings
+from django.core.management.base import CommandError, CommandParser
+
+from zerver.lib.management import ZulipBaseCommand
+from zerver.lib.queue import queue_json_publish
+from zerver.models import Client, UserProfile, get_client
+from zerver.tornado.event_queue import get_user_events, request_event_queue
+from zerver.tornado.notify_socket import send_notices_via_socket
+from zerver.tornado.sharding import get_tornado_port, notify_tornado_queue_name
+
+class Command(ZulipBaseCommand):
+    help = """Measure the end-to-end latency of delivering an event to a running
+Tornado process, from send until it's available on an event queue, via
+RabbitMQ and via the Unix socket transport (USING_TORNADO_NOTIFY_SOCKET).
+
+Usage: ./manage.py benchmark_tornado_notify <email> -r <realm> [--count=200]"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("email", metavar="<email>", type=str,
+                            help="Email address of the user whose event queue to use")
+        parser.add_argument('--count', dest='count', type=int, default=200,
+                            help='Number of events to send over each transport')
+        self.add_realm_args(parser)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        if not settings.TORNADO_SERVER:
+            raise CommandError("This benchmark requires a running Tornado server.")
+
+        realm = self.get_realm(options)
+        user_profile = self.get_user(options["email"], realm)
+        port = get_tornado_port(user_profile.realm)
+        client = get_client("benchmark_tornado_notify")  # type: Client
+
+        def send_via_rabbitmq(notice: Dict[str, Any]) -> None:
+            queue_json_publish(notify_tornado_queue_name(port), notice)
+
+        def send_via_socket(notice: Dict[str, Any]) -> None:
+            if not send_notices_via_socket(port, [notice]):
+                raise CommandError("Could not connect to Tornado's notify socket; "
+                                   "is USING_TORNADO_NOTIFY_SOCKET enabled?")
+
+        transports = []  # type: List[Tuple[str, Callable[[Dict[str, Any]], None]]]
+        if settings.USING_RABBITMQ:
+            transports.append(("RabbitMQ", send_via_rabbitmq))
+        transports.append(("Unix socket", send_via_socket))
+
+        for (name, send) in transports:
+            queue_id = request_event_queue(user_profile, client, apply_markdown=True,
+                                           client_gravatar=True, queue_lifespan_secs=60,
+                                           event_types=["heartbeat"])
+            latencies = self.measure(user_profile, queue_id, send, options["count"])
+            latencies.sort()
+            self.stdout.write("%s: %d events, mean %.2fms, median %.2fms, p99 %.2fms" % (
+                name, len(latencies),
+                1000 * sum(latencies) / len(latencies),
+                1000 * latencies[len(latencies) // 2],
+                1000 * latencies[int(len(latencies) * 0.99)]))
+
+    def measure(self, user_profile: UserProfile, queue_id: str,
+                send: Callable[[Dict[str, Any]], None], count: int) -> List[float]:
+        latencies = []  # type: List[float]
+        last_event_id = -1
+        for i in range(count):
+            notice = dict(event=dict(type="heartbeat"), users=[user_profile.id])
+            start = time.time()
+            send(notice)
+            # Poll until the event has been added to the queue; each
+            # poll is a round trip to Tornado, which limits the
+            # resolution of this measurement to about that much.
+            while True:
+                events = get_user_events(user_profile, queue_id, last_event_id)
+                if events:
+                    break
+            latencies.append(time.time() - start)
+            last_event_id = events[-1]["id"]
+        return latencies
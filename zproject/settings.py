@@ -14,8 +14,9 @@ from copy import deepcopy
 import os
 import time
 import sys
-from typing import Any, Optional
+from typing import Any, Dict, Optional
 import configparser
+import json
 
 from zerver.lib.db import TimeTrackingConnection
 import zerver.lib.logging_util
@@ -467,6 +468,42 @@ DEFAULT_SETTINGS.update({
     # users, and you would like to save some disk space. Soft-deactivated
     # returning users would still be caught-up normally.
     'AUTO_CATCH_UP_SOFT_DEACTIVATED_USERS': True,
+
+    # Deliver events from Django to Tornado over a Unix socket, rather
+    # than via RabbitMQ, when Tornado runs on the same host.  RabbitMQ
+    # is still used if the socket isn't available.
+    'USING_TORNADO_NOTIFY_SOCKET': False,
+
+    # Size of the thread pool used to fetch the independent sections of
+    # the initial state for /register concurrently, each with its own
+    # database connection; 0 fetches them one after another.
+    'INITIAL_STATE_FETCH_THREADS': 0,
+
+    # Maximum number of markdown engines (one per realm, roughly) that
+    # each process keeps around for rendering messages.
+    'BUGDOWN_ENGINE_POOL_SIZE': 64,
+
+    # Maximum number of rendered messages that each process caches,
+    # for messages (e.g. from integrations) with the same content as
+    # a recent one; 0 disables the cache.
+    'BUGDOWN_RENDER_CACHE_SIZE': 0,
+
+    # How message dicts are encoded in the remote cache: 'json' (zlib
+    # compressed JSON objects), or 'compact' (see
+    # stringify_message_dict_compact), which is smaller and faster to
+    # decode.
+    'MESSAGE_CACHE_FORMAT': 'json',
+
+    # Maximum number of entries in each process's local cache of the
+    # hottest remote cache keys (see zerver.lib.cache.LocalCache), and
+    # how many seconds they're kept for; a size of 0 disables it.
+    'LOCAL_CACHE_SIZE': 1000,
+    'LOCAL_CACHE_TIMEOUT': 30,
+
+    # Whether increments to LoggingCountStats (e.g. invites sent) are
+    # accumulated in redis and written to the analytics tables in bulk
+    # when the stats are next filled, rather than written immediately.
+    'BUFFER_LOGGING_STATS': True,
 })
 
 
@@ -596,6 +633,14 @@ CORPORATE_ENABLED = 'corporate' in INSTALLED_APPS
 # We override the port number when running frontend tests.
 TORNADO_PROCESSES = int(get_config('application_server', 'tornado_processes', 1))
 TORNADO_SERVER = 'http://127.0.0.1:9993'
+# With multiple Tornado processes, realms are assigned to a process
+# by hashing their hostname (matching nginx's split_clients); this
+# maps realm hostnames to explicit Tornado ports, overriding the hash.
+TORNADO_SHARDING_MAP = {}  # type: Dict[str, int]
+if TORNADO_PROCESSES > 1 and os.path.exists("/etc/zulip/sharding.json"):
+    with open("/etc/zulip/sharding.json") as f:
+        # Lowercased, since we look up hosts as nginx's $host does.
+        TORNADO_SHARDING_MAP = {host.lower(): port for (host, port) in json.load(f).items()}
 RUNNING_INSIDE_TORNADO = False
 AUTORELOAD = DEBUG
 
@@ -1017,6 +1062,7 @@ ZULIP_PATHS = [
     ("MANAGEMENT_LOG_PATH", "/var/log/zulip/manage.log"),
     ("WORKER_LOG_PATH", "/var/log/zulip/workers.log"),
     ("JSON_PERSISTENT_QUEUE_FILENAME_PATTERN", "/home/zulip/tornado/event_queues%s.json"),
+    ("TORNADO_NOTIFY_SOCKET_PATTERN", "/home/zulip/tornado/notify%s.sock"),
     ("EMAIL_LOG_PATH", "/var/log/zulip/send_email.log"),
     ("EMAIL_MIRROR_LOG_PATH", "/var/log/zulip/email_mirror.log"),
     ("EMAIL_DELIVERER_LOG_PATH", "/var/log/zulip/email-deliverer.log"),
@@ -161,6 +161,14 @@ PUSH_NOTIFICATION_BOUNCER_URL = None
 # Disable messages from slow queries as they affect backend tests.
 SLOW_QUERY_LOGS_STREAM = None
 
+# Many tests count or mock remote cache requests.  Explicitly enable
+# this within tests of the local cache.
+LOCAL_CACHE_SIZE = 0
+
+# Analytics tests check the count tables right after incrementing
+# LoggingCountStats.
+BUFFER_LOGGING_STATS = False
+
 THUMBOR_URL = 'http://127.0.0.1:9995'
 THUMBNAIL_IMAGES = True
 THUMBOR_SERVES_CAMO = True